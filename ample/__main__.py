@@ -11,6 +11,12 @@ to ccp4-python under windows.
 if __name__ == '__main__':
     import os, sys
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        # Run jobs from the job broker of an AMPLE run on another machine
+        from ample.util import broker
+
+        sys.exit(broker.main(sys.argv[2:]))
+
     from ample import main
     from ample.util import exit_util
 
@@ -27,7 +27,6 @@ import iotbx.pdb
 
 
 from ample.ensembler.abinitio import AbinitioEnsembler
-from ample.ensembler.constants import SPICKER_TM
 from ample.ensembler.homologs import HomologEnsembler
 from ample.ensembler.single_model import SingleModelEnsembler
 from ample.util import ample_util
@@ -313,15 +312,6 @@ def ensemble_summary(ensembles_data):
     return rstr
 
 
-def get_ensembler_timeout(optd, tm_timeout=3600 * 8):
-    """Set how long the ensembling should run based on the type of job being run"""
-    timeout = optd['ensembler_timeout']
-    if optd['cluster_method'] == SPICKER_TM:
-        if int(timeout) < tm_timeout:
-            timeout = tm_timeout
-    return timeout
-
-
 def import_ensembles(amoptd):
     """Import ensembles using their file paths
 
@@ -73,6 +73,7 @@ try:
         process_ensemble_options(optd)
         optd['ensemble_ok'] = os.path.join(optd['work_dir'], 'ensemble.ok')
         optd['results_path'] = os.path.join(optd['work_dir'], AMPLE_PKL)
+    ample_util.set_tool_timeouts(optd.get('tool_timeouts'))
     ensembler.create_ensembles(optd)
     ample_util.save_amoptd(optd)
 except Exception as e:
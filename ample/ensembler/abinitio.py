@@ -14,10 +14,21 @@ from ample.ensembler import subcluster
 from ample.ensembler import subcluster_util
 from ample.ensembler import truncation_util
 
-from ample.ensembler.constants import SIDE_CHAIN_TREATMENTS, SUBCLUSTER_RADIUS_THRESHOLDS, SPICKER_RMSD, SPICKER_TM
+from ample.ensembler.constants import (
+    KMEDOIDS_RMSD,
+    KMEDOIDS_TM,
+    SIDE_CHAIN_TREATMENTS,
+    SUBCLUSTER_RADIUS_THRESHOLDS,
+    SPICKER_NUMPY,
+    SPICKER_RMSD,
+    SPICKER_TM,
+)
 from ample.util import fast_protein_cluster
+from ample.util import kmedoids
+from ample.util import rmsd_util
 from ample.util import scwrl_util
 from ample.util import spicker
+from ample.util import spicker_util
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +53,10 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         # we save the truncator so that we can query it for data later
         self.truncator = None
 
+        # CA coordinates of the models of each cluster, keyed by the cluster index, so that the distance
+        # matrices for all the truncation levels can be calculated without reading the truncated models
+        self.coordinate_cache = {}
+
         return
 
     def cluster_models(
@@ -100,6 +115,15 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                 nproc=self.nproc,
             )
             logger.debug(spickerer.results_summary())
+        elif cluster_method_type == SPICKER_NUMPY:
+            logger.info('* Clustering models with the SPICKER algorithm *')
+            spickerer = spicker_util.Spickerer()
+            clusters = spickerer.cluster(models, num_clusters=num_clusters, max_cluster_size=max_cluster_size)
+            logger.debug(spickerer.results_summary())
+        elif cluster_method_type == 'kmedoids':
+            logger.info('* Clustering models with k-medoids using score_type: %s *', cluster_score_type)
+            clusterer = kmedoids.KMedoidsClusterer(score_type=cluster_score_type, nproc=self.nproc)
+            clusters = clusterer.cluster(models, num_clusters=num_clusters, max_cluster_size=max_cluster_size)
         else:
             raise RuntimeError('Unrecognised clustering method: {}'.format(cluster_method_type))
 
@@ -211,6 +235,8 @@ class AbinitioEnsembler(_ensembler.Ensembler):
             if use_scwrl:
                 cluster.models = self.scwrl_models(cluster.models, truncate_dir, self.scwrl_exe)
 
+            self.cache_coordinates(cluster, subcluster_program)
+
             self.truncator = truncation_util.Truncator(work_dir=truncate_dir)
             self.truncator.theseus_exe = self.theseus_exe
             for truncation in self.truncator.truncate_models(
@@ -233,6 +259,31 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                         self.ensembles.append(ensemble)
         return self.ensembles
 
+    def cache_coordinates(self, cluster, subcluster_program):
+        """Read the coordinates of the models in a cluster once if the subclusterer can use them"""
+        self.coordinate_cache.pop(cluster.index, None)
+        if not subcluster_program or not self.subclusterer_factory(subcluster_program).uses_coordinates:
+            return
+        try:
+            self.coordinate_cache[cluster.index] = rmsd_util.residue_coordinates(cluster.models)
+        except RuntimeError as e:
+            logger.debug("Not caching the coordinates of cluster %d: %s", cluster.index, e)
+
+    def generate_distance_matrix(self, clusterer, truncation):
+        """Generate the distance matrix for a truncation, using the cached coordinates of its cluster if we have them
+
+        The truncated models are in the same order as the models of the cluster, so their coordinates are just
+        the cached coordinates of the residues that the truncation keeps.
+        """
+        coords = None
+        if clusterer.uses_coordinates and truncation.cluster is not None:
+            coords = self.coordinate_cache.get(truncation.cluster.index)
+        if coords is None or len(coords) != len(truncation.models):
+            clusterer.generate_distance_matrix(truncation.models)
+        else:
+            coords = rmsd_util.select_residues(coords, truncation.residues_idxs)
+            clusterer.generate_distance_matrix(truncation.models, coords=coords)
+
     def generate_ensembles_from_amoptd(self, models, amoptd):
         """Generate ensembles from data in supplied ample data dictionary."""
         kwargs = {
@@ -272,7 +323,12 @@ class AbinitioEnsembler(_ensembler.Ensembler):
             cluster_exe = self.spicker_exe
             if cluster_method == SPICKER_TM:
                 cluster_score_type = 'tm'
-        elif cluster_method in ['import', 'random', 'skip']:
+        elif cluster_method in [KMEDOIDS_RMSD, KMEDOIDS_TM]:
+            cluster_method_type = 'kmedoids'
+            cluster_exe = None
+            if cluster_method == KMEDOIDS_TM:
+                cluster_score_type = 'tm'
+        elif cluster_method in [SPICKER_NUMPY, 'import', 'random', 'skip']:
             cluster_method_type = cluster_method
             cluster_exe = None
         else:
@@ -295,12 +351,17 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         scwrled_models = scwrl_util.Scwrl(scwrl_exe=scwrl_exe).process_models(models, scwrl_directory, strip_oxt=True)
         return scwrled_models
 
-    def subclusterer_factory(self, subcluster_program):
-        """Return an instantiated subclusterer based on the given program"""
+    def subclusterer_factory(self, subcluster_program, cutoff=None):
+        """Return an instantiated subclusterer based on the given program
+
+        If the subclusterer can skip pairs of models, cutoff is the largest radius the models will be clustered under
+        """
         if subcluster_program == 'gesamt':
             clusterer = subcluster.GesamtClusterer(self.gesamt_exe, nproc=self.nproc)
         elif subcluster_program == 'lsqkab':
-            clusterer = subcluster.LsqkabClusterer(self.lsqkab_exe)
+            clusterer = subcluster.LsqkabClusterer(self.lsqkab_exe, nproc=self.nproc)
+        elif subcluster_program == 'kabsch':
+            clusterer = subcluster.KabschClusterer(nproc=self.nproc, cutoff=cutoff)
         else:
             raise RuntimeError("Unrecognised subcluster_program: {0}".format(subcluster_program))
         return clusterer
@@ -336,8 +397,8 @@ class AbinitioEnsembler(_ensembler.Ensembler):
         os.chdir(truncation.directory)
 
         # Generate the distance matrix
-        clusterer = self.subclusterer_factory(subcluster_program)
-        clusterer.generate_distance_matrix(truncation.models)
+        clusterer = self.subclusterer_factory(subcluster_program, cutoff=max(radius_thresholds))
+        self.generate_distance_matrix(clusterer, truncation)
         # clusterer.dump_matrix(os.path.join(truncation_dir,"subcluster_distance.matrix")) # for debugging
 
         # Loop through the radius thresholds
@@ -379,8 +440,8 @@ class AbinitioEnsembler(_ensembler.Ensembler):
     def subcluster_models_floating_radii(self, truncation, subcluster_program=None, ensemble_max_models=None):
         logger.info("subclustering with floating radii")
 
-        clusterer = self.subclusterer_factory(subcluster_program)
-        clusterer.generate_distance_matrix(truncation.models)
+        clusterer = self.subclusterer_factory(subcluster_program, cutoff=max(self.subcluster_radius_thresholds))
+        self.generate_distance_matrix(clusterer, truncation)
         # clusterer.dump_matrix(os.path.join(truncation_dir,"subcluster_distance.matrix")) # for debugging
 
         subclusters = []
@@ -393,9 +454,7 @@ class AbinitioEnsembler(_ensembler.Ensembler):
             if i > 0 and radii[i - 1] > self.subcluster_radius_thresholds[i]:
                 radius = radii[i - 1]
                 nmodels = len(clusters[i - 1])
-                cluster_files, radius = subcluster_util.subcluster_nmodels(
-                    nmodels, radius, clusterer, direction='up', increment=1
-                )
+                cluster_files, radius = subcluster_util.subcluster_nmodels(nmodels, clusterer)
             else:
                 radius = self.subcluster_radius_thresholds[i]
                 cluster_files = clusterer.cluster_by_radius(radius)
@@ -416,10 +475,8 @@ class AbinitioEnsembler(_ensembler.Ensembler):
                 else:
                     radius = radii[i - 1]
                     nmodels = len(clusters[i - 1]) + 1
-                cluster_files, radius = subcluster_util.subcluster_nmodels(
-                    nmodels, radius, clusterer, direction='up', increment=1
-                )
-                cluster_files = sorted(cluster_files)
+                cluster_files, radius = subcluster_util.subcluster_nmodels(nmodels, clusterer)
+                cluster_files = sorted(cluster_files or [])
             elif cluster_size >= ensemble_max_models or cluster_files in clusters:
                 # Randomly pick ensemble_max_models
                 cluster_files = subcluster_util.pick_nmodels(cluster_files, clusters, ensemble_max_models)
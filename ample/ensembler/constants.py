@@ -10,3 +10,6 @@ ALLOWED_SIDE_CHAIN_TREATMENTS = [POLYALA, RELIABLE, ALLATOM, UNMODIFIED]  # All
 SUBCLUSTER_RADIUS_THRESHOLDS = [1, 3]
 SPICKER_RMSD = 'spicker'
 SPICKER_TM = 'spicker_tm'
+SPICKER_NUMPY = 'spicker_numpy'  # SPICKER RMSD clustering without the spicker executable
+KMEDOIDS_RMSD = 'kmedoids'
+KMEDOIDS_TM = 'kmedoids_tm'
@@ -7,20 +7,24 @@ __version__ = "1.0"
 from collections import namedtuple
 import itertools
 import logging
+import math
 import mmtbx.superpose
 import numpy
 import re
 import os
 import shutil
+import sys
 
-from ample.util import ample_util, pdb_edit
+from ample.util import ample_util, distance_matrix, pdb_edit, rmsd_util, workers_util
 
 logger = logging.getLogger()
 
 SCORE_MATRIX_NAME = 'score.matrix'
+MATRIX_NAME = 'distance.matrix'
 FILE_LIST_NAME = 'files.list'
 RMSD_MAX = 50
 QSCORE_MIN = 0.01
+RADIUS_DECIMALS = 3  # Radii found by cluster_by_nmodels are rounded up to this many decimal places
 
 
 class SubClusterer(object):
@@ -28,6 +32,9 @@ class SubClusterer(object):
     Sub-classes just need to provide a generate_distance_matrix class
     """
 
+    # Whether generate_distance_matrix can be given coordinates that have already been read from the models
+    uses_coordinates = False
+
     def __init__(self, executable=None, nproc=1):
         if executable and not os.path.exists(executable) and os.access(executable, os.X_OK):
             raise RuntimeError("Cannot find subclusterer executable: {0}".format(executable))
@@ -36,10 +43,33 @@ class SubClusterer(object):
         self.distance_matrix = None
         self.index2pdb = []
         self.cluster_score = None
+        self._radius_index = None
 
     def generate_distance_matrix(self, *args, **kwargs):
         raise NotImplementedError
 
+    @property
+    def radius_index(self):
+        """The :obj:`ample.util.distance_matrix.RadiusIndex` of the distance matrix, created when it's first needed"""
+        if self._radius_index is None or self._radius_index.matrix is not self.distance_matrix:
+            self._radius_index = distance_matrix.RadiusIndex(self.distance_matrix)
+        return self._radius_index
+
+    def cluster_by_nmodels(self, nmodels):
+        """Return the smallest cluster of at least nmodels pdbs and the radius that gives it
+
+        The radius is rounded up to RADIUS_DECIMALS decimal places. If no radius gives nmodels pdbs
+        the largest cluster is returned.
+        """
+        if self.distance_matrix is None:
+            raise RuntimeError("Need to call generate_distance_matrix before cluster_by_nmodels!")
+        radius = self.radius_index.radius_for(nmodels)
+        if radius is None:
+            radius = float(numpy.max(self.distance_matrix.data)) if len(self.distance_matrix.data) else 0.0
+        scale = 10 ** RADIUS_DECIMALS
+        radius = math.ceil(radius * scale) / scale
+        return self.cluster_by_radius(radius), radius
+
     def cluster_by_radius(self, radius):
         """Return a list of pdbs clustered by the given radius"""
         if self.distance_matrix is None:
@@ -53,29 +83,18 @@ class SubClusterer(object):
 
     def _cluster_indices(self, thresh):
         """Return the indices of the largest cluster that have distances < thresh.
-        We loop through each row of the distance matrix and for each row (pdb) see
-        how many pdbs are < thresh to this pdb. We return the largest cluster.
+        For each row (pdb) of the distance matrix we count how many pdbs are < thresh to this pdb
+        with a binary search of the sorted row in the radius index. We return the largest cluster.
         """
-        # self.dump_matrix("maxcluster.csv")
         thresh = float(thresh)
 
-        # get mask of all elements where condition is true. We exclude 0.0 to ensure we don't get the
-        # index of the model that the row is compared with, as this needs to be the first model in the
-        # ensemble. This means we would also exclude models that had an rmsd of zero to the centroid, but
-        # as these are likely to be identical (and this occurrence rare), this should be ok
-        condition = numpy.logical_and(self.distance_matrix <= thresh, self.distance_matrix != 0.0)
+        # We exclude 0.0 to ensure we don't get the index of the model that the row is compared with, as this
+        # needs to be the first model in the ensemble. This means we would also exclude models that had an rmsd
+        # of zero to the centroid, but as these are likely to be identical (and this occurrence rare), this
+        # should be ok. The first row with the most models under thresh becomes the centroid of the cluster.
+        max_cluster = self.radius_index.largest_cluster(thresh)
 
-        # Array of sums of each row - largest number is a row where most items satisfy condition
-        condition_sum = condition.sum(axis=1)
-
-        # Find all rows that have the maximum of the condition true and then select the first one
-        row_index = numpy.where(condition_sum == numpy.max(condition_sum))[0][0]
-
-        # Select all values from that row where the condition is true and insert the first index so that
-        # it becomes the centroid of that cluster
-        max_cluster = numpy.insert(numpy.where(condition[row_index])[0], 0, row_index)
-
-        if len(max_cluster) == 1:
+        if len(max_cluster) <= 1:
             return None, None
         else:
             cluster_score = self.calculate_score(max_cluster)
@@ -85,15 +104,16 @@ class SubClusterer(object):
         """Given a list of indices of a cluster, calculate the rmsd we want to give to phaser
         """
         ALL_BY_ALL = True
+        cluster = numpy.asarray(cluster)
         if ALL_BY_ALL:
-            rmsds = [self.distance_matrix[i] for i in itertools.combinations(cluster, 2)]
+            i, j = numpy.triu_indices(len(cluster), 1)
+            rmsds = self.distance_matrix[cluster[i], cluster[j]]
         else:
             # Just use the rmsds of the decoys to the the cluster centroid - assumes
             # the centroid approximates the native
-            row = cluster[0]
-            rmsds = [self.distance_matrix[row][j] for j in cluster[1:]]
+            rmsds = self.distance_matrix[cluster[0], cluster[1:]]
 
-        return max(rmsds)
+        return float(numpy.max(rmsds))
 
     def dump_raw_matrix(self, file_name):
         with open(file_name, 'w') as f:
@@ -103,55 +123,80 @@ class SubClusterer(object):
         return
 
     def dump_pdb_matrix(self, file_name=SCORE_MATRIX_NAME, offset=0):
-        with open(file_name, 'w') as f:
-            l = len(self.distance_matrix) + offset
-            for i in range(offset, l):
-                for j in range(i, l):
-                    f.write(
-                        "{0: > 4d} {1: > 4d} {2: > 8.3F}\n".format(i, j, self.distance_matrix[i - offset][j - offset])
-                    )
-            f.write("\n")
-        return os.path.abspath(file_name)
+        """Write the matrix in the text format used by SPICKER"""
+        return distance_matrix.write_text(self.distance_matrix, file_name, offset=offset)
+
+    def dump_matrix(self, file_name=MATRIX_NAME):
+        """Write the matrix and index2pdb to a binary file - see :func:`ample.util.distance_matrix.read`"""
+        return distance_matrix.write(self.distance_matrix, file_name, models=self.index2pdb)
 
 
 class CctbxClusterer(SubClusterer):
-    """Class to cluster files with CCTBX"""
+    """Class to cluster files with CCTBX
+
+    Each model is parsed once and the rows of the distance matrix are shared out
+    between nproc forked processes, which inherit the parsed models rather than
+    having them pickled and sent to them.
+    """
 
     def generate_distance_matrix(self, pdb_list):
         """Run cctbx to generate the distance distance_matrix"""
+        global _CCTBX_MODELS
 
         num_models = len(pdb_list)
         if not num_models:
             raise RuntimeError("generate_distance_matrix got empty pdb_list!")
 
         # Index is just the order of the pdb in the file
-        self.index2pdb = sorted(pdb_list)
-
-        # Create a square matrix storing the rmsd distances between models
-        self.distance_matrix = numpy.zeros([num_models, num_models])
-        for m1, m2 in itertools.combinations(pdb_list, 2):
-            i, j = pdb_list.index(m1), pdb_list.index(m2)
-            fixed = mmtbx.superpose.SuperposePDB(m1, preset='ca', log=None, quiet=True)
-            moving = mmtbx.superpose.SuperposePDB(m2, preset='ca', log=None, quiet=True)
-            rmsd, _ = moving.superpose(fixed)
-            self.distance_matrix[i, j] = self.distance_matrix[j, i] = float(rmsd)
-
-        # # Might be deleted when confirmed that above code works
-        # for i, m1 in enumerate(pdb_list):
-        #     fixed = mmtbx.superpose.SuperposePDB(m1, preset='ca', log=None, quiet=True)
-        #     for j, m2 in enumerate(pdb_list):
-        #         if j <= i: continue
-        #         moving = mmtbx.superpose.SuperposePDB(m2, preset='ca', log=None, quiet=True)
-        #         rmsd, _ = moving.superpose(fixed)
-        #         self.distance_matrix[i][j] = float(rmsd)
-
-        # # Copy in other half of matrix - we use a full matrix as it's easier to scan for clusters
-        # for x in range(len(self.distance_matrix)):
-        #     for y in range(len(self.distance_matrix)):
-        #         self.distance_matrix[y][x] = self.distance_matrix[x][y]
+        order = sorted(range(num_models), key=lambda i: pdb_list[i])
+        self.index2pdb = [pdb_list[i] for i in order]
+
+        # Pairs are superposed in the order of pdb_list, so the RMSDs are the same however the rows are split up
+        _CCTBX_MODELS = [mmtbx.superpose.SuperposePDB(pdb, preset='ca', log=None, quiet=True) for pdb in pdb_list]
+        # The position of each model of pdb_list in index2pdb
+        rank = numpy.argsort(order)
+        matrix = distance_matrix.CondensedDistanceMatrix(num_models)
+        try:
+            if self.nproc > 1 and num_models > 2 and sys.platform != 'win32':
+                pool = workers_util.fork_pool(min(self.nproc, num_models - 1))
+                try:
+                    rows = pool.imap_unordered(_cctbx_row, range(num_models - 1))
+                    for i, rmsds in rows:
+                        matrix[rank[i], rank[i + 1 :]] = rmsds
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for i in range(num_models - 1):
+                    matrix[rank[i], rank[i + 1 :]] = _cctbx_row(i)[1]
+        finally:
+            _CCTBX_MODELS = None
+        self.distance_matrix = matrix
         return
 
 
+def split_threads(nproc, njobs):
+    """Share nproc threads out between njobs jobs
+
+    Returns
+    -------
+    tuple
+       The number of jobs to run at once and the number of threads each should use
+    """
+    nconcurrent = max(1, min(nproc, njobs))
+    return nconcurrent, max(1, nproc // nconcurrent)
+
+
+# The models parsed by CctbxClusterer.generate_distance_matrix - the forked processes inherit them from the parent
+_CCTBX_MODELS = None
+
+
+def _cctbx_row(i):
+    """Return the RMSDs of model i to all the models after it"""
+    fixed = _CCTBX_MODELS[i]
+    return i, [float(moving.superpose(fixed)[0]) for moving in _CCTBX_MODELS[i + 1 :]]
+
+
 class FpcClusterer(SubClusterer):
     """Class to cluster files with fast_protein_clusterer"""
 
@@ -191,24 +236,10 @@ class FpcClusterer(SubClusterer):
                 mlen = max(mlen, x + 1)  # +1 as we want the length
                 data.append((x, y, d))
 
-        # create empty matrix - we use None's but this means we need to check for then when
-        # looking through the matrix
-        # use square matrix to make indexing easier as we're unlikely to be very big
-        m = numpy.zeros([mlen, mlen])
-
         # Fill in all values (upper triangle)
+        m = distance_matrix.CondensedDistanceMatrix(mlen)
         for i, j, d in data:
-            if i > j:
-                m[j][i] = d
-            else:
-                m[i][j] = d
-
-        # Copy to lower
-        for x in range(mlen):
-            for y in range(mlen):
-                if x == y:
-                    continue
-                m[y][x] = m[x][y]
+            m[i, j] = d
 
         self.distance_matrix = m
         return
@@ -221,7 +252,7 @@ class GesamtClusterer(SubClusterer):
         if True:
             self._generate_pairwise_rmsd_matrix(pdb_list, purge=purge)
         else:
-            self._generate_distance_matrix_generic(self, pdb_list, purge=purge, purge_all=False, metric='qscore')
+            self._generate_distance_matrix_generic(pdb_list, purge=purge, purge_all=False, metric='qscore')
         return
 
     def _generate_pairwise_rmsd_matrix(self, models, purge=False):
@@ -257,9 +288,8 @@ where inp_list.dat  contains:
         if rtn != 0:
             raise RuntimeError("Error running gesamt - check logfile: {0}".format(logfile))
 
-        # Create a square distance_matrix no_models in size filled with None
         num_models = len(models)
-        self.distance_matrix = numpy.zeros([num_models, num_models])
+        self.distance_matrix = distance_matrix.CondensedDistanceMatrix(num_models)
 
         # Read in the rmsds calculated
         self._parse_gesamt_rmsd_log(logfile, num_models)
@@ -284,10 +314,8 @@ where inp_list.dat  contains:
                     rmsd_txt = fields[2].strip()
                     # poke into distance matrix
                     rmsds = [float(r) for r in rmsd_txt.split()]
-                    for j in range(len(rmsds)):
-                        if j == nmodel:
-                            continue
-                        self.distance_matrix[nmodel - 1][j] = rmsds[j]
+                    # The matrix is symmetric so we only need the upper triangle
+                    self.distance_matrix.set_upper(nmodel - 1, rmsds[nmodel:])
                     if nmodel == num_models:
                         reading = -1
         if nmodel != num_models:
@@ -309,24 +337,29 @@ where inp_list.dat  contains:
         with open(fname, 'w') as f:
             f.write("\n".join(models) + "\n")
 
-        # Make the archive
-        logger.debug("Generating gesamt archive from models in directory %s", mdir)
-        garchive = 'gesamt.archive'
-        if not os.path.isdir(garchive):
+        # Make the archive unless we already have one made from the same models
+        garchive = os.path.abspath('gesamt.archive')
+        signature_file = garchive + '.sig'
+        signature = self._archive_signature(mdir)
+        if os.path.isdir(garchive) and self._read_signature(signature_file) == signature:
+            logger.debug("Reusing gesamt archive %s", garchive)
+        else:
+            logger.debug("Generating gesamt archive from models in directory %s", mdir)
+            if os.path.isdir(garchive):
+                shutil.rmtree(garchive)
             os.mkdir(garchive)
-        logfile = os.path.abspath('gesamt_archive.log')
-        cmd = [self.executable, '--make-archive', garchive, '-pdb', mdir]
-        # cmd += [ '-nthreads=auto' ]
-        cmd += ['-nthreads={0}'.format(self.nproc)]
-        # HACK FOR DYLD!!!!
-        env = None
-        # env = {'DYLD_LIBRARY_PATH' : '/opt/ccp4-devtools/install/lib'}
-        rtn = ample_util.run_command(cmd, logfile, env=env)
-        if rtn != 0:
-            raise RuntimeError("Error running gesamt - check logfile: {0}".format(logfile))
-
-        if purge_all:
-            os.unlink(logfile)
+            if os.path.isfile(signature_file):
+                os.unlink(signature_file)
+            logfile = os.path.abspath('gesamt_archive.log')
+            cmd = [self.executable, '--make-archive', garchive, '-pdb', mdir]
+            cmd += ['-nthreads={0}'.format(self.nproc)]
+            rtn = ample_util.run_command(cmd, logfile)
+            if rtn != 0:
+                raise RuntimeError("Error running gesamt - check logfile: {0}".format(logfile))
+            with open(signature_file, 'w') as f:
+                f.write(signature)
+            if purge_all:
+                os.unlink(logfile)
 
         # Now loop through each file creating the matrix
         if metric == 'rmsd':
@@ -336,57 +369,75 @@ where inp_list.dat  contains:
         else:
             raise RuntimeError("Unrecognised metric: {0}".format(metric))
 
-        # m = [[parity for _ in range(nmodels)] for _ in range(nmodels)]
-        m = numpy.full([nmodels, nmodels], parity, dtype=numpy.float)
-        for i, model in enumerate(models):
-            mname = os.path.basename(model)
-            gesamt_out = '{0}_gesamt.out'.format(mname)
-            logfile = '{0}_gesamt.log'.format(mname)
-            cmd = [self.executable, model, '-archive', garchive, '-o', gesamt_out]
-            cmd += ['-nthreads={0}'.format(self.nproc)]
-            rtn = ample_util.run_command(cmd, logfile)
-            if rtn != 0:
-                raise RuntimeError("Error running gesamt!")
-            else:
-                if purge:
-                    os.unlink(logfile)
-
-            gdata = self._parse_gesamt_out(gesamt_out)
-            assert gdata[0].file_name == mname, gdata[0].file_name + " " + mname
-            score_dict = {g.file_name: (g.rmsd, g.q_score) for g in gdata}
+        # Search the archive with each model concurrently, each search getting an equal share of the threads.
+        # Each search writes its hits to a scratch directory that we remove once we've read them.
+        nconcurrent, nthreads = split_threads(self.nproc, nmodels)
+        gesamt_out = 'gesamt.out'
+        nthreads = '-nthreads={0}'.format(nthreads)
+        cmds = [[self.executable, os.path.abspath(m), '-archive', garchive, '-o', gesamt_out, nthreads] for m in models]
+        logfiles = None if purge else [os.path.abspath('{0}_gesamt.log'.format(os.path.basename(m))) for m in models]
+        results = ample_util.run_commands(cmds, logfiles=logfiles, nproc=nconcurrent, keep_scratch=True)
+
+        m = distance_matrix.CondensedDistanceMatrix(nmodels, diagonal=parity)
+        try:
+            for i, (model, result) in enumerate(zip(models, results)):
+                if result.returncode != 0:
+                    raise RuntimeError("Error running gesamt!")
+                mname = os.path.basename(model)
+                gdata = self._parse_gesamt_out(os.path.join(result.directory, gesamt_out))
+                assert gdata[0].file_name == mname, gdata[0].file_name + " " + mname
+                score_dict = {g.file_name: (g.rmsd, g.q_score) for g in gdata}
+
+                for j in range(i + 1, nmodels):
+                    # Try and get the rmsd and qscore for this model. If it's missing we assume the model was
+                    # too divergent for gesamt to find it and we set the rmsd and qscore to fixed values
+                    model2 = os.path.basename(models[j])
+                    try:
+                        rmsd, qscore = score_dict[model2]
+                    except KeyError:
+                        rmsd = RMSD_MAX
+                        qscore = QSCORE_MIN
+                    if metric == 'rmsd':
+                        score = rmsd
+                    elif metric == 'qscore':
+                        score = qscore
+                    else:
+                        raise RuntimeError("Unrecognised metric: {0}".format(metric))
+                    m[i, j] = score
+        finally:
+            for result in results:
+                if result.directory:
+                    shutil.rmtree(result.directory, ignore_errors=True)
 
-            for j in range(i + 1, nmodels):
-                # Try and get the rmsd and qscore for this model. If it's missing we assume the model was
-                # too divergent for gesamt to find it and we set the rmsd and qscore to fixed values
-                model2 = os.path.basename(models[j])
-                try:
-                    rmsd, qscore = score_dict[model2]
-                except KeyError:
-                    rmsd = RMSD_MAX
-                    qscore = QSCORE_MIN
-                if metric == 'rmsd':
-                    score = rmsd
-                elif metric == 'qscore':
-                    score = qscore
-                else:
-                    raise RuntimeError("Unrecognised metric: {0}".format(metric))
-                m[i, j] = score
-            if purge_all:
-                os.unlink(gesamt_out)
-
-        # Copy upper half of matrix to lower
-        i_lower = numpy.tril_indices(nmodels, -1)
-        m[i_lower] = m.T[i_lower]  # make the matrix symmetric
         self.distance_matrix = m
 
         # Remove the gesamt archive
         if purge:
             shutil.rmtree(garchive)
+            os.unlink(signature_file)
 
-        # Write out the matrix in a form spicker can use
-        self.dump_pdb_matrix(SCORE_MATRIX_NAME)
+        # Write out the matrix so spicker can use it
+        self.dump_matrix(MATRIX_NAME)
         return
 
+    @staticmethod
+    def _archive_signature(mdir):
+        """Return a string identifying the files in mdir that a gesamt archive is made from"""
+        entries = []
+        for name in sorted(os.listdir(mdir)):
+            path = os.path.join(mdir, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append("{0} {1} {2}".format(name, stat.st_size, stat.st_mtime))
+        return "{0}\n{1}\n".format(os.path.abspath(mdir), "\n".join(entries))
+
+    @staticmethod
+    def _read_signature(path):
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
     def _parse_gesamt_out(self, out_file):
         # Assumption is there are no pdb_codes
         GesamtData = namedtuple(
@@ -421,69 +472,136 @@ where inp_list.dat  contains:
         return data
 
 
+class KabschClusterer(SubClusterer):
+    """Class to cluster files by CA RMSD, calculated with NumPy rather than an external program
+
+    All the models are read into a single array and the RMSDs between every pair after
+    Kabsch superposition are calculated in batches. The RMSDs are over the residues
+    common to all the models, which for truncated ab initio decoys is all of them.
+
+    The coordinates can also be passed in directly, so that models that have already
+    been read, such as the same decoys at different truncation levels, aren't read again.
+
+    If a cutoff is given, only the pairs of models that could have an RMSD under it are superposed
+    (see :func:`ample.util.rmsd_util.pairwise_rmsd`). Clustering under a larger radius, or scoring a
+    cluster that has pairs at or above the cutoff, calculates the RMSDs that were skipped.
+    """
+
+    uses_coordinates = True
+
+    def __init__(self, executable=None, nproc=1, cutoff=None):
+        super(KabschClusterer, self).__init__(executable=executable, nproc=nproc)
+        self.cutoff = cutoff
+        self.coords = None
+
+    def generate_distance_matrix(self, models, coords=None):
+        """Generate the distance matrix for models
+
+        coords is an optional (nmodels, nresidues, 3) array of the CA coordinates of the models in the same
+        order as models. If it isn't given the coordinates are read from the files.
+        """
+        # Index is just the order of the pdbs
+        order = sorted(range(len(models)), key=lambda i: models[i])
+        self.index2pdb = [models[i] for i in order]
+        if coords is None:
+            coords = rmsd_util.ca_coordinates(self.index2pdb)
+        else:
+            coords = coords[order]
+        self.coords = coords
+        self.distance_matrix = distance_matrix.CondensedDistanceMatrix(len(models))
+        rmsd_util.pairwise_rmsd(coords, out=self.distance_matrix, cutoff=self.cutoff)
+        return
+
+    def _exact_under(self, radius):
+        """Make sure that all the RMSDs under radius are exact, calculating all of them if any were skipped"""
+        if self.cutoff is not None and radius > self.cutoff:
+            logger.debug("Calculating all the RMSDs to cluster under %.3f", radius)
+            self.cutoff = None
+            self.generate_distance_matrix(self.index2pdb, coords=self.coords)
+
+    def cluster_by_nmodels(self, nmodels):
+        if self.cutoff is not None and self.distance_matrix is not None:
+            # Radii under the cutoff are only found from exact RMSDs
+            radius = self.radius_index.radius_for(nmodels)
+            if radius is None or radius >= self.cutoff:
+                self._exact_under(float('inf'))
+        return super(KabschClusterer, self).cluster_by_nmodels(nmodels)
+
+    def cluster_by_radius(self, radius):
+        if self.distance_matrix is not None:
+            self._exact_under(radius)
+        return super(KabschClusterer, self).cluster_by_radius(radius)
+
+    def calculate_score(self, cluster):
+        score = super(KabschClusterer, self).calculate_score(cluster)
+        if self.cutoff is not None and score >= self.cutoff:
+            # Some of the pairs weren't superposed so we only have a lower bound on their RMSD
+            score = float(numpy.max(rmsd_util.pairwise_rmsd(self.coords[numpy.asarray(cluster)])))
+        return score
+
+
 class LsqkabClusterer(SubClusterer):
-    """Class to cluster files with Lsqkab"""
+    """Class to cluster files with Lsqkab
 
-    def calc_rmsd(self, model1, model2, nresidues=None, logfile='lsqkab.out', purge=False):
-        if not nresidues:
-            _, nresidues = pdb_edit.num_atoms_and_residues(model1, first=True)
+    Each pair of models is superposed by a separate lsqkab run in its own scratch directory,
+    as lsqkab always writes an RMSTAB file to the directory it is run in, so up to nproc pairs
+    can be run at once.
+    """
 
+    def _command(self, model1, model2, nresidues):
+        """Return the command and stdin to superpose the CA atoms of model2 onto model1"""
         stdin = """FIT RESIDUE CA 1 TO {0} CHAIN {1}
 MATCH 1 to  {0} CHAIN {1}
 output  RMS
 end""".format(
             nresidues, 'A'
         )
+        cmd = [self.executable or 'lsqkab', 'XYZINM', os.path.abspath(model1), 'XYZINF', os.path.abspath(model2)]
+        return cmd, stdin
 
-        cmd = ['lsqkab', 'XYZINM', model1, 'XYZINF', model2]
-        ample_util.run_command(cmd, logfile=logfile, stdin=stdin)
-        rmsd = self.parse_lsqkab_output(logfile)
-
-        # cleanup
-        if purge:
+    def calc_rmsd(self, model1, model2, nresidues=None, logfile=None, purge=False):
+        if not nresidues:
+            _, nresidues = pdb_edit.num_atoms_and_residues(model1, first=True)
+        cmd, stdin = self._command(model1, model2, nresidues)
+        result = ample_util.run_commands([cmd], stdins=[stdin], logfiles=[logfile] if logfile else None)[0]
+        if purge and logfile:
             os.unlink(logfile)
-            os.unlink('RMSTAB')
-
-        return rmsd
+        return self.parse_lsqkab_rmsd(result.output)
 
     def generate_distance_matrix(self, models):
 
         # Index is just the order of the pdb in the file
-        self.index2pdb = sorted(models)
+        models = sorted(models)
+        self.index2pdb = models
         num_models = len(models)
 
         # Assume all models are the same size and only have a single chain
         # We also assume that the chain is called 'A' (not relevant here)
         _, nresidues = pdb_edit.num_atoms_and_residues(models[0], first=True)
 
-        # Create a square distance_matrix no_models in size filled with None
-        self.distance_matrix = numpy.zeros([num_models, num_models])
-
-        logfile = 'lsqkab.out'
-        parity = 0.0
-        for i, fixed in enumerate(models):
-            for j, model2 in enumerate(models):
-                if j < i:
-                    continue
-                if j == i:
-                    rmsd = parity
-                elif j > i:
-                    rmsd = self.calc_rmsd(fixed, model2, nresidues=nresidues, logfile=logfile)
-                self.distance_matrix[i][j] = rmsd
-
-        # Clean up output files from lsqkab
-        os.unlink(logfile)
-        os.unlink('RMSTAB')
-
-        # Copy in other half of matrix - we use a full matrix as it's easier to scan for clusters
-        for x in range(len(self.distance_matrix)):
-            for y in range(len(self.distance_matrix)):
-                self.distance_matrix[y][x] = self.distance_matrix[x][y]
+        pairs = list(itertools.combinations(range(num_models), 2))
+        cmds, stdins = [], []
+        for i, j in pairs:
+            cmd, stdin = self._command(models[i], models[j], nresidues)
+            cmds.append(cmd)
+            stdins.append(stdin)
+        results = ample_util.run_commands(cmds, stdins=stdins, nproc=self.nproc)
+
+        self.distance_matrix = distance_matrix.CondensedDistanceMatrix(num_models)
+        for (i, j), result in zip(pairs, results):
+            if result.returncode != 0:
+                raise RuntimeError("Error running lsqkab on {0} and {1}".format(models[i], models[j]))
+            self.distance_matrix[i, j] = self.parse_lsqkab_rmsd(result.output)
         return
 
     def parse_lsqkab_output(self, output_file):
         with open(output_file) as f:
-            for l in f.readlines():
-                if l.startswith("          RMS     XYZ DISPLACEMENT ="):
-                    return float(l.split()[4])
-        assert False
+            return self.parse_lsqkab_rmsd(f.read())
+
+    @staticmethod
+    def parse_lsqkab_rmsd(output):
+        """Return the RMSD from the output of lsqkab"""
+        for l in output.splitlines():
+            if l.startswith("          RMS     XYZ DISPLACEMENT ="):
+                return float(l.split()[4])
+        raise RuntimeError("Could not find the RMSD in the lsqkab output")
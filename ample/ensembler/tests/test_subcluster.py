@@ -1,9 +1,16 @@
 import glob
+import itertools
 import os
 import unittest
+
+import mmtbx.superpose
+import numpy
+
 from ample import constants
 from ample.ensembler import subcluster
 from ample.util import ample_util
+from ample.util import distance_matrix
+from ample.util import rmsd_util
 from ample.testing import test_funcs
 
 
@@ -28,6 +35,21 @@ class Test_1(unittest.TestCase):
         ref = ['1_S_00000002.pdb', '1_S_00000004.pdb']
         self.assertItemsEqual(ref, cluster_files1)
 
+    def test_cctbx_matrix(self):
+        # Compare with superposing each pair from scratch, with the models out of order and the rows split
+        names = ['1_S_00000003.pdb', '1_S_00000001.pdb', '1_S_00000005.pdb', '1_S_00000002.pdb', '1_S_00000004.pdb']
+        pdb_list = [os.path.join(self.testfiles_dir, "models", pdb) for pdb in names]
+        clusterer = subcluster.CctbxClusterer(nproc=2)
+        clusterer.generate_distance_matrix(pdb_list)
+        self.assertEqual(clusterer.index2pdb, sorted(pdb_list))
+        for (i, m1), (j, m2) in itertools.combinations(enumerate(pdb_list), 2):
+            fixed = mmtbx.superpose.SuperposePDB(m1, preset='ca', log=None, quiet=True)
+            moving = mmtbx.superpose.SuperposePDB(m2, preset='ca', log=None, quiet=True)
+            rmsd = float(moving.superpose(fixed)[0])
+            i, j = clusterer.index2pdb.index(m1), clusterer.index2pdb.index(m2)
+            self.assertEqual(clusterer.distance_matrix[i, j], rmsd)
+            self.assertEqual(clusterer.distance_matrix[j, i], rmsd)
+
     @unittest.skipUnless(test_funcs.found_exe("gesamt" + ample_util.EXE_EXT), "gesamt exec missing")
     def test_gesamt_matrix_generic(self):
         # Test we can reproduce the original thresholds
@@ -51,23 +73,37 @@ class Test_1(unittest.TestCase):
 
         self.assertIsNotNone(qscore, "No q-score found")
         # read score matrix
-        matrix = []
-        with open(subcluster.SCORE_MATRIX_NAME) as f:
-            for l in f.readlines():
-                if not l.strip():
-                    continue
-                fields = l.split()
-                matrix.append((int(fields[0]), int(fields[1]), float(fields[2])))
-        # Make sure the score matches
-        for l in matrix:
-            if l[0] == index1 and l[1] == index2:
-                # Gesamt log and out file formats have different precisions
-                self.assertAlmostEqual(l[2], qscore, 3, "Q-scores differ: {0} - {1}".format(l[2], qscore))
+        matrix, models = distance_matrix.read(subcluster.MATRIX_NAME)
+        self.assertEqual(models, pdb_list)
+        # Make sure the score matches - gesamt log and out file formats have different precisions
+        score = matrix[index1, index2]
+        self.assertAlmostEqual(score, qscore, 3, "Q-scores differ: {0} - {1}".format(score, qscore))
+        # The hits are read straight from the scratch directories of the searches
+        self.assertEqual(glob.glob('*_gesamt.out'), [])
         os.unlink(logfile)
-        os.unlink(subcluster.SCORE_MATRIX_NAME)
+        os.unlink(subcluster.MATRIX_NAME)
         os.unlink(subcluster.FILE_LIST_NAME)
         return
 
+    @unittest.skipUnless(test_funcs.found_exe("gesamt" + ample_util.EXE_EXT), "gesamt exec missing")
+    def test_gesamt_archive_reused(self):
+        gesamt_exe = ample_util.find_exe("gesamt" + ample_util.EXE_EXT)
+        clusterer = subcluster.GesamtClusterer(executable=gesamt_exe, nproc=2)
+        pdb_list = sorted(glob.glob(os.path.join(self.testfiles_dir, "models", '*.pdb')))
+        clusterer._generate_distance_matrix_generic(pdb_list, purge=False, purge_all=True)
+        matrix = clusterer.distance_matrix
+        clusterer._generate_distance_matrix_generic(pdb_list, purge=True, purge_all=True)
+        self.assertFalse(os.path.isfile('gesamt_archive.log'))
+        self.assertTrue(numpy.array_equal(matrix, clusterer.distance_matrix))
+        self.assertFalse(os.path.exists('gesamt.archive'))
+        for f in glob.glob('*_gesamt.log') + [subcluster.MATRIX_NAME, subcluster.FILE_LIST_NAME]:
+            os.unlink(f)
+
+    def test_split_threads(self):
+        self.assertEqual(subcluster.split_threads(8, 3), (3, 2))
+        self.assertEqual(subcluster.split_threads(4, 30), (4, 1))
+        self.assertEqual(subcluster.split_threads(1, 5), (1, 1))
+
     @unittest.skipUnless(test_funcs.found_exe("gesamt" + ample_util.EXE_EXT), "gesamt exec missing")
     def test_gesamt_radius(self):
         # Test we can reproduce the original thresholds
@@ -98,15 +134,73 @@ class Test_1(unittest.TestCase):
         self.assertEqual(0, len(ref - cluster_files1))
         return
 
+    def test_radius_kabsch(self):
+        clusterer = subcluster.KabschClusterer()
+        pdb_list = glob.glob(os.path.join(self.testfiles_dir, "models", '*.pdb'))
+        clusterer.generate_distance_matrix(pdb_list)
+        self.assertEqual(clusterer.index2pdb, sorted(pdb_list))
+        self.assertEqual(clusterer.distance_matrix.shape, (len(pdb_list), len(pdb_list)))
+        matrix = clusterer.distance_matrix.to_square()
+        self.assertTrue((matrix == matrix.T).all())
+        self.assertTrue(len(clusterer.cluster_by_radius(8)) > 1)
+
+    def test_kabsch_coordinates(self):
+        # The matrix from cached coordinates must match the one from the files whatever order the models are in
+        pdb_list = glob.glob(os.path.join(self.testfiles_dir, "models", '*.pdb'))
+        clusterer = subcluster.KabschClusterer()
+        clusterer.generate_distance_matrix(pdb_list)
+        cached = subcluster.KabschClusterer()
+        cached.generate_distance_matrix(pdb_list, coords=rmsd_util.residue_coordinates(pdb_list))
+        self.assertEqual(cached.index2pdb, clusterer.index2pdb)
+        self.assertTrue(numpy.allclose(cached.distance_matrix, clusterer.distance_matrix))
+
+    def test_cluster_by_nmodels(self):
+        clusterer = subcluster.KabschClusterer()
+        pdb_list = glob.glob(os.path.join(self.testfiles_dir, "models", '*.pdb'))
+        clusterer.generate_distance_matrix(pdb_list)
+        for nmodels in (2, 5, 10, 20):
+            cluster, radius = clusterer.cluster_by_nmodels(nmodels)
+            self.assertGreaterEqual(len(cluster), nmodels)
+            self.assertEqual(round(radius, subcluster.RADIUS_DECIMALS), radius)
+            # Any smaller radius gives fewer models
+            smaller = clusterer.cluster_by_radius(radius - 10 ** -subcluster.RADIUS_DECIMALS)
+            self.assertLess(len(smaller or []), nmodels)
+
+    def test_kabsch_cutoff(self):
+        # Skipping the pairs that can't be under the cutoff mustn't change any of the clusters
+        pdb_list = glob.glob(os.path.join(self.testfiles_dir, "models", '*.pdb'))
+        clusterer = subcluster.KabschClusterer()
+        clusterer.generate_distance_matrix(pdb_list)
+        pruned = subcluster.KabschClusterer(cutoff=3.0)
+        pruned.generate_distance_matrix(pdb_list)
+        for radius in (1.0, 2.0, 3.0):
+            self.assertEqual(pruned.cluster_by_radius(radius), clusterer.cluster_by_radius(radius))
+            self.assertAlmostEqual(pruned.cluster_score, clusterer.cluster_score, 6)
+        self.assertEqual(pruned.cutoff, 3.0)
+        self.assertEqual(pruned.cluster_by_nmodels(5), clusterer.cluster_by_nmodels(5))
+        # A larger radius needs the RMSDs that were skipped
+        self.assertEqual(pruned.cluster_by_nmodels(25), clusterer.cluster_by_nmodels(25))
+        self.assertIsNone(pruned.cutoff)
+        self.assertTrue(numpy.allclose(pruned.distance_matrix, clusterer.distance_matrix))
+
     def test_radius_lsqkab(self):
         # Test we can reproduce the original thresholds
-        clusterer = subcluster.LsqkabClusterer()
+        clusterer = subcluster.LsqkabClusterer(nproc=2)
         pdb_list = glob.glob(os.path.join(self.testfiles_dir, "models", '*.pdb'))
         clusterer.generate_distance_matrix(pdb_list)
+        # Each pair is run in its own scratch directory
+        self.assertFalse(os.path.exists('RMSTAB'))
         clusterer.dump_pdb_matrix('lsqkab.matrix')
         os.unlink('lsqkab.matrix')
         return
 
+    def test_parse_lsqkab_rmsd(self):
+        output = """
+          RMS     XYZ DISPLACEMENT =    1.234
+"""
+        self.assertEqual(subcluster.LsqkabClusterer.parse_lsqkab_rmsd(output), 1.234)
+        self.assertRaises(RuntimeError, subcluster.LsqkabClusterer.parse_lsqkab_rmsd, "No rmsd\n")
+
 
 @unittest.skipUnless(
     test_funcs.found_exe("fast_protein_cluster" + ample_util.EXE_EXT), "fast_protein_cluster exec missing"
@@ -14,9 +14,11 @@ from ample.ensembler.constants import UNMODIFIED
 from ample.util import ample_util
 from ample.util import argparse_util
 from ample.util import benchmark_util
+from ample.util import broker
 from ample.util import config_util
 from ample.util import contact_util
 from ample.util import exit_util
+from ample.util import ledger_util
 from ample.util import logging_util
 from ample.util import mrbump_util
 from ample.util import options_processor
@@ -24,6 +26,7 @@ from ample.util import pdb_edit
 from ample.util import process_models
 from ample.util import pyrvapi_results
 from ample.util import reference_manager
+from ample.util import telemetry_util
 from ample.util import workers_util
 from ample.util import version
 
@@ -62,6 +65,7 @@ class Ample(object):
         self.setup_workdir(argso)
         global logger
         logger = logging_util.setup_logging(argso)
+        telemetry_util.enable(os.path.join(argso['work_dir'], telemetry_util.TELEMETRY_FILE))
 
         # Logging and work directories in place so can start work
         self.amopt = amopt = config_util.AMPLEConfigOptions()
@@ -99,17 +103,20 @@ class Ample(object):
 
         # Modelling business happens here
         if self.modelling_required(amopt.d):
+            telemetry_util.set_stage('modelling')
             self.modelling(amopt.d, rosetta_modeller)
             ample_util.save_amoptd(amopt.d)
             amopt.write_config_file()
 
         # Ensembling business next
         if amopt.d['make_ensembles']:
+            telemetry_util.set_stage('ensembling')
             self.ensembling(amopt.d)
             amopt.write_config_file()
 
         # Some MR here
         if amopt.d['do_mr']:
+            telemetry_util.set_stage('molecular_replacement')
             self.molecular_replacement(amopt.d)
             amopt.write_config_file()
 
@@ -124,9 +131,17 @@ class Ample(object):
 
         # Benchmark mode
         if amopt.d['benchmark_mode']:
+            telemetry_util.set_stage('benchmarking')
             self.benchmarking(amopt.d)
             amopt.write_config_file()
 
+        # All jobs have run so we can stop the local and any remote workers
+        workers_util.shutdown_pool()
+        broker.shutdown_broker()
+        telemetry_summary = telemetry_util.summary()
+        if telemetry_summary:
+            logger.info(telemetry_summary)
+
         amopt.write_config_file()
         # Flag to show that we reached the end without error - useful for integration testing
         amopt.d['AMPLE_finished'] = True
@@ -253,12 +268,11 @@ class Ample(object):
                 # Pickle dictionary so it can be opened by the job to get the parameters
                 ample_util.save_amoptd(optd)
                 script = ensembler.cluster_script(optd)
-                ensembler_timeout = ensembler.get_ensembler_timeout(optd)
                 workers_util.run_scripts(
                     job_scripts=[script],
                     monitor=monitor,
                     nproc=optd['nproc'],
-                    job_time=ensembler_timeout,
+                    job_time=optd['ensembler_timeout'],
                     job_name='ensemble',
                     submit_cluster=optd['submit_cluster'],
                     submit_qtype=optd['submit_qtype'],
@@ -394,6 +408,9 @@ class Ample(object):
         # Save results here so that we have the list of scripts and mrbump directory set
         ample_util.save_amoptd(optd)
 
+        # Run the ensembles most likely to succeed first, reordering as results come in
+        prioritiser = mrbump_util.MrBumpPrioritiser(optd['mrbump_scripts'], optd['ensembles_data'])
+
         # Change to mrbump directory before running
         os.chdir(optd['mrbump_dir'])
         ok = workers_util.run_scripts(
@@ -401,6 +418,7 @@ class Ample(object):
             monitor=monitor,
             check_success=mrbump_util.checkSuccess,
             early_terminate=optd['early_terminate'],
+            early_terminate_kill=optd['early_terminate_kill'],
             nproc=optd['nproc'],
             job_time=mrbump_util.MRBUMP_RUNTIME,
             job_name='mrbump',
@@ -411,6 +429,10 @@ class Ample(object):
             submit_pe_sge=optd['submit_pe_sge'],
             submit_array=optd['submit_array'],
             submit_max_array=optd['submit_max_array'],
+            submit_broker=optd['submit_broker'],
+            prioritiser=prioritiser,
+            job_cores=mrbump_util.MRBUMP_JOB_CORES,
+            job_memory=optd['job_memory'],
         )
 
         if not ok:
@@ -467,12 +489,26 @@ class Ample(object):
         optd = options_processor.process_restart_options(optd)
         if not optd['restart_pkl']:
             options_processor.process_options(optd)
+        if not optd.get('job_ledger'):
+            optd['job_ledger'] = os.path.join(optd['work_dir'], ledger_util.LEDGER_FILE)
+        ledger_util.enable(optd['job_ledger'])
+        try:
+            ample_util.set_tool_timeouts(optd['tool_timeouts'])
+        except RuntimeError as e:
+            exit_util.exit_error(str(e))
         if optd['dry_run']:
             logger.info('Dry run finished checking options - cleaning up...')
             os.chdir(optd['run_dir'])
             shutil.rmtree(optd['work_dir'])
             sys.exit(0)
         logger.info('All needed programs are found, continuing...')
+        if optd['submit_broker']:
+            # Start the broker now so that workers can connect while we get everything ready
+            authkey_file = os.path.join(optd['work_dir'], broker.AUTHKEY_FILE)
+            try:
+                broker.get_broker(optd['submit_broker'], nproc=optd['nproc'], authkey_file=authkey_file)
+            except (IOError, OSError) as e:
+                exit_util.exit_error("Cannot start job broker on {0}: {1}".format(optd['submit_broker'], e))
         return optd
 
     def setup_workdir(self, argso):
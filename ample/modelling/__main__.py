@@ -66,11 +66,13 @@ rm.multimer_modelling = args.multimer_modelling
 rm.nchains = args.nchains
 
 rm.nproc = args.nproc
+rm.job_memory = args.job_memory
 rm.submit_cluster = args.submit_cluster
 rm.submit_qtype = args.submit_qtype
 rm.submit_queue = args.submit_queue
 rm.submit_array = args.submit_array
 rm.submit_max_array = args.submit_max_array
+rm.submit_broker = args.submit_broker
 
 logger.info("Running binary {} with flagsfile: {}".format(args.rosetta_executable, args.rosetta_flagsfile))
 if args.multimer_modelling:
@@ -19,6 +19,9 @@ from ample.util import ample_util, pdb_edit, sequence_util, workers_util
 
 logger = logging.getLogger(__name__)
 
+# Resources used by each Rosetta modelling job - Rosetta is single-threaded
+ROSETTA_JOB_CORES = 1
+
 
 def align_mafft(query_seq, template_seq, logger, mafft_exe=None):
     if not mafft_exe:
@@ -124,6 +127,7 @@ class RosettaModel(object):
 
         self.debug = None
         self.nproc = None
+        self.job_memory = None
         self.nmodels = None
         self.work_dir = None  # Where the modelling happens - can be deleted on exit
         self.ample_dir = None
@@ -960,6 +964,9 @@ class RosettaModel(object):
             submit_queue=self.submit_queue,
             submit_array=self.submit_array,
             submit_max_array=self.submit_max_array,
+            submit_broker=self.submit_broker,
+            job_cores=ROSETTA_JOB_CORES,
+            job_memory=self.job_memory,
         )
 
     def setup_domain_restraints(self):
@@ -1049,11 +1056,13 @@ class RosettaModel(object):
 
         # Runtime options
         self.nproc = optd['nproc']
+        self.job_memory = optd['job_memory']
         self.submit_cluster = optd['submit_cluster']
         self.submit_qtype = optd['submit_qtype']
         self.submit_queue = optd['submit_queue']
         self.submit_array = optd['submit_array']
         self.submit_max_array = optd['submit_max_array']
+        self.submit_broker = optd['submit_broker']
 
         if optd['transmembrane_old']:
             self.transmembrane_old = True
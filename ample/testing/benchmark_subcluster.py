@@ -0,0 +1,112 @@
+"""Time how the subclusterers scale with the number of models
+
+The models are made by randomly rotating, translating and perturbing the decoys in
+testfiles/models, so any number of them can be generated. To run::
+
+    ccp4-python -m ample.testing.benchmark_subcluster -programs cctbx kabsch -sizes 50 100 250 500 1000 -nproc 4
+
+"""
+
+__author__ = "Jens Thomas"
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+from ample import constants
+from ample.ensembler import subcluster
+from ample.util import ample_util, printTable
+
+PROGRAMS = ('cctbx', 'gesamt', 'kabsch', 'lsqkab')
+SIZES = (50, 100, 250, 500, 1000)
+NOISE = 0.5  # Standard deviation in Angstroms of the random shifts added to each atom
+
+
+def make_models(directory, num_models, seed=1):
+    """Write num_models perturbed copies of the test decoys to directory and return their paths"""
+    rng = numpy.random.RandomState(seed)
+    templates = []
+    for pdb in sorted(glob.glob(os.path.join(constants.SHARE_DIR, 'testfiles', 'models', '*.pdb'))):
+        with open(pdb) as f:
+            lines = [l.rstrip('\n') for l in f if l.startswith('ATOM')]
+        coords = numpy.array([[float(l[30:38]), float(l[38:46]), float(l[46:54])] for l in lines])
+        templates.append((lines, coords))
+    pdbs = []
+    for i in range(num_models):
+        lines, coords = templates[i % len(templates)]
+        q, r = numpy.linalg.qr(rng.normal(size=(3, 3)))
+        rotation = q * numpy.sign(numpy.diag(r))
+        xyz = coords.dot(rotation) + rng.normal(scale=20.0, size=3) + rng.normal(scale=NOISE, size=coords.shape)
+        pdb = os.path.join(directory, "model_{0:04d}.pdb".format(i))
+        with open(pdb, 'w') as f:
+            for l, (x, y, z) in zip(lines, xyz):
+                f.write("{0}{1:8.3f}{2:8.3f}{3:8.3f}{4}\n".format(l[:30], x, y, z, l[54:]))
+            f.write("END\n")
+        pdbs.append(pdb)
+    return pdbs
+
+
+def clusterer_factory(program, nproc=1):
+    if program == 'cctbx':
+        return subcluster.CctbxClusterer(nproc=nproc)
+    elif program == 'gesamt':
+        return subcluster.GesamtClusterer(ample_util.find_exe('gesamt' + ample_util.EXE_EXT), nproc=nproc)
+    elif program == 'kabsch':
+        return subcluster.KabschClusterer(nproc=nproc)
+    elif program == 'lsqkab':
+        return subcluster.LsqkabClusterer(ample_util.find_exe('lsqkab' + ample_util.EXE_EXT), nproc=nproc)
+    raise RuntimeError("Unrecognised subcluster program: {0}".format(program))
+
+
+def benchmark(programs, sizes, nproc=1, work_dir=None):
+    """Return a list of (program, number of models, seconds) for generating the distance matrix of each size"""
+    work_dir = tempfile.mkdtemp(prefix='benchmark_subcluster_', dir=work_dir)
+    owd = os.getcwd()
+    results = []
+    try:
+        for size in sizes:
+            models_dir = os.path.join(work_dir, "models_{0}".format(size))
+            os.mkdir(models_dir)
+            pdbs = make_models(models_dir, size)
+            for program in programs:
+                run_dir = os.path.join(work_dir, "{0}_{1}".format(program, size))
+                os.mkdir(run_dir)
+                os.chdir(run_dir)
+                clusterer = clusterer_factory(program, nproc=nproc)
+                start = time.time()
+                clusterer.generate_distance_matrix(pdbs)
+                results.append((program, size, time.time() - start))
+                os.chdir(owd)
+                sys.stdout.write("{0} {1} models: {2:.2f}s\n".format(program, size, results[-1][2]))
+                sys.stdout.flush()
+    finally:
+        os.chdir(owd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark_subcluster', description=__doc__.split('\n')[0])
+    parser.add_argument('-programs', nargs='+', choices=PROGRAMS, default=['cctbx', 'kabsch'])
+    parser.add_argument('-sizes', nargs='+', type=int, default=list(SIZES), help="The numbers of models to cluster")
+    parser.add_argument('-nproc', type=int, default=1, help="The number of processors to use")
+    parser.add_argument('-work_dir', help="Directory to write the models to [default: the system temporary directory]")
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.programs, args.sizes, nproc=args.nproc, work_dir=args.work_dir)
+    table = [['Program', 'Models', 'Pairs', 'Time (s)', 'Pairs/s']]
+    for program, size, seconds in results:
+        pairs = size * (size - 1) // 2
+        table.append([program, str(size), str(pairs), "{0:.2f}".format(seconds), "{0:.0f}".format(pairs / seconds)])
+    sys.stdout.write("\n" + printTable.Table().pprint_table(table) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""A local stand-in for the SGE and LSF commands used by :mod:`ample.util.clusterize`
+
+This provides minimal versions of qsub, qstat, bsub and bjobs that run the
+submitted jobs in the background on the local machine, so that the cluster
+code paths can be tested, and loaded with many jobs, on a single Linux box
+without a queueing system.
+
+Only the queue directives AMPLE writes are understood: the job name, the log
+file and the range and maximum number of concurrent tasks of array jobs. The
+tasks of a job are run with at most AMPLE_FAKE_SCHEDULER_NPROC (by default the
+number of processors) running at the same time.
+
+The commands are installed with :func:`install` and then used by putting the
+directory it returns at the front of the PATH::
+
+    bin_dir = fake_scheduler.install(directory)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+The state of the jobs is kept in a spool directory, given by the
+AMPLE_FAKE_SCHEDULER_DIR environment variable.
+"""
+
+__author__ = "Jens Thomas"
+
+import getpass
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+COMMANDS = ('qsub', 'qstat', 'bsub', 'bjobs')
+NPROC_ENV = 'AMPLE_FAKE_SCHEDULER_NPROC'
+SPOOL_ENV = 'AMPLE_FAKE_SCHEDULER_DIR'
+QUEUE = 'fake.q'
+POLL_INTERVAL = 0.1
+
+WRAPPER = """#!/bin/sh
+export PYTHONPATH="{root}${{PYTHONPATH:+:$PYTHONPATH}}"
+export {spool_env}="${{{spool_env}:-{spool}}}"
+exec "{python}" -m ample.testing.fake_scheduler {command} "$@"
+"""
+
+
+def install(directory):
+    """Write the fake scheduler commands to directory/bin and return the path to it"""
+    bin_dir = os.path.join(directory, 'bin')
+    spool = os.path.join(directory, 'spool')
+    for d in (bin_dir, spool):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for command in COMMANDS:
+        path = os.path.join(bin_dir, command)
+        with open(path, 'w') as f:
+            f.write(WRAPPER.format(root=root, spool_env=SPOOL_ENV, spool=spool, python=sys.executable, command=command))
+        os.chmod(path, 0o755)
+    return bin_dir
+
+
+def spool_dir():
+    return os.environ[SPOOL_ENV]
+
+
+def _job_file(job_id, finished=False):
+    return os.path.join(spool_dir(), "{0}.{1}".format(job_id, 'finished' if finished else 'job'))
+
+
+def _next_job_id():
+    """Return a new job id, using a lock directory so that concurrent submissions get unique ids"""
+    lock = os.path.join(spool_dir(), 'lock')
+    while True:
+        try:
+            os.mkdir(lock)
+            break
+        except OSError:
+            time.sleep(0.01)
+    try:
+        counter = os.path.join(spool_dir(), 'next_id')
+        job_id = 1
+        if os.path.isfile(counter):
+            with open(counter) as f:
+                job_id = int(f.read())
+        with open(counter, 'w') as f:
+            f.write(str(job_id + 1))
+    finally:
+        os.rmdir(lock)
+    return job_id
+
+
+def _directives(text, prefix):
+    """Return a list of the arguments of each line of text starting with prefix"""
+    directives = []
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            directives.append(line[len(prefix) :].split())
+    return directives
+
+
+def parse_sge(text):
+    job = {'name': None, 'log': None, 'tasks': None, 'max_running': None}
+    for d in _directives(text, '#$'):
+        if d[0] == '-N':
+            job['name'] = d[1]
+        elif d[0] == '-o':
+            job['log'] = d[1]
+        elif d[0] == '-t':
+            start, end = d[1].split('-')
+            job['tasks'] = [int(start), int(end)]
+        elif d[0] == '-tc':
+            job['max_running'] = int(d[1])
+    return job
+
+
+def parse_lsf(text):
+    job = {'name': None, 'log': None, 'tasks': None, 'max_running': None}
+    for d in _directives(text, '#BSUB'):
+        if d[0] == '-J':
+            m = re.match(r"([^\[]+)(?:\[(\d+)-(\d+)\](?:%(\d+))?)?$", d[1])
+            job['name'] = m.group(1)
+            if m.group(2):
+                job['tasks'] = [int(m.group(2)), int(m.group(3))]
+            if m.group(4):
+                job['max_running'] = int(m.group(4))
+        elif d[0] == '-o':
+            job['log'] = d[1]
+    return job
+
+
+def submit(qtype, script, text):
+    """Record a job and start running it in the background
+
+    Returns
+    -------
+    tuple
+       The job id and the job dictionary
+    """
+    job = parse_sge(text) if qtype == 'SGE' else parse_lsf(text)
+    job_id = _next_job_id()
+    spooled = os.path.join(spool_dir(), "{0}.sh".format(job_id))
+    with open(spooled, 'w') as f:
+        f.write(text)
+    os.chmod(spooled, 0o755)
+    job.update(
+        {
+            'id': job_id,
+            'qtype': qtype,
+            'script': spooled,
+            'name': job['name'] or os.path.basename(script),
+            'cwd': os.getcwd(),
+            'user': getpass.getuser(),
+            'submitted': time.time(),
+        }
+    )
+    with open(_job_file(job_id), 'w') as f:
+        json.dump(job, f)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-m', 'ample.testing.fake_scheduler', '_run', str(job_id)],
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            preexec_fn=os.setsid,
+        )
+    return job_id, job
+
+
+def _log_path(job, task):
+    log = job['log']
+    if not log:
+        if job['qtype'] == 'LSF':
+            return os.devnull
+        log = "{0}.o{1}".format(job['name'], job['id'])
+    if job['qtype'] == 'SGE':
+        log = log.replace('$TASK_ID', str(task)).replace('$JOB_ID', str(job['id']))
+    else:
+        log = log.replace('%I', str(task)).replace('%J', str(job['id']))
+    return os.path.join(job['cwd'], log)
+
+
+def run_job(job_id):
+    """Run all the tasks of a job and then mark it as finished"""
+    with open(_job_file(job_id)) as f:
+        job = json.load(f)
+    nproc = job['max_running'] or int(os.environ.get(NPROC_ENV, 0)) or multiprocessing.cpu_count()
+    tasks = list(range(job['tasks'][0], job['tasks'][1] + 1)) if job['tasks'] else [None]
+    running = []
+    while tasks or running:
+        while tasks and len(running) < nproc:
+            task = tasks.pop(0)
+            env = dict(os.environ)
+            if job['qtype'] == 'SGE':
+                env.update({'JOB_ID': str(job_id), 'SGE_TASK_ID': str(task or 'undefined')})
+            else:
+                env.update({'LSB_JOBID': str(job_id), 'LSB_JOBINDEX': str(task or 0)})
+            with open(_log_path(job, task), 'w') as log:
+                running.append(
+                    subprocess.Popen(
+                        [job['script']], cwd=job['cwd'], env=env, stdout=log, stderr=subprocess.STDOUT
+                    )
+                )
+        time.sleep(POLL_INTERVAL)
+        running = [p for p in running if p.poll() is None]
+    shutil.move(_job_file(job_id), _job_file(job_id, finished=True))
+
+
+def _jobs(finished=False):
+    jobs = []
+    ext = '.finished' if finished else '.job'
+    for name in os.listdir(spool_dir()):
+        if name.endswith(ext):
+            try:
+                with open(os.path.join(spool_dir(), name)) as f:
+                    jobs.append(json.load(f))
+            except (IOError, ValueError):
+                # The job finished while we were reading it
+                pass
+    return sorted(jobs, key=lambda j: j['id'])
+
+
+def _options(args):
+    """Split args into a dictionary of options and a list of the remaining arguments"""
+    options, rest = {}, []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '-V':
+            continue
+        if arg.startswith('-'):
+            options[arg] = args.pop(0)
+        else:
+            rest.append(arg)
+    return options, rest
+
+
+def qsub(args):
+    _, rest = _options(args)
+    script = rest[0]
+    with open(script) as f:
+        job_id, job = submit('SGE', script, f.read())
+    if job['tasks']:
+        start, end = job['tasks']
+        print('Your job-array {0}.{1}-{2}:1 ("{3}") has been submitted'.format(job_id, start, end, job['name']))
+    else:
+        print('Your job {0} ("{1}") has been submitted'.format(job_id, job['name']))
+    return 0
+
+
+def qstat(args):
+    options, _ = _options(args)
+    if '-j' in options:
+        return qstat_jobs(options['-j'].split(','))
+    jobs = [j for j in _jobs() if '-u' not in options or j['user'] == options['-u']]
+    if not jobs:
+        return 0
+    print("job-ID  prior   name       user         state submit/start at     queue          slots ja-task-ID")
+    print("-" * 92)
+    for j in jobs:
+        submitted = time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(j['submitted']))
+        print(
+            "{0:>7} 0.50000 {1:<10} {2:<12} r     {3} {4:<14} 1".format(
+                j['id'], j['name'][:10], j['user'][:12], submitted, QUEUE
+            )
+        )
+    return 0
+
+
+def qstat_jobs(ids):
+    """Print the details of the jobs in ids as qstat -j does, with a job_number line for each"""
+    running = dict((str(j['id']), j) for j in _jobs())
+    for job_id in ids:
+        if job_id in running:
+            print("=" * 62)
+            print("job_number:                 {0}".format(job_id))
+            print("owner:                      {0}".format(running[job_id]['user']))
+            print("job_name:                   {0}".format(running[job_id]['name']))
+    missing = [job_id for job_id in ids if job_id not in running]
+    if missing:
+        sys.stderr.write("Following jobs do not exist: \n{0}\n".format(", ".join(missing)))
+        return 1
+    return 0
+
+
+def bsub(args):
+    job_id, job = submit('LSF', 'stdin', sys.stdin.read())
+    print("Job <{0}> is submitted to queue <{1}>.".format(job_id, QUEUE))
+    return 0
+
+
+def bjobs(args):
+    options, ids = _options(args)
+    running = _jobs()
+    if ids:
+        finished = dict((str(j['id']), j) for j in _jobs(finished=True))
+        running = dict((str(j['id']), j) for j in running)
+        jobs = []
+        for job_id in ids:
+            if job_id in running:
+                jobs.append((running[job_id], 'RUN'))
+            elif job_id in finished:
+                jobs.append((finished[job_id], 'DONE'))
+            else:
+                sys.stderr.write("Job <{0}> is not found\n".format(job_id))
+    else:
+        jobs = [(j, 'RUN') for j in running if '-u' not in options or j['user'] == options['-u']]
+    if not jobs:
+        if not ids:
+            sys.stderr.write("No unfinished job found\n")
+        return 0
+    print("JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME")
+    for j, stat in jobs:
+        submitted = time.strftime("%b %d %H:%M", time.localtime(j['submitted']))
+        tasks = range(j['tasks'][0], j['tasks'][1] + 1) if j['tasks'] else [None]
+        for task in tasks:
+            job_id = "{0}[{1}]".format(j['id'], task) if task else str(j['id'])
+            print(
+                "{0:<7} {1:<7} {2:<5} {3:<10} localhost   localhost   {4:<10} {5}".format(
+                    job_id, j['user'][:7], stat, QUEUE, j['name'][:10], submitted
+                )
+            )
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command, args = argv[0], argv[1:]
+    if command == '_run':
+        run_job(int(args[0]))
+        return 0
+    return {'qsub': qsub, 'qstat': qstat, 'bsub': bsub, 'bjobs': bjobs}[command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
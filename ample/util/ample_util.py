@@ -4,17 +4,24 @@ __date__ = "01 Jan 2016"
 __version__ = "1.0"
 
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import collections
+import multiprocessing
 import pickle
 import logging
 import os
+import shutil
+import signal
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import warnings
 import zipfile
 
-from ample.util import ccp4, exit_util
+from ample.util import ccp4, exit_util, telemetry_util
 
 from ample.constants import SHARE_DIR, AMPLEDIR, I2DIR
 
@@ -23,6 +30,27 @@ SCRIPT_EXT = '.bat' if sys.platform.startswith('win') else '.sh'
 EXE_EXT = '.exe' if sys.platform.startswith('win') else ''
 SCRIPT_HEADER = '' if sys.platform.startswith('win') else '#!/bin/bash'
 
+# Seconds after which run_command kills a program, keyed by the program name - see set_tool_timeouts
+TOOL_TIMEOUTS = {}
+KILL_GRACE = 10  # Seconds a timed-out command has to exit after SIGTERM before it is sent SIGKILL
+
+# The result of a command run with run_commands
+CommandResult = collections.namedtuple('CommandResult', ['returncode', 'output', 'directory', 'timed_out'])
+
+
+class CommandTimeoutError(RuntimeError):
+    """Raised when run_command kills a command for running for longer than its timeout"""
+
+    def __init__(self, cmd, timeout, returncode=None, logfile=None):
+        msg = "Command killed after {0} seconds: {1}".format(timeout, " ".join(cmd))
+        if logfile:
+            msg += "\nCheck log: {0}".format(logfile)
+        super(CommandTimeoutError, self).__init__(msg)
+        self.cmd = cmd
+        self.timeout = timeout
+        self.returncode = returncode
+        self.logfile = logfile
+
 
 class FileNotFoundError(Exception):
     pass
@@ -371,7 +399,9 @@ def make_workdir(run_dir, ccp4i2=False, MAX_WORKDIRS=100):
     return work_dir
 
 
-def run_command(cmd, logfile=None, directory=None, dolog=True, stdin=None, check=False, **kwargs):
+def run_command(
+    cmd, logfile=None, directory=None, dolog=True, stdin=None, check=False, on_start=None, timeout=None, **kwargs
+):
     """Execute a command and return the exit code.
 
     Parameters
@@ -386,15 +416,26 @@ def run_command(cmd, logfile=None, directory=None, dolog=True, stdin=None, check
        The directory to run the job in (cwd assumed)
     dolog : bool, optional
        Whether to output info to the system log [default: False]
+    on_start : callable, optional
+       Called with the :obj:`subprocess.Popen` object as soon as the command has started
+    timeout : int, optional
+       Seconds after which the command and everything it started are killed [default: the
+       entry for the program in TOOL_TIMEOUTS, otherwise no timeout]
 
     Returns
     -------
     returncode : int
        Subprocess exit code
 
+    Raises
+    ------
+    :exc:`CommandTimeoutError`
+       The command was killed as it ran for longer than the timeout
+
     Notes
     -----
-    We take care of outputting stuff to the logs and opening/closing logfiles
+    We take care of outputting stuff to the logs and opening/closing logfiles. The resources
+    used by the command are recorded with :mod:`ample.util.telemetry_util`.
 
     """
     assert type(cmd) is list, "run_command needs a list!"
@@ -432,17 +473,196 @@ def run_command(cmd, logfile=None, directory=None, dolog=True, stdin=None, check
     # Windows needs some special treatment
     if os.name == "nt":
         kwargs.update({'bufsize': 0, 'shell': "False"})
+    if timeout is None:
+        timeout = tool_timeout(cmd)
+    if timeout and hasattr(os, 'killpg'):
+        # Run in a new process group so that we can kill everything the command starts
+        kwargs['preexec_fn'] = _new_process_group(kwargs.get('preexec_fn'))
+    start = time.time()
     p = subprocess.Popen(cmd, stdin=stdin, stdout=logf, stderr=subprocess.STDOUT, cwd=directory, **kwargs)
+    if on_start:
+        on_start(p)
+    expired = []
+    timers = []
+    if timeout:
+
+        def expire():
+            expired.append(True)
+            logger.critical("Killing command after %s seconds: %s", timeout, " ".join(cmd))
+            _signal_process_group(p, signal.SIGTERM)
+            kill_timer = threading.Timer(KILL_GRACE, _signal_process_group, args=(p, getattr(signal, 'SIGKILL', None)))
+            kill_timer.daemon = True
+            kill_timer.start()
+            timers.append(kill_timer)
+
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+        timers.append(timer)
 
     if stdin is not None:
         p.stdin.write(stdinstr.encode())
         p.stdin.close()
         if dolog:
             logger.debug("stdin for cmd was: %s", stdinstr)
-    p.wait()
+    returncode, rusage = telemetry_util.wait(p)
+    for timer in list(timers):
+        timer.cancel()
     if not file_handle:
         logf.close()
-    return p.returncode
+    telemetry_util.record(cmd, returncode, start, rusage=rusage, logfile=logf.name, directory=directory)
+    if expired:
+        raise CommandTimeoutError(cmd, timeout, returncode=returncode, logfile=logf.name)
+    return returncode
+
+
+def _new_process_group(preexec_fn=None):
+    """Return a function for Popen's preexec_fn that puts the child in a new process group"""
+
+    def preexec():
+        try:
+            os.setsid()
+        except OSError:
+            # Already a process group leader
+            pass
+        # A second setsid would fail with EPERM as we now lead the group
+        if preexec_fn and preexec_fn is not os.setsid:
+            preexec_fn()
+
+    return preexec
+
+
+def _signal_process_group(process, signum):
+    """Send signum to the process group of process, or just kill the process if we can't"""
+    if process.returncode is not None:
+        return
+    try:
+        if hasattr(os, 'killpg') and signum is not None:
+            os.killpg(process.pid, signum)
+        else:
+            process.kill()
+    except OSError:
+        pass
+
+
+def run_commands(
+    cmds, stdins=None, logfiles=None, directory=None, nproc=None, timeout=None, scratch=True, keep_scratch=False
+):
+    """Run a list of short commands concurrently and capture their output.
+
+    The commands are run from a pool of threads, each of which runs its command with
+    :func:`run_command` and waits for it, so up to nproc commands run at the same time.
+
+    Parameters
+    ----------
+    cmds : list
+       A list of commands, each of which is a list
+    stdins : list, optional
+       A list of stdin strings, one for each command
+    logfiles : list, optional
+       A list of paths to write the output of each command to
+    directory : str, optional
+       The directory to run the commands in (cwd assumed)
+    nproc : int, optional
+       The maximum number of commands to run at once [default: number of processors]
+    timeout : int, optional
+       The number of seconds after which a command is killed
+    scratch : bool, optional
+       Run each command in its own scratch directory within directory, so that programs that write
+       files with fixed names don't overwrite each other's files [default: True]
+    keep_scratch : bool, optional
+       Keep the scratch directories so that the files written by the commands can be read [default: False]
+
+    Returns
+    -------
+    list
+       A :obj:`CommandResult` (returncode, output, directory, timed_out) for each command, in the
+       same order as cmds. directory is the directory the command ran in, or None if it was a scratch
+       directory that has been removed.
+
+    Notes
+    -----
+    With scratch directories any paths in the commands need to be absolute.
+
+    """
+    if not cmds:
+        return []
+    if not directory:
+        directory = os.getcwd()
+    stdins = stdins or [None] * len(cmds)
+    logfiles = logfiles or [None] * len(cmds)
+    nproc = min(nproc or multiprocessing.cpu_count(), len(cmds))
+
+    def run(i):
+        return _run_captured(cmds[i], stdins[i], logfiles[i], directory, timeout, scratch, keep_scratch)
+
+    pool = ThreadPool(nproc)
+    try:
+        return pool.map(run, range(len(cmds)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _run_captured(cmd, stdin, logfile, directory, timeout, scratch, keep_scratch):
+    """Run a single command for run_commands"""
+    if scratch:
+        directory = tempfile.mkdtemp(prefix='cmd_', dir=directory)
+    tmplog = None
+    if not logfile:
+        fd, tmplog = tempfile.mkstemp(prefix='cmd_', suffix='.log', dir=directory)
+        os.close(fd)
+        logfile = tmplog
+    timed_out = False
+    try:
+        returncode = run_command(cmd, logfile=logfile, directory=directory, dolog=False, stdin=stdin, timeout=timeout)
+    except CommandTimeoutError as e:
+        returncode = e.returncode
+        timed_out = True
+    with open(logfile) as f:
+        output = f.read()
+    if tmplog:
+        os.unlink(tmplog)
+    if scratch and not keep_scratch:
+        shutil.rmtree(directory)
+        directory = None
+    return CommandResult(returncode, output, directory, timed_out)
+
+
+def set_tool_timeouts(tool_timeouts):
+    """Set the module-level TOOL_TIMEOUTS used by run_command
+
+    Parameters
+    ----------
+    tool_timeouts : list
+       A list of strings of the form TOOL=SECONDS, where TOOL is the name of the program
+       (e.g. theseus, spicker, shelxe)
+
+    Raises
+    ------
+    RuntimeError
+       A timeout could not be parsed
+
+    """
+    timeouts = {}
+    for entry in tool_timeouts or []:
+        try:
+            tool, seconds = entry.split('=')
+            timeouts[tool.strip()] = int(seconds)
+        except ValueError:
+            raise RuntimeError("Cannot parse tool timeout {0} - should be of the form TOOL=SECONDS".format(entry))
+    if timeouts:
+        logger.debug('Setting tool timeouts to: %s', timeouts)
+    TOOL_TIMEOUTS.clear()
+    TOOL_TIMEOUTS.update(timeouts)
+
+
+def tool_timeout(cmd):
+    """Return the timeout in seconds for the program cmd will run or None if there isn't one"""
+    tool = os.path.basename(cmd[0])
+    if EXE_EXT and tool.endswith(EXE_EXT):
+        tool = tool[: -len(EXE_EXT)]
+    return TOOL_TIMEOUTS.get(tool)
 
 
 def read_amoptd(amoptd_fname):
@@ -47,6 +47,12 @@ def add_core_options(parser=None):
         type=int,
         help="Number of processors [1]. For local, serial runs the jobs will be split across nproc processors. For cluster submission, this should be the number of processors on a node.",
     )
+    parser.add_argument(
+        '-job_memory',
+        type=int,
+        help="Rough estimate of the peak memory in MB of each modelling and MRBUMP job. If set, no more jobs are "
+        "run at the same time than fit in the memory of the machine [not set: jobs are only limited by nproc]",
+    )
     parser.add_argument(
         '-work_dir',
         action=FilePathAction,
@@ -70,6 +76,12 @@ def add_cluster_submit_options(parser=None):
         metavar='True/False',
         help='Submit jobs to a cluster - need to set -submit_qtype flag to specify the batch queue system.',
     )
+    submit_group.add_argument(
+        '-submit_broker',
+        metavar='HOST:PORT',
+        help='Run jobs on workers on other machines that connect to a job broker listening on HOST:PORT, '
+        'started with: ample worker -connect HOST:PORT -authkey_file WORK_DIR/broker.key',
+    )
     submit_group.add_argument(
         '-submit_max_array',
         type=int,
@@ -140,6 +152,13 @@ def add_general_options(parser=None):
         metavar='True/False',
         help='Stop the run as soon as a success has been found.',
     )
+    parser.add_argument(
+        '-early_terminate_kill',
+        action=BoolAction,
+        nargs='?',
+        metavar='True/False',
+        help='With early_terminate, also kill any MR jobs that are still running once a success has been found.',
+    )
     parser.add_argument('-ensembles', help='Path to directory containing existing ensembles')
     parser.add_argument('-fasta', action=FilePathAction, help='protein fasta file. (required)')
     parser.add_argument('-fast_protein_cluster_exe', help='path to fast_protein_cluster executable')
@@ -233,6 +252,12 @@ def add_general_options(parser=None):
         '-sf_cif', action=FilePathAction, help='Path to a structure factor CIF file (instead of MTZ file)'
     )
     parser.add_argument('-SIGF', help='Flag for SIGF column in the MTZ file')
+    parser.add_argument(
+        '-tool_timeouts',
+        nargs='+',
+        metavar='TOOL=SECONDS',
+        help='Kill any run of the program TOOL that takes longer than SECONDS, e.g. -tool_timeouts theseus=3600 spicker=7200',
+    )
     parser.add_argument('-top_model_only', metavar='True/False', help='Only process the top model in each ensemble')
     parser.add_argument('--version', action='version', version='%(prog)s {0}'.format(version.__version__))
     parser.add_argument(
@@ -481,13 +506,23 @@ def add_ensembler_options(parser=None):
     # --------------------------------------------------------------------------------------------- #
     # sphinx-argparse ignores Mock imports and thus cannot find iotbx.pdb when generating the docs. #
     try:
-        from ample.ensembler.constants import ALLOWED_SIDE_CHAIN_TREATMENTS, SPICKER_RMSD, SPICKER_TM
+        from ample.ensembler.constants import (
+            ALLOWED_SIDE_CHAIN_TREATMENTS,
+            KMEDOIDS_RMSD,
+            KMEDOIDS_TM,
+            SPICKER_NUMPY,
+            SPICKER_RMSD,
+            SPICKER_TM,
+        )
         from ample.ensembler.truncation_util import TRUNCATION_METHODS
     except ImportError:
         allowed_side_chain_treatments = ['polyala', 'reliable', 'allatom', 'unmod']
         truncation_methods = ['percent']
         SPICKER_RMSD = 'spicker'
         SPICKER_TM = 'spicker_tm'
+        SPICKER_NUMPY = 'spicker_numpy'
+        KMEDOIDS_RMSD = 'kmedoids'
+        KMEDOIDS_TM = 'kmedoids_tm'
     else:
         allowed_side_chain_treatments = ALLOWED_SIDE_CHAIN_TREATMENTS[:]
         truncation_methods = [t.value for t in TRUNCATION_METHODS]
@@ -499,7 +534,8 @@ def add_ensembler_options(parser=None):
     )
     ensembler_group.add_argument(
         '-cluster_method',
-        help='How to cluster the models for ensembling. Options: ' + '|'.join([SPICKER_RMSD, SPICKER_TM]),
+        help='How to cluster the models for ensembling. Options: '
+        + '|'.join([SPICKER_RMSD, SPICKER_TM, SPICKER_NUMPY, KMEDOIDS_RMSD, KMEDOIDS_TM]),
     )
     ensembler_group.add_argument('-ensembler_timeout', type=int, help='Time in seconds before timing out ensembling')
     ensembler_group.add_argument(
@@ -547,7 +583,10 @@ def add_ensembler_options(parser=None):
         nargs='+',
         help='The radii to use for subclustering the truncated ensembles',
     )
-    ensembler_group.add_argument('-subcluster_program', help='Program for subclustering models [gesamt]')
+    ensembler_group.add_argument(
+        '-subcluster_program',
+        help='Program for subclustering models: gesamt, lsqkab or kabsch (CA RMSDs calculated internally) [gesamt]',
+    )
     ensembler_group.add_argument(
         '-theseus_exe', action=FilePathAction, metavar='Theseus exe', help='Path to theseus executable'
     )
@@ -12,7 +12,18 @@ import pandas as pd
 import shutil
 import sys
 
-from ample.util import ample_util, csymmatch, mtz_util, pdb_edit, pdb_model, reforigin, residue_map, rio, shelxe, tm_util
+from ample.util import (
+    ample_util,
+    csymmatch,
+    mtz_util,
+    pdb_edit,
+    pdb_model,
+    reforigin,
+    residue_map,
+    rio,
+    shelxe,
+    tmscore_util,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -210,16 +221,13 @@ def analyse(amoptd, newroot=None):
         centroid_index = dframe.index
         centroid_models = [fixpath(f) for f in dframe.subcluster_centroid_model]
         native_pdb_std = fixpath(amoptd['native_pdb_std'])
-        fasta = fixpath(amoptd['fasta'])
 
         # Calculation of TMscores for subcluster centroid models
-        if amoptd['have_tmscore']:
-            tm = tm_util.TMscore(amoptd['tmscore_exe'], wdir=fixpath(amoptd['benchmark_dir']), **amoptd)
-            tm_results = tm.compare_structures(centroid_models, [native_pdb_std], [fasta])
-            centroid_tmscores = [r['tmscore'] for r in tm_results]
-            centroid_rmsds = [r['rmsd'] for r in tm_results]
-        else:
-            raise RuntimeError("No program to calculate tmscores!")
+        tm_results = tmscore_util.compare_structures(
+            centroid_models, native_pdb_std, res_seq_map=amoptd.get('res_seq_map'), nproc=amoptd['nproc']
+        )
+        centroid_tmscores = [r['tmscore'] for r in tm_results]
+        centroid_rmsds = [r['rmsd'] for r in tm_results]
 
         dframe['subcluster_centroid_model_TM'] = pd.Series(centroid_tmscores, index=centroid_index)
         dframe['subcluster_centroid_model_RMSD'] = pd.Series(centroid_rmsds, index=centroid_index)
@@ -253,18 +261,15 @@ def analyseModels(amoptd):
         logger.exception("Error calculating resSeqMap: %s" % e)
         amoptd['res_seq_map'] = None  # Won't be able to calculate RIO scores
 
-    if amoptd['have_tmscore']:
-        try:
-            tm = tm_util.TMscore(amoptd['tmscore_exe'], wdir=fixpath(amoptd['benchmark_dir']))
-            # Calculation of TMscores for all models
-            logger.info("Analysing Rosetta models with TMscore")
-            model_list = sorted(glob.glob(os.path.join(amoptd['models_dir'], "*pdb")))
-            structure_list = [amoptd['native_pdb_std']]
-            amoptd['tmComp'] = tm.compare_structures(model_list, structure_list, fastas=[amoptd['fasta']])
-        except Exception as e:
-            logger.exception("Unable to run TMscores: %s", e)
-    else:
-        raise RuntimeError("No program to calculate TMSCORES")
+    try:
+        # Calculation of TMscores for all models
+        logger.info("Analysing Rosetta models with TMscore")
+        model_list = sorted(glob.glob(os.path.join(amoptd['models_dir'], "*pdb")))
+        amoptd['tmComp'] = tmscore_util.compare_structures(
+            model_list, amoptd['native_pdb_std'], res_seq_map=amoptd['res_seq_map'], nproc=amoptd['nproc']
+        )
+    except Exception as e:
+        logger.exception("Unable to calculate TMscores: %s", e)
 
 
 def analysePdb(amoptd):
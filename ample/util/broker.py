@@ -0,0 +1,403 @@
+"""Run job scripts on worker processes on other machines through a broker
+
+AMPLE starts a :obj:`Broker` listening on a TCP address (HOST:PORT) or a Unix
+socket, and worker processes started on any number of machines with::
+
+    ample worker -connect HOST:PORT -authkey_file WORK_DIR/broker.key -nproc 8
+
+connect to it and pull jobs whenever they have free cores, so faster or less
+busy machines simply take more of the work. This allows the MRBUMP and Rosetta
+stages to use several workstations that have no queueing system.
+
+As with a cluster, the job scripts and their directories must be on a filesystem
+that is shared between the machines. Connections are authenticated with a key
+that is written to a file in the AMPLE work directory when the broker starts.
+"""
+
+__author__ = "Jens Thomas"
+
+import argparse
+import binascii
+import heapq
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from multiprocessing.connection import Client, Listener
+
+from ample.util import ledger_util, telemetry_util, worker, workers_util
+
+AUTHKEY_FILE = 'broker.key'
+CONNECT_TIMEOUT = 300  # Seconds a worker keeps trying to connect to a broker that isn't running yet
+POLL_INTERVAL = 0.5  # Seconds between polls of the broker by a worker
+
+logger = logging.getLogger(__name__)
+
+# The broker shared by all stages of a run - see get_broker
+_BROKER = None
+
+
+def parse_address(address):
+    """Return the address to listen on or connect to for a HOST:PORT string or the path to a Unix socket"""
+    if os.sep not in address and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return (host, int(port))
+    return address
+
+
+def new_authkey(path):
+    """Write a new random key to the file path, which only the user can read, and return it"""
+    authkey = binascii.hexlify(os.urandom(16))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    if hasattr(os, 'fchmod'):
+        # The mode is only set by os.open when it creates the file
+        os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    return authkey
+
+
+def read_authkey(path):
+    with open(path, 'rb') as f:
+        return f.read().strip()
+
+
+class Broker(workers_util.WorkerPool):
+    """A :obj:`ample.util.workers_util.WorkerPool` whose jobs are run by remote workers
+
+    Jobs are submitted, reprioritised, waited on and cancelled exactly as with a local
+    pool, but rather than being handed to local processes they wait in the queue until
+    a worker connected to the broker asks for work. Each worker polls the broker with
+    the jobs that have started and finished since its last poll and the number of
+    cores it has free, and is sent as many of the highest priority jobs as will fit.
+    The reply also lists any of its jobs that should be killed. The jobs of a worker
+    whose connection is lost are put back in the queue for another worker, unless
+    they were being killed.
+
+    Parameters
+    ----------
+    address : str or tuple
+       The (host, port) or Unix socket path to listen on
+    authkey : bytes
+       The key workers must use to connect
+    nproc : int, optional
+       The maximum number of cores a single job can use
+
+    """
+
+    def __init__(self, address, authkey, nproc=1):
+        self.address = address
+        self._authkey = authkey
+        super(Broker, self).__init__(nproc)
+        # The memory of the machines the workers run on isn't known
+        self.memory = None
+        logger.info("Job broker listening on: {0}".format(address))
+
+    def _start(self):
+        """Listen for remote workers rather than starting local ones
+
+        The workers are held as a dictionary of the name of each worker to its number of cores.
+        """
+        self._listener = Listener(self.address, authkey=self._authkey)
+        self._thread = threading.Thread(target=self._accept, name='BrokerListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def resize(self, nproc):
+        """Change the maximum number of cores a single job can use"""
+        with self._lock:
+            self.nproc = nproc
+
+    def submit(self, job, priority=0, cores=1, memory=None, args=()):
+        if callable(job):
+            raise RuntimeError("A Broker can only run job scripts: {0}".format(job))
+        return super(Broker, self).submit(job, priority=priority, cores=cores, memory=memory)
+
+    def shutdown(self, wait=True):
+        """Stop handing out jobs and tell the workers to exit
+
+        Any jobs that have not yet started are cancelled. If wait is True we wait
+        for running jobs to finish, otherwise they are killed.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            cancelled = [entry[2] for entry in self._pending]
+            del self._pending[:]
+            running = list(self._running.values())
+        for future in cancelled:
+            future._set_done(workers_util.JobFuture.CANCELLED)
+        if not wait:
+            for future in running:
+                future.kill()
+        with self._lock:
+            while self._running and self._workers:
+                self._lock.wait(POLL_INTERVAL)
+        self._listener.close()
+
+    def _dispatch(self):
+        """Jobs wait in the queue until a worker asks for them"""
+        pass
+
+    @staticmethod
+    def _signal(future, signum):
+        """Jobs are killed by the worker running them when it next polls the broker"""
+        pass
+
+    def _take(self, worker_name, cores, free):
+        """Remove the pending jobs that fit into free cores from the queue - must be called with the lock held"""
+        taken = []
+        for entry in sorted(self._pending):
+            future = entry[2]
+            # A job that needs more cores than the worker has is given to it when it has nothing else to do
+            need = min(future.cores, cores)
+            if need > free:
+                continue
+            free -= need
+            future.worker = worker_name
+            self._running[future.job_id] = future
+            self._cores_used += future.cores
+            taken.append(future)
+        if taken:
+            ids = set(f.job_id for f in taken)
+            self._pending = [entry for entry in self._pending if entry[1] not in ids]
+            heapq.heapify(self._pending)
+        return taken
+
+    def _accept(self):
+        """Thread that accepts connections from workers"""
+        while not self.closed:
+            try:
+                conn = self._listener.accept()
+            except multiprocessing.AuthenticationError as e:
+                logger.warning("Rejected connection to job broker: {0}".format(e))
+                continue
+            except (IOError, OSError, EOFError):
+                # The listener has been closed
+                break
+            thread = threading.Thread(target=self._serve, args=(conn,), name='BrokerConnection')
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        """Thread that answers the polls of a single worker"""
+        worker_name = None
+        jobs = set()
+        try:
+            while True:
+                _, worker_name, cores, free, started, finished = conn.recv()
+                done = []
+                starting = []
+                with self._lock:
+                    if worker_name not in self._workers:
+                        logger.info("Worker {0} with {1} cores connected to job broker".format(worker_name, cores))
+                    self._workers[worker_name] = cores
+                    for job_id, pid in started:
+                        future = self._running.get(job_id)
+                        if future is not None:
+                            self._started(future, worker_name, pid)
+                            starting.append(future)
+                    for job_id, returncode in finished:
+                        jobs.discard(job_id)
+                        future = self._running.get(job_id)
+                        if future is not None:
+                            self._release(future)
+                            done.append((future, returncode))
+                    if self.closed and not jobs:
+                        reply = ('stop',)
+                    else:
+                        taken = [] if self.closed else self._take(worker_name, cores, free)
+                        jobs.update(future.job_id for future in taken)
+                        environ = telemetry_util.environment()
+                        kill = [j for j in jobs if j in self._running and self._running[j].kill_requested]
+                        reply = ('jobs', [(f.job_id, f.job, f.cores, environ) for f in taken], kill)
+                conn.send(reply)
+                for future in starting:
+                    future._record(ledger_util.STARTED, pid=future.pid)
+                self._finish(done)
+                if reply[0] == 'stop':
+                    break
+        except (EOFError, IOError, OSError) as e:
+            logger.critical("Lost connection to worker {0}: {1}".format(worker_name, e))
+        finally:
+            conn.close()
+            with self._lock:
+                self._workers.pop(worker_name, None)
+                lost = [self._running[job_id] for job_id in jobs if job_id in self._running]
+                failed = []
+                for future in lost:
+                    self._release(future)
+                    if future.kill_requested or self.closed:
+                        failed.append(future)
+                    else:
+                        self._requeue(future)
+                self._lock.notify_all()
+            self._finish([(future, 1) for future in failed])
+
+    def _requeue(self, future):
+        """Put a job that was lost with its worker back in the queue - must be called with the lock held"""
+        logger.warning("Requeueing job {0} lost with worker {1}".format(future.name, future.worker))
+        future.state = workers_util.JobFuture.PENDING
+        future.pid = None
+        future.worker = None
+        future.start_time = None
+        heapq.heappush(self._pending, [future.priority, future.job_id, future])
+        future._record(ledger_util.SUBMITTED, priority=future.priority, cores=future.cores)
+
+    def _finish(self, done):
+        for future, returncode in done:
+            state = workers_util.JobFuture.CANCELLED if future.kill_requested else workers_util.JobFuture.FINISHED
+            future._set_done(state, returncode)
+        if done:
+            self._notify()
+
+
+def get_broker(address, nproc=1, authkey_file=None):
+    """Return the shared :obj:`Broker`, starting it on address if it isn't already running
+
+    The key workers need to connect is written to authkey_file [default: broker.key in the current directory]
+    """
+    global _BROKER
+    if _BROKER is None or _BROKER.closed:
+        authkey_file = os.path.abspath(authkey_file or AUTHKEY_FILE)
+        _BROKER = Broker(parse_address(address), new_authkey(authkey_file), nproc=nproc)
+        logger.info(
+            "Start workers on other machines with: ample worker -connect {0} -authkey_file {1} -nproc NPROC".format(
+                address, authkey_file
+            )
+        )
+    elif _BROKER.nproc != nproc:
+        _BROKER.resize(nproc)
+    return _BROKER
+
+
+def shutdown_broker(wait=True):
+    """Shut down the shared :obj:`Broker` if there is one"""
+    global _BROKER
+    if _BROKER is not None:
+        _BROKER.shutdown(wait=wait)
+        _BROKER = None
+
+
+def connect(address, authkey, timeout=CONNECT_TIMEOUT):
+    """Connect to a broker, waiting up to timeout seconds for it to start"""
+    start = time.time()
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except (IOError, OSError) as e:
+            if time.time() - start > timeout:
+                raise RuntimeError("Could not connect to job broker at {0}: {1}".format(address, e))
+            time.sleep(1)
+
+
+def run_worker(address, authkey, nproc=1, name=None):
+    """Run jobs from the broker at address until it tells us to stop
+
+    Parameters
+    ----------
+    address : str or tuple
+       The (host, port) or Unix socket path of the broker
+    authkey : bytes
+       The key to connect with
+    nproc : int, optional
+       The number of cores to use
+    name : str, optional
+       The name of the worker [default: host-pid]
+
+    """
+    name = name or "{0}-{1}".format(socket.gethostname(), os.getpid())
+    conn = connect(address, authkey)
+    logger.info("Worker {0} connected to job broker at {1}".format(name, address))
+    lock = threading.Lock()
+    running = {}  # job_id -> [cores, pid, kill_requested]
+    started, finished = [], []
+
+    def run(job_id, job, cores, environ):
+        def on_start(p):
+            with lock:
+                running[job_id][1] = p.pid
+                started.append((job_id, p.pid))
+                if running[job_id][2]:
+                    _kill(p.pid)
+
+        retcode = worker.run_script(job, cores, on_start=on_start, environ=environ)
+        with lock:
+            del running[job_id]
+            finished.append((job_id, retcode))
+
+    try:
+        while True:
+            with lock:
+                free = nproc - sum(r[0] for r in running.values())
+                msg = ('poll', name, nproc, free, started[:], finished[:])
+                del started[:]
+                del finished[:]
+            conn.send(msg)
+            reply = conn.recv()
+            if reply[0] == 'stop':
+                break
+            _, jobs, kill = reply
+            for job_id, job, cores, environ in jobs:
+                logger.info("Worker {0} running job {1}".format(name, job))
+                with lock:
+                    running[job_id] = [min(cores, nproc), None, False]
+                thread = threading.Thread(target=run, args=(job_id, job, cores, environ))
+                thread.daemon = True
+                thread.start()
+            with lock:
+                for job_id in kill:
+                    if job_id in running and not running[job_id][2]:
+                        running[job_id][2] = True
+                        if running[job_id][1]:
+                            _kill(running[job_id][1])
+            time.sleep(POLL_INTERVAL)
+    except (EOFError, IOError, OSError) as e:
+        logger.critical("Lost connection to job broker: {0}".format(e))
+        with lock:
+            for cores, pid, _ in running.values():
+                if pid:
+                    _kill(pid)
+    finally:
+        conn.close()
+    logger.info("Worker {0} finished".format(name))
+
+
+def _kill(pid):
+    """Terminate the process group of a job, killing it if it is still running after a grace period"""
+
+    def signal_group(signum):
+        try:
+            os.killpg(pid, signum)
+        except OSError:
+            pass
+
+    signal_group(signal.SIGTERM)
+    timer = threading.Timer(workers_util.KILL_GRACE, signal_group, args=(signal.SIGKILL,))
+    timer.daemon = True
+    timer.start()
+
+
+def main(argv=None):
+    """Entry point for: ample worker -connect HOST:PORT"""
+    parser = argparse.ArgumentParser(prog='ample worker', description="Run AMPLE jobs from a job broker")
+    parser.add_argument('-connect', '--connect', required=True, help="HOST:PORT or Unix socket path of the broker")
+    parser.add_argument('-authkey_file', '--authkey_file', required=True, help="The key file written by the broker")
+    parser.add_argument(
+        '-nproc', '--nproc', type=int, default=multiprocessing.cpu_count(), help="The number of cores to use"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    run_worker(parse_address(args.connect), read_authkey(args.authkey_file), nproc=args.nproc)
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    sys.exit(main())
@@ -5,6 +5,7 @@
 #
 # Ronan Keegan 25/10/2011
 #
+import getpass
 import logging
 import os
 import subprocess
@@ -12,9 +13,27 @@ import shlex
 import shutil
 import time
 
+DONE_EXT = '.done'  # Extension of the sentinel file each job script writes its exit status to
+POLL_MIN = 5  # Initial seconds between checks on the queue
+POLL_MAX = 60  # Maximum seconds between checks on the queue
+POLL_BACKOFF = 2  # Factor the time between checks grows by while no jobs finish
+MONITOR_INTERVAL = 60  # Seconds between calls to the monitor function
+
 logger = logging.getLogger(__name__)
 
 
+def done_trap(path):
+    """Return the line to add near the top of a shell script so that it writes its exit status to path on exit"""
+    return "trap 'echo $? > \"{0}\"' EXIT\n".format(path)
+
+
+def remove_done_files(paths):
+    """Remove any sentinel files left by a previous run of the jobs"""
+    for path in paths:
+        if os.path.isfile(path):
+            os.unlink(path)
+
+
 class ClusterRun:
     def __init__(self):
 
@@ -25,6 +44,7 @@ class ClusterRun:
         self.runDir = None
         self.logDir = None
         self._scriptFile = None
+        self.doneFiles = {}
         self.debug = True
         return
 
@@ -62,30 +82,40 @@ class ClusterRun:
                 logger.critical("Cannot find logfile {0} to copy to {1}".format(oldLog, newLog))
         return
 
-    def getRunningJobList(self, user=""):
+    def getRunningJobList(self, user="", job_ids=None):
         """ Check a job status int the cluster queue 
 
+            The query is limited to the jobs in job_ids if given, or otherwise to the jobs
+            of user (by default the current user).
+
+            For SGE the jobs in job_ids are listed with qstat -j, which prints a
+            job_number line for each job that is still in the queue.
+
             For LSF output is of form:
 JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
 35340   jxt15-d RUN   q1h32      ida7c42     ida2a40     *ep 5;done Mar 25 13:23
                                              ida2a40
                                              ida2a40
 """
+        if user == "":
+            user = getpass.getuser()
         if self.QTYPE == "SGE":
-            if user == "":
-                command_line = 'qstat'
+            if job_ids:
+                command_line = 'qstat -j ' + ",".join(str(job) for job in job_ids)
             else:
                 command_line = 'qstat -u ' + user
         elif self.QTYPE == "LSF":
-            if user == "":
-                command_line = 'bjobs'
+            if job_ids:
+                command_line = 'bjobs ' + " ".join(str(job) for job in job_ids)
             else:
                 command_line = 'bjobs -u ' + user
+        else:
+            raise RuntimeError("Unrecognised QTYPE: {0}".format(self.QTYPE))
 
         log_lines = []
         self.runningQueueList = []
         process_args = shlex.split(command_line)
-        p = subprocess.Popen(process_args, stdout=subprocess.PIPE)
+        p = subprocess.Popen(process_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
         child_stdout = p.stdout
         out = child_stdout.readline()
         while out:
@@ -93,42 +123,66 @@ JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
             log_lines.append(out.strip())
             out = child_stdout.readline()
         child_stdout.close()
-        if log_lines != []:
+        if self.QTYPE == "SGE" and job_ids:
+            for i in log_lines:
+                fields = i.split()
+                if len(fields) == 2 and fields[0] == "job_number:":
+                    self.runningQueueList.append(fields[1])
+        elif log_lines != []:
             log_lines.pop(0)
             # SGE has extra header
             if self.QTYPE == "SGE":
                 log_lines.pop(0)
             for i in log_lines:
-                self.runningQueueList.append(i.split()[0])
+                fields = i.split()
+                # Skip the extra host lines of LSF and jobs LSF still lists after they have finished
+                if len(fields) < 3 or (self.QTYPE == "LSF" and fields[2] in ("DONE", "EXIT")):
+                    continue
+                # LSF array tasks are listed as JOBID[INDEX]
+                self.runningQueueList.append(fields[0].split("[")[0])
+        p.wait()
         return
 
+    def jobDone(self, job):
+        """Return True if all the scripts run by the job have written their sentinel files"""
+        doneFiles = self.doneFiles.get(job)
+        return bool(doneFiles) and all(os.path.isfile(f) for f in doneFiles)
+
     def monitorQueue(self, user="", monitor=None):
-        """ Monitor the Cluster queue to see when all jobs are completed """
+        """ Monitor the Cluster queue to see when all jobs are completed
+
+        Jobs are finished once all their scripts have written their sentinel files, or
+        when they are no longer in the queue, e.g. if they were killed. The queue is only
+        queried for jobs that are not yet finished. We check often to start with, and
+        less often the longer we go without any jobs finishing.
+        """
 
         if not len(self.qList):
             raise RuntimeError("No jobs found in self.qList!")
         logger.info("Jobs submitted to cluster queue, awaiting their completion...")
-        # set a holder for the qlist
-        runningList = self.qList
-        newRunningList = []
-        while runningList != []:
-            time.sleep(60)
-            self.getRunningJobList(user)
-            for job in runningList:
-                if str(job) in self.runningQueueList:
-                    newRunningList.append(job)
+        runningList = list(self.qList)
+        interval = POLL_MIN
+        lastMonitor = time.time()
+        while runningList:
+            time.sleep(interval)
+            newRunningList = [job for job in runningList if not self.jobDone(job)]
+            if newRunningList:
+                self.getRunningJobList(user, job_ids=newRunningList)
+                newRunningList = [job for job in newRunningList if str(job) in self.runningQueueList]
             if len(runningList) > len(newRunningList):
                 logger.info(
                     "Queue Monitor: %d out of %d jobs remaining in cluster queue...",
                     len(newRunningList),
                     len(self.qList),
                 )
-            if len(newRunningList) == 0:
-                logger.info("Queue Monitor: All jobs complete!")
+                interval = POLL_MIN
+            else:
+                interval = min(interval * POLL_BACKOFF, POLL_MAX)
             runningList = newRunningList
-            newRunningList = []
-            if monitor:
+            if monitor and time.time() - lastMonitor >= MONITOR_INTERVAL:
                 monitor()
+                lastMonitor = time.time()
+        logger.info("Queue Monitor: All jobs complete!")
         return
 
     def queueDirectives(
@@ -210,12 +264,13 @@ JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
         sh += ['\n']
         return sh
 
-    def submitJob(self, subScript):
+    def submitJob(self, subScript, doneFiles=None):
         """
         Submit the job to the queue and return the job number.
         
         Args:
         subScript -- the path to the submission script
+        doneFiles -- the sentinel files the job writes when it has finished
         
         Returns:
         job number as a string
@@ -237,7 +292,9 @@ JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
         logger.debug("Submitting job with command: {0}".format(command_line))
         process_args = shlex.split(command_line)
         try:
-            p = subprocess.Popen(process_args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p = subprocess.Popen(
+                process_args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+            )
         except Exception as e:
             raise RuntimeError("Error submitting job to queue with commmand: {0}\n{1}".format(command_line, e))
 
@@ -272,8 +329,12 @@ JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   JOB_NAME   SUBMIT_TIME
                     self.qList.append(qNumber)
             if qNumber:
                 logger.debug("Submission script {0} submitted to queue as job {1}".format(subScript, qNumber))
+                self.doneFiles[qNumber] = doneFiles or []
             out = child_stdout.readline()
         child_stdout.close()
+        p.wait()
+        if stdin:
+            stdin.close()
         return str(qNumber)
 
     def submitArrayJob(
@@ -343,12 +404,16 @@ jobname=`basename $script .sh`
 # cd to jobdir and runit
 cd $jobdir
 
+# Record that the script has finished
+{2}
 # Run the script
 $script
 """.format(
-            self._scriptFile, task_env
+            self._scriptFile, task_env, done_trap("${script}" + DONE_EXT)
         )
         with open(arrayScript, 'w') as f:
             f.write(s)
-        self.submitJob(arrayScript)
+        doneFiles = [script + DONE_EXT for script in job_scripts]
+        remove_done_files(doneFiles)
+        self.submitJob(arrayScript, doneFiles=doneFiles)
         return
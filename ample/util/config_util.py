@@ -57,6 +57,7 @@ _SECTIONS_REFERENCE = {
         'fasta',
         'frags_3mers',
         'frags_9mers',
+        'job_ledger',
         'models',
         'models_dir',
         'mrbump_dir',
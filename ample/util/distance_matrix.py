@@ -0,0 +1,394 @@
+"""A compact symmetric distance matrix
+
+The subclusterers and SPICKER only need the distances between distinct pairs of
+models, and the matrix is symmetric, so only the upper triangle (i < j) is stored,
+row by row, as a flat float32 array of n * (n - 1) / 2 values. This is less than a
+quarter of the memory of a dense float64 matrix.
+
+Large matrices can be backed by a :obj:`numpy.memmap` on scratch disk, so that
+matrices for many thousands of models don't need to be held in memory.
+
+Matrices are exchanged between AMPLE processes as binary files holding the raw
+upper triangle and the paths of the models (see :func:`write` and :func:`read`).
+The text format used by SPICKER is only written with :func:`write_text` when the
+SPICKER program needs it.
+"""
+
+__author__ = "Jens Thomas"
+
+import logging
+import os
+import tempfile
+
+import numpy
+
+# Matrices for at least this many models are memory-mapped if we have a directory for them
+MEMMAP_MIN_SIZE = 2000
+
+# Binary matrix files start with MAGIC, followed by a header of the format version, the number of models,
+# the value of the diagonal and the length of the model index, then the model index as newline-separated
+# UTF-8 paths and finally the upper triangle as little-endian float32 values.
+MAGIC = b'AMPLEDM\0'
+VERSION = 1
+_HEADER = numpy.dtype([('version', '<u4'), ('n', '<u4'), ('diagonal', '<f8'), ('index_bytes', '<u8')])
+_DATA_DTYPE = numpy.dtype('<f4')
+
+logger = logging.getLogger(__name__)
+
+# Directory to create memory-mapped matrices in - see set_memmap_dir
+_MEMMAP_DIR = None
+
+
+def set_memmap_dir(directory, min_size=None):
+    """Set the directory that large matrices are memory-mapped in [default: $CCP4_SCR]
+
+    Parameters
+    ----------
+    directory : str
+       The directory for the files, or None for the default
+    min_size : int, optional
+       Matrices for at least this many models are memory-mapped
+
+    """
+    global _MEMMAP_DIR, MEMMAP_MIN_SIZE
+    _MEMMAP_DIR = directory
+    if min_size is not None:
+        MEMMAP_MIN_SIZE = min_size
+
+
+def condensed_size(n):
+    """Return the number of distinct pairs of n items"""
+    return n * (n - 1) // 2
+
+
+class CondensedDistanceMatrix(object):
+    """Symmetric n x n distance matrix that only stores the upper triangle
+
+    Elements are accessed as with a square array, with ``matrix[i, j]`` for single elements, where
+    i or j can also be an array of indices, and ``matrix[i]`` for a whole row. The diagonal isn't
+    stored and is always the value diagonal.
+
+    Parameters
+    ----------
+    n : int
+       The number of items
+    diagonal : float, optional
+       The distance of each item from itself
+    dtype : :obj:`numpy.dtype`, optional
+       The type the distances are stored as
+    memmap_dir : str, optional
+       Back the matrix with a file in this directory [default: see :func:`set_memmap_dir`]
+    data : :obj:`numpy.ndarray`, optional
+       An existing array of the n * (n - 1) / 2 elements of the upper triangle to use
+
+    """
+
+    def __init__(self, n, diagonal=0.0, dtype=numpy.float32, memmap_dir=None, data=None):
+        self.n = n
+        self.diagonal = diagonal
+        self.filename = None
+        size = condensed_size(n)
+        if data is not None:
+            if len(data) != size:
+                raise RuntimeError("Need {0} elements for a matrix of size {1} but got {2}".format(size, n, len(data)))
+            self.data = data
+            return
+        if memmap_dir is None and n >= MEMMAP_MIN_SIZE:
+            memmap_dir = _MEMMAP_DIR or os.environ.get('CCP4_SCR')
+        if memmap_dir and size:
+            fd, self.filename = tempfile.mkstemp(prefix='distance_matrix_', suffix='.dat', dir=memmap_dir)
+            os.close(fd)
+            logger.debug("Memory-mapping distance matrix for %d models to %s", n, self.filename)
+            self.data = numpy.memmap(self.filename, dtype=dtype, mode='w+', shape=(size,))
+        else:
+            self.data = numpy.zeros(size, dtype=dtype)
+
+    @classmethod
+    def from_square(cls, matrix, **kwargs):
+        """Create a matrix from the upper triangle of a square array"""
+        matrix = numpy.asarray(matrix)
+        n = len(matrix)
+        kwargs.setdefault('diagonal', matrix[0, 0] if n else 0.0)
+        m = cls(n, **kwargs)
+        for i in range(n - 1):
+            m.set_upper(i, matrix[i, i + 1 :])
+        return m
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Remove the file backing a memory-mapped matrix"""
+        if self.filename:
+            self.data = None
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+            self.filename = None
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    def __array__(self, dtype=None, copy=None):
+        square = self.to_square()
+        return square if dtype is None else square.astype(dtype)
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.row(i)
+
+    def offset(self, i):
+        """Return the position in data of the element (i, i + 1), after which the rest of the upper row follows"""
+        return i * self.n - i * (i + 1) // 2
+
+    def index(self, i, j):
+        """Return the position in data of the elements (i, j), which must not be on the diagonal"""
+        i, j = numpy.minimum(i, j), numpy.maximum(i, j)
+        return i * self.n - i * (i + 1) // 2 + j - i - 1
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return self.row(key)
+        i, j = key
+        if numpy.isscalar(i) and numpy.isscalar(j):
+            return self.diagonal if i == j else self.data[self.index(i, j)]
+        i, j = numpy.broadcast_arrays(i, j)
+        values = numpy.full(i.shape, self.diagonal, dtype=self.data.dtype)
+        off = i != j
+        values[off] = self.data[self.index(i[off], j[off])]
+        return values
+
+    def __setitem__(self, key, value):
+        i, j = key
+        if numpy.isscalar(i) and numpy.isscalar(j):
+            if i != j:
+                self.data[self.index(i, j)] = value
+            return
+        i, j, value = numpy.broadcast_arrays(i, j, value)
+        off = i != j
+        self.data[self.index(i[off], j[off])] = value[off]
+
+    def set_upper(self, i, values):
+        """Set the elements (i, i + 1) to (i, n - 1) of row i"""
+        start = self.offset(i)
+        self.data[start : start + self.n - i - 1] = values
+
+    def upper(self, i):
+        """Return the elements (i, i + 1) to (i, n - 1) of row i"""
+        start = self.offset(i)
+        return self.data[start : start + self.n - i - 1]
+
+    def row(self, i):
+        """Return row i as an array"""
+        row = numpy.empty(self.n, dtype=self.data.dtype)
+        js = numpy.arange(i)
+        row[:i] = self.data[js * self.n - js * (js + 1) // 2 + i - js - 1]
+        row[i] = self.diagonal
+        row[i + 1 :] = self.upper(i)
+        return row
+
+    def to_square(self):
+        """Return the matrix as a square array"""
+        square = numpy.empty(self.shape, dtype=self.data.dtype)
+        for i in range(self.n):
+            square[i, i] = self.diagonal
+            square[i, i + 1 :] = square[i + 1 :, i] = self.upper(i)
+        return square
+
+    def count_within(self, thresh):
+        """Return the number of elements of each row that are <= thresh, but not zero"""
+        counts = numpy.zeros(self.n, dtype=numpy.int64)
+        for i in range(self.n - 1):
+            upper = self.upper(i)
+            within = numpy.logical_and(upper <= thresh, upper != 0.0)
+            counts[i] += numpy.count_nonzero(within)
+            counts[i + 1 :] += within
+        if self.diagonal <= thresh and self.diagonal != 0.0:
+            counts += 1
+        return counts
+
+
+class RadiusIndex(object):
+    """Index of a :obj:`CondensedDistanceMatrix` for finding the largest cluster under any radius
+
+    Each row of the matrix is sorted once, after which the number of items within a radius of every
+    item, and the smallest radius that gives a cluster of a given size, are found with binary searches.
+    As with :meth:`CondensedDistanceMatrix.count_within`, distances of zero are ignored so that an item
+    is never counted as its own neighbour.
+
+    The sorted rows take up n * n values, which is twice the size of the condensed matrix, so they
+    are memory-mapped in the same way when the matrix is.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.filename = None
+        n = matrix.n
+        dtype = matrix.data.dtype
+        if isinstance(matrix.data, numpy.memmap) and n:
+            # A matrix read from a file is memory-mapped from that file, which may not be somewhere we can write
+            directory = os.path.dirname(matrix.filename or matrix.data.filename)
+            if not matrix.filename:
+                directory = _MEMMAP_DIR or os.environ.get('CCP4_SCR') or directory
+            fd, self.filename = tempfile.mkstemp(prefix='radius_index_', suffix='.dat', dir=directory)
+            os.close(fd)
+            logger.debug("Memory-mapping sorted distances for %d models to %s", n, self.filename)
+            self.sorted = numpy.memmap(self.filename, dtype=dtype, mode='w+', shape=(n, n))
+        else:
+            self.sorted = numpy.empty((n, n), dtype=dtype)
+        for i in range(n):
+            self.sorted[i] = numpy.sort(matrix.row(i))
+        self.nzeros = self._searchsorted(0.0, 'right')
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Remove the file backing memory-mapped sorted rows"""
+        if self.filename:
+            self.sorted = None
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+            self.filename = None
+
+    def _searchsorted(self, value, side):
+        """Return :func:`numpy.searchsorted` of value in every sorted row, with one binary search over all the rows"""
+        value = self.sorted.dtype.type(value)
+        n = self.matrix.n
+        lo = numpy.zeros(n, dtype=numpy.int64)
+        hi = numpy.full(n, n, dtype=numpy.int64)
+        active = numpy.arange(n)
+        while len(active):
+            mid = (lo[active] + hi[active]) // 2
+            values = self.sorted[active, mid]
+            below = values < value if side == 'left' else values <= value
+            lo[active[below]] = mid[below] + 1
+            hi[active[~below]] = mid[~below]
+            active = active[lo[active] < hi[active]]
+        return lo
+
+    def counts(self, radius):
+        """Return the number of items within radius of each item"""
+        return numpy.maximum(self._searchsorted(radius, 'right') - self.nzeros, 0)
+
+    def counts_below(self, radius):
+        """Return the number of distances in each row that are strictly less than radius, including the diagonal"""
+        return self._searchsorted(radius, 'left')
+
+    def largest_cluster(self, radius):
+        """Return the indices of the largest cluster under radius, with the item it is centred on first
+
+        The cluster is centred on the first of the items with the most neighbours within radius.
+        An empty list is returned if no items are within radius of each other.
+        """
+        counts = self.counts(radius)
+        centre = int(numpy.argmax(counts))
+        if counts[centre] == 0:
+            return []
+        row = self.matrix.row(centre)
+        neighbours = numpy.where(numpy.logical_and(row <= self.sorted.dtype.type(radius), row != 0.0))[0]
+        return [centre] + neighbours.tolist()
+
+    def radius_for(self, nitems):
+        """Return the smallest radius that gives a cluster of at least nitems items, or None if there isn't one"""
+        if nitems < 2:
+            return 0.0
+        # The radius at which each item gets nitems - 1 neighbours
+        position = self.nzeros + nitems - 2
+        possible = position < self.matrix.n
+        if not possible.any():
+            return None
+        return float(self.sorted[numpy.where(possible)[0], position[possible]].min())
+
+
+def write(matrix, path, models=None):
+    """Write a :obj:`CondensedDistanceMatrix` to the binary file path
+
+    Parameters
+    ----------
+    matrix : :obj:`CondensedDistanceMatrix`
+       The matrix to write
+    path : str
+       The file to write
+    models : list, optional
+       The paths of the models that the rows of the matrix correspond to
+
+    """
+    if models is not None and len(models) != matrix.n:
+        raise RuntimeError("Have {0} models for a matrix of size {1}".format(len(models), matrix.n))
+    index = "\n".join(models or []).encode('utf-8')
+    header = numpy.array([(VERSION, matrix.n, matrix.diagonal, len(index))], dtype=_HEADER)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(header.tobytes())
+        f.write(index)
+        f.write(numpy.asarray(matrix.data, dtype=_DATA_DTYPE).tobytes())
+    return os.path.abspath(path)
+
+
+def is_binary(path):
+    """Return True if path is a binary matrix file"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read(path, mmap=False):
+    """Read a binary matrix file
+
+    Parameters
+    ----------
+    path : str
+       The file to read
+    mmap : bool, optional
+       Memory-map the distances from the file rather than reading them into memory
+
+    Returns
+    -------
+    tuple
+       The :obj:`CondensedDistanceMatrix` and the list of the models in it, which is empty if they weren't written
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError("Not a distance matrix file: {0}".format(path))
+        header = numpy.frombuffer(f.read(_HEADER.itemsize), dtype=_HEADER)[0]
+        if header['version'] != VERSION:
+            raise RuntimeError("Unsupported distance matrix file version {0}: {1}".format(header['version'], path))
+        index = f.read(int(header['index_bytes'])).decode('utf-8')
+        n = int(header['n'])
+        size = condensed_size(n)
+        if mmap and size:
+            if os.path.getsize(path) < f.tell() + size * _DATA_DTYPE.itemsize:
+                raise RuntimeError("Distance matrix file is truncated: {0}".format(path))
+            data = numpy.memmap(path, dtype=_DATA_DTYPE, mode='r', offset=f.tell(), shape=(size,))
+        else:
+            data = numpy.frombuffer(f.read(size * _DATA_DTYPE.itemsize), dtype=_DATA_DTYPE).copy()
+    if len(data) != size:
+        raise RuntimeError("Distance matrix file is truncated: {0}".format(path))
+    matrix = CondensedDistanceMatrix(n, diagonal=float(header['diagonal']), data=data)
+    return matrix, index.split("\n") if index else []
+
+
+def write_text(matrix, path, offset=0):
+    """Write the matrix in the text format read by SPICKER
+
+    Each line holds the two indices and the distance of an element of the upper triangle,
+    including the diagonal, with the indices starting from offset.
+    """
+    n = matrix.n
+    with open(path, 'w') as f:
+        for i in range(n):
+            j = numpy.arange(i, n)
+            values = numpy.empty(n - i, dtype=numpy.float64)
+            values[0] = matrix.diagonal
+            values[1:] = matrix.upper(i)
+            rows = numpy.column_stack((numpy.full(n - i, i + offset), j + offset, values))
+            numpy.savetxt(f, rows, fmt=['% 4d', '% 4d', '% 8.3f'])
+        f.write("\n")
+    return os.path.abspath(path)
@@ -0,0 +1,48 @@
+"""Append-only files of JSON records, one per line
+
+The job ledger and the telemetry file are both written this way. Each record is
+appended with a single write of a complete line, so the file can be read while it
+is being written and appended to by several processes at once. The file is named
+by an environment variable so that it is inherited by any AMPLE processes we start.
+"""
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+
+
+def enable(variable, path):
+    """Set the environment variable variable to the absolute path of the file"""
+    os.environ[variable] = os.path.abspath(path)
+
+
+def append(path, record):
+    """Append the dictionary record to the file path as a line of JSON"""
+    try:
+        with _lock:
+            with open(path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+    except (IOError, OSError) as e:
+        logger.debug("Could not write to %s: %s", path, e)
+
+
+def read(path):
+    """Return the list of records in the file path, or an empty list if there is no file"""
+    records = []
+    if not path or not os.path.isfile(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Most likely a partial line from a killed process
+                logger.debug("Ignoring bad record in %s: %s", path, line)
+    return records
@@ -0,0 +1,263 @@
+"""Cluster decoys with k-medoids directly with NumPy
+
+The decoys are split into k clusters, each represented by its medoid: the decoy with the smallest total
+distance to the other decoys in the cluster. The distance between two decoys is either the CA RMSD or
+1 - TM-score (see :mod:`ample.util.tmscore_util`).
+
+Up to batch_size decoys are clustered with the full matrix of distances between them. Larger sets of
+decoys are clustered in mini-batches (the CLARA algorithm): k-medoids is run on several random samples
+of batch_size decoys, every decoy is assigned to the nearest of the medoids of each sample and the
+medoids that give the smallest total distance are kept. The medoid of each cluster is then refined on a
+sample of its members. Only batch_size x batch_size and nmodels x k distances are ever held in memory,
+so any number of clusters can be made from tens of thousands of decoys.
+"""
+
+__author__ = "Jens Thomas"
+
+import functools
+import logging
+
+import numpy
+
+from ample.ensembler._ensembler import Cluster
+from ample.ensembler.constants import KMEDOIDS_RMSD, KMEDOIDS_TM
+from ample.util import rmsd_util, tmscore_util
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 2000  # The number of decoys clustered with the full distance matrix
+NUM_BATCHES = 5  # The number of samples clustered when there are more than BATCH_SIZE decoys
+MAX_ITERATIONS = 100
+SCORE_TYPES = ('rmsd', 'tm')
+TM_SEARCH_STEP = None  # Only extend the superposition of all the residues when calculating TM-scores
+
+
+def rmsd_distances(coords, others=None):
+    """Return the RMSDs between every model in coords and every model in others [default: coords]"""
+    if others is None:
+        return rmsd_util.pairwise_rmsd(coords)
+    return rmsd_util.cross_rmsd(coords, others)
+
+
+def tm_distances(coords, others=None, nproc=1):
+    """Return 1 - the TM-score between every model in coords and every model in others [default: coords]
+
+    The TM-scores come from a quick search that only extends the superposition of all the residues
+    (see :func:`ample.util.tmscore_util.seeds`), so this is an upper bound on the TM-score distance.
+
+    Parameters
+    ----------
+    coords : :obj:`numpy.ndarray`
+       An (nmodels, nresidues, 3) array of coordinates
+    others : :obj:`numpy.ndarray`, optional
+       An (nothers, nresidues, 3) array of coordinates
+    nproc : int, optional
+       The number of processes to calculate the TM-scores with
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       An (nmodels, nothers) array of distances
+    """
+    if others is None:
+        return 1.0 - tmscore_util.pairwise_tm(coords, step=TM_SEARCH_STEP, nproc=nproc)
+    return 1.0 - tmscore_util.cross_tm(coords, others, step=TM_SEARCH_STEP, nproc=nproc)
+
+
+def distance_function(score_type, nproc=1):
+    """Return the function that calculates the distances between two sets of coordinates for a score_type
+
+    TM-scores are calculated with nproc processes; the vectorised RMSDs are calculated in this process.
+    """
+    if score_type == 'rmsd':
+        return rmsd_distances
+    elif score_type == 'tm':
+        return functools.partial(tm_distances, nproc=nproc)
+    raise RuntimeError("Unrecognised score_type: {0}".format(score_type))
+
+
+def kmedoids(matrix, num_clusters, rng=None, max_iterations=MAX_ITERATIONS):
+    """Cluster the items of a square distance matrix with k-medoids
+
+    The medoids are started with k-medoids++ and then moved to the item with the smallest total distance
+    to the other items in its cluster until they stop changing.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       The indices of the medoids
+    """
+    rng = rng or numpy.random.RandomState(1)
+    n = len(matrix)
+    medoids = [rng.randint(n)]
+    nearest = matrix[medoids[0]].astype(numpy.float64)
+    for _ in range(1, num_clusters):
+        weights = nearest ** 2
+        total = weights.sum()
+        if total > 0:
+            medoid = int(rng.choice(n, p=weights / total))
+        else:
+            # Everything left is identical to a medoid
+            medoid = int(numpy.setdiff1d(numpy.arange(n), medoids)[0])
+        medoids.append(medoid)
+        nearest = numpy.minimum(nearest, matrix[medoid])
+    medoids = numpy.array(medoids)
+
+    for _ in range(max_iterations):
+        labels = numpy.argmin(matrix[:, medoids], axis=1)
+        # A medoid is always in its own cluster, even if it is identical to another medoid
+        labels[medoids] = numpy.arange(num_clusters)
+        new_medoids = medoids.copy()
+        for c in range(num_clusters):
+            members = numpy.where(labels == c)[0]
+            new_medoids[c] = members[numpy.argmin(matrix[numpy.ix_(members, members)].sum(axis=1))]
+        if numpy.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+    return medoids
+
+
+def clara(coords, num_clusters, distances, batch_size=BATCH_SIZE, num_batches=NUM_BATCHES, rng=None):
+    """Cluster a large number of models with k-medoids on samples of batch_size models
+
+    Parameters
+    ----------
+    coords : :obj:`numpy.ndarray`
+       An (nmodels, nresidues, 3) array of coordinates
+    num_clusters : int
+       The number of clusters
+    distances : function
+       Returns the array of distances between two sets of coordinates, or within one set if only given one
+    batch_size : int, optional
+       The number of models in each sample
+    num_batches : int, optional
+       The number of samples to cluster
+
+    Returns
+    -------
+    tuple
+       The indices of the medoids and the (nmodels, num_clusters) array of the distances of each model to them
+    """
+    rng = rng or numpy.random.RandomState(1)
+    n = len(coords)
+    best_medoids, best_distances, best_cost = None, None, None
+    for batch in range(num_batches):
+        # As with CLARA, the best medoids so far are always in the sample
+        sample = rng.choice(n, batch_size, replace=False)
+        if best_medoids is not None:
+            sample = numpy.union1d(best_medoids, sample)
+        medoids = sample[kmedoids(distances(coords[sample]), num_clusters, rng=rng)]
+        to_medoids = distances(coords, coords[medoids])
+        cost = to_medoids.min(axis=1).sum()
+        logger.debug("k-medoids batch %d cost: %f", batch + 1, cost)
+        if best_cost is None or cost < best_cost:
+            best_medoids, best_distances, best_cost = medoids, to_medoids, cost
+
+    # Refine the medoid of each cluster on a sample of its members
+    labels = numpy.argmin(best_distances, axis=1)
+    labels[best_medoids] = numpy.arange(num_clusters)
+    medoids = best_medoids.copy()
+    for c in range(num_clusters):
+        members = numpy.where(labels == c)[0]
+        if len(members) > batch_size:
+            members = numpy.union1d([medoids[c]], rng.choice(members, batch_size - 1, replace=False))
+        matrix = distances(coords[members])
+        medoids[c] = members[numpy.argmin(matrix.sum(axis=1))]
+    if not numpy.array_equal(medoids, best_medoids):
+        best_distances = distances(coords, coords[medoids])
+    return medoids, best_distances
+
+
+class KMedoidsClusterer(object):
+    """Cluster decoys with k-medoids
+
+    The clusters are :obj:`ample.ensembler._ensembler.Cluster` objects in order of size, with the models
+    of each cluster ordered by their distance from its medoid, so the medoid is the centroid.
+
+    Parameters
+    ----------
+    score_type : str, optional
+       Cluster on the CA RMSD ('rmsd') or 1 - TM-score ('tm')
+    batch_size : int, optional
+       Cluster in mini-batches of this many models if there are more models than this
+    seed : int, optional
+       The seed of the random numbers used to pick the starting medoids and the samples
+    nproc : int, optional
+       The number of processes to calculate the TM-scores with
+
+    """
+
+    def __init__(self, score_type='rmsd', batch_size=BATCH_SIZE, seed=1, nproc=1):
+        if score_type not in SCORE_TYPES:
+            raise RuntimeError("Unrecognised score_type: {0}".format(score_type))
+        self.score_type = score_type
+        self.batch_size = batch_size
+        self.seed = seed
+        self.nproc = nproc
+        self.cluster_method = KMEDOIDS_RMSD if score_type == 'rmsd' else KMEDOIDS_TM
+        self.distances = distance_function(score_type, nproc=nproc)
+
+    def cluster(self, models, num_clusters=10, max_cluster_size=200, coords=None):
+        """Cluster decoys with k-medoids
+
+        Parameters
+        ----------
+        models : list
+           A list containing structure decoys
+        num_clusters : int
+           The number of clusters to produce
+        max_cluster_size : int
+           The maximum number of decoys per cluster
+        coords : :obj:`numpy.ndarray`, optional
+           An (nmodels, nresidues, 3) array of the CA coordinates of the models, which are read from the models
+           if not given
+
+        Returns
+        -------
+        list
+           A list containing the clusters
+        """
+        if not len(models):
+            raise RuntimeError("no models provided!")
+        if coords is None:
+            coords = rmsd_util.ca_coordinates(models)
+        if len(coords) != len(models):
+            raise RuntimeError("Have coordinates for {0} models but {1} models".format(len(coords), len(models)))
+        if num_clusters > len(models):
+            logger.critical(
+                'Requested {0} clusters but only have {1} models so using {1} clusters'.format(
+                    num_clusters, len(models)
+                )
+            )
+            num_clusters = len(models)
+
+        rng = numpy.random.RandomState(self.seed)
+        if len(models) <= self.batch_size:
+            matrix = self.distances(coords)
+            medoids = kmedoids(matrix, num_clusters, rng=rng)
+            to_medoids = matrix[:, medoids]
+        else:
+            logger.info("Clustering %d models with k-medoids in batches of %d", len(models), self.batch_size)
+            medoids, to_medoids = clara(coords, num_clusters, self.distances, batch_size=self.batch_size, rng=rng)
+        return self.make_clusters(models, medoids, to_medoids, max_cluster_size)
+
+    def make_clusters(self, models, medoids, to_medoids, max_cluster_size):
+        """Return the clusters given the medoids and the distances of every model to them"""
+        labels = numpy.argmin(to_medoids, axis=1)
+        labels[medoids] = numpy.arange(len(medoids))
+        sizes = numpy.bincount(labels, minlength=len(medoids))
+        clusters = []
+        for i, c in enumerate(numpy.argsort(-sizes, kind='mergesort')):
+            members = numpy.where(labels == c)[0]
+            distances = to_medoids[members, c]
+            # Sort by distance from the medoid, making sure the medoid is first
+            members = members[numpy.lexsort((members != medoids[c], distances))]
+            cluster = Cluster()
+            cluster.cluster_method = self.cluster_method
+            cluster.cluster_score_type = self.score_type
+            cluster.index = i + 1
+            cluster.num_clusters = len(medoids)
+            cluster.models = [models[m] for m in members[:max_cluster_size]]
+            cluster.r_cen = to_medoids[members[:max_cluster_size], c].tolist()
+            clusters.append(cluster)
+        return clusters
@@ -0,0 +1,62 @@
+"""An append-only ledger of the state of the jobs that AMPLE runs
+
+Every time a job run through the :obj:`ample.util.workers_util.WorkerPool` changes state
+a line of JSON is appended to the ledger file recording the job, its new state, the
+time and any data such as the return code or run time. Reading the file back gives
+the last known state of every job, so that a restarted run can tell straight away
+which jobs have finished without having to look through their output directories.
+"""
+
+import os
+import time
+
+from ample.util import jsonl_util
+
+LEDGER_FILE = 'jobs.jsonl'
+LEDGER_FILE_ENV = 'AMPLE_LEDGER_FILE'
+
+# Job states
+SUBMITTED = 'submitted'
+STARTED = 'started'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+def enable(path):
+    """Record job states in the file path"""
+    jsonl_util.enable(LEDGER_FILE_ENV, path)
+
+
+def record(job, state, **data):
+    """Append the new state of job to the ledger if one has been set
+
+    Parameters
+    ----------
+    job : str
+       The path to the job script
+    state : str
+       The new state of the job
+    **data
+       Any other data to record, e.g. the returncode
+
+    """
+    path = os.environ.get(LEDGER_FILE_ENV)
+    if not path:
+        return
+    entry = {'job': job, 'state': state, 'time': time.time()}
+    entry.update(data)
+    jsonl_util.append(path, entry)
+
+
+def read(path=None):
+    """Return the list of entries in a ledger file"""
+    return jsonl_util.read(path or os.environ.get(LEDGER_FILE_ENV))
+
+
+def job_states(path=None):
+    """Return a dictionary mapping each job in a ledger file to its last entry"""
+    states = {}
+    for entry in read(path):
+        states[entry['job']] = entry
+    return states
@@ -13,11 +13,13 @@ if __name__ == "__main__":
     root = os.sep.join(os.path.abspath(__file__).split(os.sep)[:-2])
     sys.path.insert(0, os.path.join(root, "scripts"))
 
+from ample.ensembler.constants import POLYALA
 from ample.util import ample_util, mrbump_cmd, printTable
 from mrbump.parsers import parse_arpwarp, parse_buccaneer, parse_phaser
 
 TOP_KEEP = 3  # How many of the top shelxe/phaser results to keep for the gui
 MRBUMP_RUNTIME = 172800  # allow 48 hours for each mrbump job
+MRBUMP_JOB_CORES = 1  # MRBUMP runs its programs one after the other
 REBUILD_MAX_PERMITTED_RESOLUTION = 4.0
 SHELXE_MAX_PERMITTED_RESOLUTION = 3.0
 SHELXE_MAX_PERMITTED_RESOLUTION_CC = 3.5
@@ -30,6 +32,15 @@ SUCCESS_RFREE = 0.4
 SUCCESS_SHELXE_CC = 25.0
 SUCCESS_SHELXE_ACL = 10
 
+# Values below which a job is considered to have failed badly - used to reorder the remaining jobs
+POOR_PHASER_TFZ = 5.0
+POOR_SHELXE_CC = 10.0
+# Values above which a job that hasn't succeeded is still considered promising
+PROMISING_PHASER_TFZ = 6.5
+PROMISING_SHELXE_CC = 15.0
+# Ensembles with fewer residues than this rarely solve so are run last
+MIN_PROMISING_RESIDUES = 20
+
 
 # We need a null logger so that we can be used without requiring a logger
 class NullHandler(logging.Handler):
@@ -41,6 +52,93 @@ logger = logging.getLogger(__name__)
 logger.addHandler(NullHandler())
 
 
+class MrBumpPrioritiser(object):
+    """Order MRBUMP jobs and reorder the remaining jobs as results come in.
+
+    The initial priority of a job is its position in the list of job scripts, which
+    should already have been sorted with :func:`ample.ensembler.sort_ensembles`, with
+    ensembles with very few residues moved to the end. When a job finishes without
+    succeeding, the jobs for the other ensembles from the same cluster and truncation
+    level are moved down the queue if it failed badly (more so if it was a polyalanine
+    ensemble, as these are the most likely to succeed), or up the queue if it looked
+    promising.
+
+    Parameters
+    ----------
+    job_scripts : list
+       The MRBUMP job scripts in their initial order
+    ensembles_data : list
+       The ensembles' data dictionaries
+
+    """
+
+    def __init__(self, job_scripts, ensembles_data):
+        data = {d['name']: d for d in ensembles_data or []}
+        self.nscripts = len(job_scripts)
+        self._rank = {}
+        self._data = {}
+        for i, script in enumerate(job_scripts):
+            name = os.path.splitext(os.path.basename(script))[0]
+            self._rank[script] = i
+            self._data[script] = data.get(name)
+        self._shift = {}
+
+    def priority(self, script):
+        """Return the priority of a job script - lowest runs first"""
+        priority = float(self._rank.get(script, self.nscripts))
+        data = self._data.get(script)
+        if data:
+            if data.get('num_residues') and data['num_residues'] < MIN_PROMISING_RESIDUES:
+                priority += self.nscripts
+            priority += self._shift.get(self._group(data), 0.0)
+        return priority
+
+    def job_finished(self, script, returncode):
+        """Update the priorities with the result of a job
+
+        Returns
+        -------
+        bool
+           True if the priorities of the remaining jobs have changed
+        """
+        data = self._data.get(script)
+        if not data or returncode != 0:
+            return False
+        results = job_results(script)
+        if not results:
+            return False
+        best = ResultsSummary.sortResultsStatic(results)[0]
+        if ResultsSummary.jobSucceeded(best):
+            return False
+        group = self._group(data)
+        if self._failed_badly(best):
+            shift = self.nscripts if data.get('side_chain_treatment') == POLYALA else self.nscripts / 2.0
+            logger.debug("Moving jobs from cluster %s, truncation level %s down the queue", group[0], group[1])
+        elif self._promising(best):
+            shift = -self.nscripts / 2.0
+            logger.debug("Moving jobs from cluster %s, truncation level %s up the queue", group[0], group[1])
+        else:
+            return False
+        self._shift[group] = self._shift.get(group, 0.0) + shift
+        return True
+
+    @staticmethod
+    def _group(data):
+        return data.get('cluster_num'), data.get('truncation_level')
+
+    @staticmethod
+    def _failed_badly(result):
+        tfz = _float_or_none(result.get('PHASER_TFZ'))
+        cc = _float_or_none(result.get('SHELXE_CC'))
+        return (tfz is None or tfz < POOR_PHASER_TFZ) and (cc is None or cc < POOR_SHELXE_CC)
+
+    @staticmethod
+    def _promising(result):
+        tfz = _float_or_none(result.get('PHASER_TFZ'))
+        cc = _float_or_none(result.get('SHELXE_CC'))
+        return (tfz is not None and tfz >= PROMISING_PHASER_TFZ) or (cc is not None and cc >= PROMISING_SHELXE_CC)
+
+
 class ResultsSummary(object):
     """
     Summarise the results for a series of MRBUMP runs
@@ -536,11 +634,8 @@ def checkSuccess(script_path):
     Success is assumed as a SHELX CC score of >= SHELXSUCCESS
 
     """
-    directory, script = os.path.split(script_path)
-    scriptname = os.path.splitext(script)[0]
-    rfile = os.path.join(directory, 'search_' + scriptname + '_mrbump', 'results', 'resultsTable.pkl')
-    if os.path.isfile(rfile):
-        results = ResultsSummary().processMrbumpPkl(rfile)
+    results = job_results(script_path)
+    if results:
         best = ResultsSummary.sortResultsStatic(results)[0]
         return ResultsSummary.jobSucceeded(best)
     else:
@@ -595,12 +690,29 @@ def finalSummary(amoptd):
     return r
 
 
+def job_results(script_path):
+    """Return the list of results dictionaries for a MrBUMP job script or an empty list if there are none"""
+    directory, script = os.path.split(script_path)
+    scriptname = os.path.splitext(script)[0]
+    rfile = os.path.join(directory, 'search_' + scriptname + '_mrbump', 'results', 'resultsTable.pkl')
+    if os.path.isfile(rfile):
+        return ResultsSummary().processMrbumpPkl(rfile)
+    return []
+
+
 def job_unfinished(job_dict):
     if not 'Solution_Type' in job_dict:
         return True
     return job_dict['Solution_Type'] == "unfinished" or job_dict['Solution_Type'] == "no_job_directory"
 
 
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
 def purge_MRBUMP(amoptd):
     """Remove as much as possible from a MRBUMP directory whilst keeping valid results"""
     mkey = 'mrbump_dir'
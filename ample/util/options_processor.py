@@ -7,13 +7,15 @@ __version__ = "1.0"
 import glob
 import logging
 import os
-import shutil
 
 from ample.constants import AMPLE_PKL
 from ample.ensembler.constants import (
     SUBCLUSTER_RADIUS_THRESHOLDS,
     SIDE_CHAIN_TREATMENTS,
     ALLOWED_SIDE_CHAIN_TREATMENTS,
+    KMEDOIDS_RMSD,
+    KMEDOIDS_TM,
+    SPICKER_NUMPY,
     SPICKER_RMSD,
     SPICKER_TM,
     POLYALA,
@@ -21,7 +23,7 @@ from ample.ensembler.constants import (
     ALLATOM,
 )
 from ample.modelling import rosetta_model
-from ample.util import ample_util, contact_util, exit_util, mrbump_util, mtz_util, sequence_util
+from ample.util import ample_util, contact_util, exit_util, ledger_util, mrbump_util, mtz_util, sequence_util
 
 logger = logging.getLogger(__name__)
 
@@ -120,11 +122,8 @@ def process_ensemble_options(optd):
     # Ensemble options
     if optd['cluster_method'] in [SPICKER_RMSD, SPICKER_TM]:
         if not optd['spicker_exe']:
-            if optd['cluster_method'] == SPICKER_TM and optd['nproc'] > 1:
-                # We need to use the multicore version of SPICKER
-                optd['spicker_exe'] = 'spicker_omp' + ample_util.EXE_EXT
-            else:
-                optd['spicker_exe'] = 'spicker' + ample_util.EXE_EXT
+            # The TM-scores are calculated before spicker is run, so the multicore version isn't needed
+            optd['spicker_exe'] = 'spicker' + ample_util.EXE_EXT
         try:
             optd['spicker_exe'] = ample_util.find_exe(optd['spicker_exe'])
         except ample_util.FileNotFoundError:
@@ -138,7 +137,7 @@ def process_ensemble_options(optd):
             raise RuntimeError(
                 "Cannot find fast_protein_cluster executable: {0}".format(optd['fast_protein_cluster_exe'])
             )
-    elif optd['cluster_method'] in ['import', 'random', 'skip']:
+    elif optd['cluster_method'] in [SPICKER_NUMPY, KMEDOIDS_RMSD, KMEDOIDS_TM, 'import', 'random', 'skip']:
         pass
     else:
         raise RuntimeError("Unrecognised cluster_method: {0}".format(optd['cluster_method']))
@@ -228,6 +227,8 @@ def process_options(optd):
         raise RuntimeError(
             'Must use -submit_qtype argument to specify queueing system (e.g. QSUB, LSF ) if submitting to a cluster.'
         )
+    if optd['submit_cluster'] and optd.get('submit_broker'):
+        raise RuntimeError('Cannot use -submit_broker when submitting to a cluster with -submit_cluster.')
     try:
         optd['purge'] = int(optd['purge'])
     except (ValueError, KeyError):
@@ -526,26 +527,36 @@ def process_restart_options(optd):
         logger.info('Restart using benchmark mode')
 
     # We always check first to see if there are any mrbump jobs
+    mrbump_scripts = optd.get('mrbump_scripts') or []
     optd['mrbump_scripts'] = []
     if 'mrbump_dir' in optd:
-        optd['mrbump_scripts'] = mrbump_util.unfinished_scripts(optd)
+        job_states = ledger_util.job_states(optd.get('job_ledger'))
+        if any(s in job_states for s in mrbump_scripts):
+            # The job ledger tells us which jobs finished so we don't need to search the MRBUMP directories
+            logger.info('Using job ledger %s to find unfinished mrbump jobs', optd['job_ledger'])
+            optd['mrbump_scripts'] = [
+                s for s in mrbump_scripts if s not in job_states or job_states[s]['state'] != ledger_util.FINISHED
+            ]
+        else:
+            optd['mrbump_scripts'] = mrbump_util.unfinished_scripts(optd)
         if not optd['mrbump_scripts']:
             optd['do_mr'] = False
 
     if optd['do_mr']:
         if len(optd['mrbump_scripts']):
             logger.info('Restarting from unfinished mrbump scripts: %s', optd['mrbump_scripts'])
-            # Purge unfinished jobs
+            # MRBUMP cannot resume a job so unfinished jobs need to start again, but we move any partial
+            # results out of the way rather than deleting them
             for spath in optd['mrbump_scripts']:
                 directory, script = os.path.split(spath)
                 name, _ = os.path.splitext(script)
-                # Hack to delete old job directories
                 logfile = os.path.join(directory, name + '.log')
-                if os.path.isfile(logfile):
-                    os.unlink(logfile)
                 jobdir = os.path.join(directory, 'search_' + name + '_mrbump')
-                if os.path.isdir(jobdir):
-                    shutil.rmtree(jobdir)
+                for path in (logfile, jobdir):
+                    if os.path.exists(path):
+                        moved = _restart_path(path)
+                        logger.debug('Moving partial mrbump output %s to %s', path, moved)
+                        os.rename(path, moved)
         elif 'ensembles' in optd and optd['ensembles'] and len(optd['ensembles']):
             # Rerun from ensembles - check for data/ensembles are ok?
             logger.info('Restarting from existing ensembles: %s', optd['ensembles'])
@@ -572,6 +583,14 @@ def process_rosetta_options(optd):
     return rosetta_modeller
 
 
+def _restart_path(path):
+    """Return a path that does not exist to move the output of an unfinished job at path to"""
+    i = 1
+    while os.path.exists("{0}.restart{1}".format(path, i)):
+        i += 1
+    return "{0}.restart{1}".format(path, i)
+
+
 def restart_amoptd(optd):
     """Create an ample dictionary from a restart pkl file
 
@@ -150,10 +150,12 @@ class Rio(object):
             allAtom=True,
             maxDist=0.5,
         )
-        self.parseNcontLog(contactData)
+        return self._processAllAtom(contactData, self.ncontLog)
 
+    def _processAllAtom(self, contactData, logfile):
+        """Set the All Atom data from an ncont logfile"""
+        self.parseNcontLog(contactData, logfile=logfile)
         contactData.aaNumContacts = contactData.numContacts
-
         return contactData
 
     def calcRio(self, contactData):
@@ -171,11 +173,13 @@ class Rio(object):
         self.runNcont(
             pdbin=contactData.joinedPdb, sourceChains=contactData.fromChains, targetChains=contactData.toChains
         )
-        self.parseNcontLog(contactData)
-        self.analyseRio(contactData)
+        return self._processRio(contactData, self.ncontLog)
 
+    def _processRio(self, contactData, logfile):
+        """Set the RIO data from an ncont logfile"""
+        self.parseNcontLog(contactData, logfile=logfile)
+        self.analyseRio(contactData)
         contactData.rioNumContacts = contactData.numContacts
-
         return contactData
 
     def findOrigin(
@@ -201,9 +205,8 @@ class Rio(object):
         # The list of chains in the native that we will be checking contacts from
         fromChains = nativePdbInfo.models[0].chains
 
-        # Loop over origins, move the placed pdb to the new origin and then run ncont
-        # Object to hold data on best origin
-        self.data = None
+        # Loop over origins, move the placed pdb to the new origin and set up the data for ncont
+        origin_data = []
         for origin in origins:
             placedOriginPdb = placedAaPdb
             if origin != [0.0, 0.0, 0.0]:
@@ -225,21 +228,42 @@ class Rio(object):
             data.fromChains = fromChains
             data.toChains = toChains
             data.numGood = 0  # For holding the metric
+            origin_data.append(data)
 
-            # Run ncont
+        # Run ncont on all the origins at once
+        if allAtom:
+            inputs = [
+                self.ncontInput(
+                    pdbin=d.joinedPdb, sourceChains=fromChains, targetChains=toChains, allAtom=True, maxDist=0.5
+                )
+                for d in origin_data
+            ]
+        else:
+            inputs = [
+                self.ncontInput(pdbin=d.joinedPdb, sourceChains=fromChains, targetChains=toChains) for d in origin_data
+            ]
+        cmds, stdins, logfiles = zip(*inputs)
+        results = ample_util.run_commands(
+            list(cmds), stdins=list(stdins), logfiles=list(logfiles), directory=os.getcwd(), scratch=False
+        )
+
+        # Object to hold data on best origin
+        self.data = None
+        for data, cmd, logfile, result in zip(origin_data, cmds, logfiles, results):
+            if result.returncode != 0:
+                raise RuntimeError("Error running ncont command: {0}\nCheck log: {1}".format(cmd, logfile))
+            self.ncontLog = logfile
             if allAtom:
-                self.calcAllAtom(data)
+                self._processAllAtom(data, logfile)
                 data.numGood = data.aaNumContacts
             else:
-                self.calcRio(data)
+                self._processRio(data, logfile)
                 data.numGood = data.rioInRegister + data.rioOoRegister
 
             # Save the first origin and only update if we get a better score
             if not self.data or data.numGood > self.data.numGood:
                 self.data = data
 
-        # End loop over origins
-
         # Now need to calculate data for whichever one we didn't calculate
         if allAtom:
             self.calcRio(self.data)
@@ -369,13 +393,22 @@ class Rio(object):
         return (None, joinedChunk)
 
     def runNcont(self, pdbin=None, sourceChains=None, targetChains=None, maxDist=1.5, allAtom=False):
-        """FOO
-        """
+        """Run ncont to find the contacts between the source and target chains of pdbin"""
+        cmd, stdin, self.ncontLog = self.ncontInput(
+            pdbin=pdbin, sourceChains=sourceChains, targetChains=targetChains, maxDist=maxDist, allAtom=allAtom
+        )
+        retcode = ample_util.run_command(cmd=cmd, logfile=self.ncontLog, directory=os.getcwd(), dolog=True, stdin=stdin)
+
+        if retcode != 0:
+            raise RuntimeError("Error running ncont command: {0}\nCheck log: {1}".format(cmd, self.ncontLog))
+
+    def ncontInput(self, pdbin=None, sourceChains=None, targetChains=None, maxDist=1.5, allAtom=False):
+        """Return the command, stdin and logfile for running ncont"""
 
         if allAtom:
-            self.ncontLog = pdbin + ".ncont_aa.log"
+            logfile = pdbin + ".ncont_aa.log"
         else:
-            self.ncontLog = pdbin + ".ncont_rio.log"
+            logfile = pdbin + ".ncont_rio.log"
 
         cmd = ["ncont", "xyzin", pdbin]
 
@@ -391,11 +424,7 @@ class Rio(object):
         stdin += "maxdist {0}\n".format(maxDist)
         stdin += "cells 2\n"
         stdin += "sort target inc\n"
-
-        retcode = ample_util.run_command(cmd=cmd, logfile=self.ncontLog, directory=os.getcwd(), dolog=True, stdin=stdin)
-
-        if retcode != 0:
-            raise RuntimeError("Error running ncont command: {0}\nCheck log: {1}".format(cmd, self.ncontLog))
+        return cmd, stdin, logfile
 
     def parseNcontLog(self, contactData, logfile=None, clean_up=True):
         """
@@ -0,0 +1,446 @@
+"""Calculate CA RMSDs between models directly with NumPy
+
+The models are read into a single (nmodels, nresidues, 3) array of CA coordinates
+and the RMSD between every pair of models after optimal superposition is calculated
+in batches, so no external program is run for each pair.
+
+For two centred sets of coordinates X and Y the minimum RMSD over all rotations is::
+
+    rmsd**2 = (|X|**2 + |Y|**2 - 2 * lambda) / nresidues
+
+where lambda is the largest eigenvalue of the 4x4 key matrix built from the 3x3 covariance
+matrix X.T Y (equal to the sum of its singular values, with the smallest negated if the
+superposition would be a reflection). lambda is found as the largest root of the
+characteristic polynomial with Newton's method, following the quaternion characteristic
+polynomial (QCP) method of Theobald, Acta Cryst. (2005) A61, 478-480, which is much
+quicker than a singular value decomposition of every covariance matrix.
+
+When only the RMSDs under a cutoff are needed, as when subclustering under fixed radii, pairs of
+models that must be further apart are not superposed at all. As the superposition puts the centres
+of the two models together, and two points can be no closer than the difference of their distances
+from a common point, the RMSD is at least the root mean square difference of the distances of the CA
+atoms from the centres of their models. This fingerprint of each model is compared with a single
+matrix multiplication, so the pairs that can be skipped cost next to nothing to find.
+"""
+
+__author__ = "Jens Thomas"
+
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Number of rows of the distance matrix calculated at once - this limits the memory used by the covariance matrices
+BLOCK_SIZE = 64
+PAIRS_PER_ROW = 1024  # cross_rmsd calculates about BLOCK_SIZE * PAIRS_PER_ROW RMSDs at once
+QCP_TOLERANCE = 1e-11
+QCP_MAX_ITERATIONS = 50
+LOWER_BOUND_TOLERANCE = 1e-6  # Allowance for rounding in the lower bounds so that no pair under a cutoff is skipped
+
+
+def read_ca(pdb):
+    """Return the CA atoms of the first model in a pdb file
+
+    Returns
+    -------
+    tuple
+       A list of the (chain, resSeq, iCode) identifiers of the residues and an (nresidues, 3) array of
+       their CA coordinates
+    """
+    residues = []
+    coords = []
+    seen = set()
+    with open(pdb) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if not line.startswith('ATOM') or line[12:16].strip() != 'CA':
+                continue
+            residue = (line[21], line[22:26].strip(), line[26])
+            # Only take the first of any alternate conformations
+            if residue in seen:
+                continue
+            seen.add(residue)
+            residues.append(residue)
+            coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return residues, numpy.array(coords, dtype=numpy.float64).reshape(-1, 3)
+
+
+def read_residue_ca(pdb):
+    """Return the CA coordinates of every residue in the first chain of the first model of a pdb file
+
+    Residues are indexed in the same way as by :func:`ample.util.pdb_edit.select_residues`, so residues
+    with HETATM records are skipped. Residues without a CA atom are given NaN coordinates.
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       An (nresidues, 3) array of coordinates
+    """
+    coords = []
+    chain = None
+    residue = None
+    hetero = set()
+    with open(pdb) as f:
+        for line in f:
+            if line.startswith('ENDMDL') or (line.startswith('TER') and chain is not None):
+                break
+            if not line.startswith(('ATOM', 'HETATM')):
+                continue
+            if chain is None:
+                chain = line[21]
+            elif line[21] != chain:
+                break
+            resid = line[22:27]
+            if resid != residue:
+                residue = resid
+                coords.append([numpy.nan] * 3)
+            if line.startswith('HETATM'):
+                hetero.add(len(coords) - 1)
+            elif line[12:16].strip() == 'CA' and numpy.isnan(coords[-1][0]):
+                coords[-1] = [float(line[30:38]), float(line[38:46]), float(line[46:54])]
+    coords = [xyz for i, xyz in enumerate(coords) if i not in hetero]
+    return numpy.array(coords, dtype=numpy.float64).reshape(-1, 3)
+
+
+def residue_coordinates(pdbs):
+    """Return an (nmodels, nresidues, 3) array of the CA coordinates of every residue of each of the pdbs
+
+    This is used to cache the coordinates of a set of models with the same residues, such as a cluster of
+    ab initio decoys, so that any subset of the residues can be selected with :func:`select_residues`.
+    """
+    coords = [read_residue_ca(pdb) for pdb in pdbs]
+    if len(set(len(c) for c in coords)) != 1:
+        raise RuntimeError("The models do not all have the same number of residues")
+    return numpy.array(coords)
+
+
+def select_residues(coords, residues_idxs):
+    """Return the coordinates of the residues with indexes residues_idxs that have a CA in every model"""
+    selected = coords[:, residues_idxs]
+    return selected[:, ~numpy.isnan(selected).any(axis=(0, 2))]
+
+
+def ca_coordinates(pdbs):
+    """Return an (nmodels, nresidues, 3) array of the CA coordinates of the residues common to all the pdbs
+
+    The residues are in the order they appear in the first pdb.
+    """
+    if not len(pdbs):
+        raise RuntimeError("No models to read CA coordinates from")
+    models = [read_ca(pdb) for pdb in pdbs]
+    common = set(models[0][0])
+    for residues, _ in models[1:]:
+        common.intersection_update(residues)
+    if not common:
+        raise RuntimeError("The models have no CA atoms in common")
+    order = [r for r in models[0][0] if r in common]
+    if any(len(residues) != len(order) for residues, _ in models):
+        logger.debug("Using the %d CA atoms common to all %d models", len(order), len(pdbs))
+    coords = numpy.empty((len(pdbs), len(order), 3), dtype=numpy.float64)
+    for i, (residues, xyz) in enumerate(models):
+        index = dict((r, k) for k, r in enumerate(residues))
+        coords[i] = xyz[[index[r] for r in order]]
+    return coords
+
+
+def _centre(coords):
+    """Return coords centred on the origin and the sum of the squared coordinates of each model"""
+    coords = numpy.asarray(coords, dtype=numpy.float64)
+    centred = coords - coords.mean(axis=1)[:, numpy.newaxis, :]
+    return centred, numpy.einsum('ijk,ijk->i', centred, centred)
+
+
+def _columns(coords):
+    """Return the (nresidues, nmodels * 3) array that covariance multiplies by for coords"""
+    return numpy.ascontiguousarray(coords.transpose(1, 0, 2)).reshape(coords.shape[1], -1)
+
+
+def fingerprints(coords):
+    """Return the (nmodels, nresidues) array of the distances of the CA atoms from the centre of each model"""
+    centred, _ = _centre(coords)
+    return numpy.sqrt(numpy.einsum('ijk,ijk->ij', centred, centred))
+
+
+def lower_bounds(prints, others):
+    """Return lower bounds on the RMSDs between two sets of models from their :func:`fingerprints`
+
+    Parameters
+    ----------
+    prints : :obj:`numpy.ndarray`
+       An (nmodels, nresidues) array of fingerprints
+    others : :obj:`numpy.ndarray`
+       An (nothers, nresidues) array of fingerprints
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       An (nmodels, nothers) array of the root mean square differences between the fingerprints
+    """
+    sq_prints = numpy.einsum('ij,ij->i', prints, prints)
+    sq_others = numpy.einsum('ij,ij->i', others, others)
+    sq_diff = sq_prints[:, numpy.newaxis] + sq_others[numpy.newaxis, :] - 2.0 * prints.dot(others.T)
+    return numpy.sqrt(numpy.clip(sq_diff / prints.shape[1], 0.0, None))
+
+
+def covariance(block, others, others_columns=None):
+    """Return the (nblock, nothers, 3, 3) covariance matrices between each model in block and each model in others
+
+    This is a single matrix multiplication rather than an einsum, which is many times quicker. When the
+    covariances with the same others are calculated for many blocks, others_columns can be given to save
+    rearranging others each time.
+    """
+    nblock, nresidues, _ = block.shape
+    if others_columns is None:
+        others_columns = _columns(others)
+    h = block.transpose(0, 2, 1).reshape(nblock * 3, nresidues).dot(others_columns)
+    return h.reshape(nblock, 3, -1, 3).transpose(0, 2, 1, 3)
+
+
+def _max_eigenvalue(h, e0):
+    """Return the largest eigenvalue of the QCP key matrix of each covariance matrix in h
+
+    Parameters
+    ----------
+    h : :obj:`numpy.ndarray`
+       An array of 3x3 covariance matrices
+    e0 : :obj:`numpy.ndarray`
+       (|X|**2 + |Y|**2) / 2 for each covariance matrix, which is an upper bound on the eigenvalue
+       and the starting point of the Newton iterations
+
+    """
+    sxx, sxy, sxz = h[..., 0, 0], h[..., 0, 1], h[..., 0, 2]
+    syx, syy, syz = h[..., 1, 0], h[..., 1, 1], h[..., 1, 2]
+    szx, szy, szz = h[..., 2, 0], h[..., 2, 1], h[..., 2, 2]
+    sxx2, syy2, szz2 = sxx * sxx, syy * syy, szz * szz
+    sxy2, syz2, sxz2 = sxy * sxy, syz * syz, sxz * sxz
+    syx2, szy2, szx2 = syx * syx, szy * szy, szx * szx
+    syzszymsyyszz2 = 2.0 * (syz * szy - syy * szz)
+    sxx2syy2szz2syz2szy2 = syy2 + szz2 - sxx2 + syz2 + szy2
+    sxy2sxz2syx2szx2 = sxy2 + sxz2 - syx2 - szx2
+    sxzpszx, syzpszy, sxypsyx = sxz + szx, syz + szy, sxy + syx
+    syzmszy, sxzmszx, sxymsyx = syz - szy, sxz - szx, sxy - syx
+    sxxpsyy, sxxmsyy = sxx + syy, sxx - syy
+
+    # Coefficients of the characteristic polynomial x**4 + c2 * x**2 + c1 * x + c0
+    c2 = -2.0 * (sxx2 + syy2 + szz2 + sxy2 + syx2 + sxz2 + szx2 + syz2 + szy2)
+    c1 = 8.0 * (
+        sxx * syz * szy + syy * szx * sxz + szz * sxy * syx - sxx * syy * szz - syz * szx * sxy - szy * syx * sxz
+    )
+    c0 = (
+        sxy2sxz2syx2szx2 * sxy2sxz2syx2szx2
+        + (sxx2syy2szz2syz2szy2 + syzszymsyyszz2) * (sxx2syy2szz2syz2szy2 - syzszymsyyszz2)
+        + (-sxzpszx * syzmszy + sxymsyx * (sxxmsyy - szz)) * (-sxzmszx * syzpszy + sxymsyx * (sxxmsyy + szz))
+        + (-sxzpszx * syzpszy - sxypsyx * (sxxpsyy - szz)) * (-sxzmszx * syzmszy - sxypsyx * (sxxpsyy + szz))
+        + (sxypsyx * syzpszy + sxzpszx * (sxxmsyy + szz)) * (-sxymsyx * syzmszy + sxzpszx * (sxxpsyy + szz))
+        + (sxypsyx * syzmszy + sxzmszx * (sxxmsyy - szz)) * (-sxymsyx * syzpszy + sxzmszx * (sxxpsyy - szz))
+    )
+
+    eigenvalue = numpy.array(e0, dtype=numpy.float64)
+    for _ in range(QCP_MAX_ITERATIONS):
+        x2 = eigenvalue * eigenvalue
+        b = (x2 + c2) * eigenvalue
+        a = b + c1
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            delta = (a * eigenvalue + c0) / (2.0 * x2 * eigenvalue + b + a)
+        # Identical models give a zero derivative at the root, where we have already converged
+        delta[~numpy.isfinite(delta)] = 0.0
+        eigenvalue -= delta
+        if (numpy.abs(delta) <= QCP_TOLERANCE * numpy.abs(eigenvalue)).all():
+            break
+    return eigenvalue
+
+
+def rotations(h, e0):
+    """Return the rotation matrices that superpose the models of each covariance matrix in h
+
+    The rotation is found from the eigenvector of the largest eigenvalue of the QCP key matrix, which
+    is quicker than a singular value decomposition of each covariance matrix. For a covariance matrix
+    X.T Y of centred coordinates, X.dot(rotation) is superposed on Y.
+
+    Parameters
+    ----------
+    h : :obj:`numpy.ndarray`
+       An array of 3x3 covariance matrices
+    e0 : :obj:`numpy.ndarray`
+       (|X|**2 + |Y|**2) / 2 for each covariance matrix
+
+    """
+    eigenvalue = _max_eigenvalue(h, e0)
+    sxx, sxy, sxz = h[..., 0, 0], h[..., 0, 1], h[..., 0, 2]
+    syx, syy, syz = h[..., 1, 0], h[..., 1, 1], h[..., 1, 2]
+    szx, szy, szz = h[..., 2, 0], h[..., 2, 1], h[..., 2, 2]
+    # The key matrix less the eigenvalue, which is singular, so any row of its adjugate is the eigenvector
+    a11 = sxx + syy + szz - eigenvalue
+    a12 = a21 = syz - szy
+    a13 = a31 = szx - sxz
+    a14 = a41 = sxy - syx
+    a22 = sxx - syy - szz - eigenvalue
+    a23 = a32 = sxy + syx
+    a24 = a42 = szx + sxz
+    a33 = syy - sxx - szz - eigenvalue
+    a34 = a43 = syz + szy
+    a44 = szz - sxx - syy - eigenvalue
+    a3344_4334 = a33 * a44 - a43 * a34
+    a3244_4234 = a32 * a44 - a42 * a34
+    a3243_4233 = a32 * a43 - a42 * a33
+    a3143_4133 = a31 * a43 - a41 * a33
+    a3144_4134 = a31 * a44 - a41 * a34
+    a3142_4132 = a31 * a42 - a41 * a32
+    a1324_1423 = a13 * a24 - a14 * a23
+    a1224_1422 = a12 * a24 - a14 * a22
+    a1223_1322 = a12 * a23 - a13 * a22
+    a1124_1421 = a11 * a24 - a14 * a21
+    a1123_1321 = a11 * a23 - a13 * a21
+    a1122_1221 = a11 * a22 - a12 * a21
+    candidates = numpy.array(
+        [
+            [
+                a22 * a3344_4334 - a23 * a3244_4234 + a24 * a3243_4233,
+                -a21 * a3344_4334 + a23 * a3144_4134 - a24 * a3143_4133,
+                a21 * a3244_4234 - a22 * a3144_4134 + a24 * a3142_4132,
+                -a21 * a3243_4233 + a22 * a3143_4133 - a23 * a3142_4132,
+            ],
+            [
+                a12 * a3344_4334 - a13 * a3244_4234 + a14 * a3243_4233,
+                -a11 * a3344_4334 + a13 * a3144_4134 - a14 * a3143_4133,
+                a11 * a3244_4234 - a12 * a3144_4134 + a14 * a3142_4132,
+                -a11 * a3243_4233 + a12 * a3143_4133 - a13 * a3142_4132,
+            ],
+            [
+                a42 * a1324_1423 - a43 * a1224_1422 + a44 * a1223_1322,
+                -a41 * a1324_1423 + a43 * a1124_1421 - a44 * a1123_1321,
+                a41 * a1224_1422 - a42 * a1124_1421 + a44 * a1122_1221,
+                -a41 * a1223_1322 + a42 * a1123_1321 - a43 * a1122_1221,
+            ],
+            [
+                a32 * a1324_1423 - a33 * a1224_1422 + a34 * a1223_1322,
+                -a31 * a1324_1423 + a33 * a1124_1421 - a34 * a1123_1321,
+                a31 * a1224_1422 - a32 * a1124_1421 + a34 * a1122_1221,
+                -a31 * a1223_1322 + a32 * a1123_1321 - a33 * a1122_1221,
+            ],
+        ]
+    )
+    # Use the row that is furthest from zero, as any of them can vanish
+    sq_norms = (candidates ** 2).sum(axis=1)
+    best = numpy.argmax(sq_norms, axis=0)
+    q = numpy.take_along_axis(candidates, best[numpy.newaxis, numpy.newaxis], axis=0)[0]
+    norm = numpy.sqrt(numpy.take_along_axis(sq_norms, best[numpy.newaxis], axis=0)[0])
+    # If the models can't be oriented at all, don't rotate them
+    degenerate = norm == 0
+    q[0][degenerate] = 1.0
+    norm[degenerate] = 1.0
+    q1, q2, q3, q4 = q / norm
+    rotation = numpy.empty(h.shape)
+    rotation[..., 0, 0] = q1 * q1 + q2 * q2 - q3 * q3 - q4 * q4
+    rotation[..., 0, 1] = 2.0 * (q2 * q3 + q1 * q4)
+    rotation[..., 0, 2] = 2.0 * (q4 * q2 - q1 * q3)
+    rotation[..., 1, 0] = 2.0 * (q2 * q3 - q1 * q4)
+    rotation[..., 1, 1] = q1 * q1 - q2 * q2 + q3 * q3 - q4 * q4
+    rotation[..., 1, 2] = 2.0 * (q3 * q4 + q1 * q2)
+    rotation[..., 2, 0] = 2.0 * (q4 * q2 + q1 * q3)
+    rotation[..., 2, 1] = 2.0 * (q3 * q4 - q1 * q2)
+    rotation[..., 2, 2] = q1 * q1 - q2 * q2 - q3 * q3 + q4 * q4
+    return rotation
+
+
+def _block_rmsd(block, sq_block, others_columns, sq_others, candidates=None):
+    """Return the RMSDs between each model in block and each of the others, which must already be centred
+
+    If candidates is given, only the RMSDs of the pairs where it is True are calculated and returned as a
+    1D array. The covariance matrices are still all calculated as they are cheap compared with finding
+    the eigenvalues.
+    """
+    e0 = 0.5 * (sq_block[:, numpy.newaxis] + sq_others[numpy.newaxis, :])
+    h = covariance(block, None, others_columns=others_columns)
+    if candidates is not None:
+        h, e0 = h[candidates], e0[candidates]
+    eigenvalue = _max_eigenvalue(h, e0)
+    return numpy.sqrt(numpy.clip(2.0 * (e0 - eigenvalue) / block.shape[1], 0.0, None))
+
+
+def cross_rmsd(coords, others, block_size=BLOCK_SIZE):
+    """Return the RMSDs after Kabsch superposition between every model in coords and every model in others
+
+    Parameters
+    ----------
+    coords : :obj:`numpy.ndarray`
+       An (nmodels, nresidues, 3) array of coordinates
+    others : :obj:`numpy.ndarray`
+       An (nothers, nresidues, 3) array of coordinates
+    block_size : int, optional
+       The number of rows of the matrix to calculate at once
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       An (nmodels, nothers) array of RMSDs
+    """
+    centred, sq_norms = _centre(coords)
+    others, sq_others = _centre(others)
+    columns = _columns(others)
+    matrix = numpy.empty((len(centred), len(others)))
+    # Calculate about as many covariance matrices at once as pairwise_rmsd does for a thousand models
+    block_size = max(1, block_size * PAIRS_PER_ROW // max(len(others), 1))
+    for start in range(0, len(centred), block_size):
+        stop = min(start + block_size, len(centred))
+        matrix[start:stop] = _block_rmsd(centred[start:stop], sq_norms[start:stop], columns, sq_others)
+    return matrix
+
+
+def pairwise_rmsd(coords, block_size=BLOCK_SIZE, out=None, cutoff=None):
+    """Return the square matrix of RMSDs between every pair of models after Kabsch superposition
+
+    If a cutoff is given, pairs whose :func:`lower_bounds` are at or above it are not superposed and
+    their lower bound is used instead. Every RMSD under the cutoff is still exact and every other
+    distance is at least the cutoff, so the matrix can be clustered under any radius up to the cutoff.
+
+    Parameters
+    ----------
+    coords : :obj:`numpy.ndarray`
+       An (nmodels, nresidues, 3) array of coordinates
+    block_size : int, optional
+       The number of rows of the matrix to calculate at once
+    out : :obj:`ample.util.distance_matrix.CondensedDistanceMatrix`, optional
+       A matrix to put the RMSDs in rather than creating a square array
+    cutoff : float, optional
+       Only superpose the pairs of models that could have an RMSD under this
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       An (nmodels, nmodels) array of RMSDs, or out if it was given
+    """
+    centred, sq_norms = _centre(coords)
+    columns = _columns(centred)
+    nmodels = len(centred)
+    matrix = numpy.zeros((nmodels, nmodels)) if out is None else None
+    if cutoff is not None:
+        prints = fingerprints(centred)
+        nsuperposed = 0
+    for start in range(0, nmodels, block_size):
+        stop = min(start + block_size, nmodels)
+        # Only calculate the upper triangle of the matrix
+        args = (centred[start:stop], sq_norms[start:stop], columns[:, start * 3 :], sq_norms[start:])
+        if cutoff is None:
+            rmsds = _block_rmsd(*args)
+        else:
+            rmsds = lower_bounds(prints[start:stop], prints[start:])
+            candidates = rmsds < cutoff + LOWER_BOUND_TOLERANCE
+            rmsds[candidates] = _block_rmsd(*args, candidates=candidates)
+            nsuperposed += numpy.count_nonzero(numpy.triu(candidates, 1))
+        if out is None:
+            matrix[start:stop, start:] = rmsds
+        else:
+            for i in range(start, stop):
+                out.set_upper(i, rmsds[i - start, i - start + 1 :])
+    if cutoff is not None:
+        npairs = nmodels * (nmodels - 1) // 2
+        logger.debug("Superposed %d of %d pairs of models that could be under %.3f", nsuperposed, npairs, cutoff)
+    if out is not None:
+        return out
+    i_lower = numpy.tril_indices(nmodels, -1)
+    matrix[i_lower] = matrix.T[i_lower]
+    numpy.fill_diagonal(matrix, 0.0)
+    return matrix
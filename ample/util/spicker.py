@@ -3,17 +3,40 @@
 import glob
 import logging
 import os
-import re
 import shutil
 import sys
 
-from ample.util import ample_util
+import numpy
+
+from ample.util import ample_util, distance_matrix, rmsd_util, tmscore_util
 from ample.ensembler._ensembler import Cluster
 from ample.ensembler.constants import SPICKER_RMSD
 
 logger = logging.getLogger(__name__)
 
 
+# Number of lines of rep1.tra1 held in memory before they are written out
+WRITE_BUFFER_LINES = 50000
+
+
+def read_ca_records(pdb):
+    """Read the CA atoms of a pdb in a single pass
+
+    Returns
+    -------
+    tuple
+       A list of the (resSeq, resName) of each CA atom and a list of the (x, y, z) coordinate strings of each CA atom
+    """
+    residues = []
+    coords = []
+    with open(pdb) as f:
+        for line in f:
+            if line.startswith('ATOM') and line[12:16].strip() == 'CA':
+                residues.append((line[22:26].strip(), line[17:20].strip()))
+                coords.append((line[30:38].strip(), line[38:46].strip(), line[46:54].strip()))
+    return residues, coords
+
+
 class Spickerer(object):
     def __init__(self, spicker_exe=None, run_dir=None):
         """Initialise from a dictionary of options"""
@@ -29,25 +52,22 @@ class Spickerer(object):
         self.score_type = 'rmsd'
 
     def get_length(self, pdb):
-        pdb = open(pdb)
-        counter = 0
-        for line in pdb:
-            pdb_pattern = re.compile('^ATOM')
-            pdb_result = pdb_pattern.match(line)
-            if pdb_result:
-                atom = line[13:16]
-                if re.search('CA', atom):
-                    counter += 1
-        return str(counter)
-
-    def create_input_files(self, models, score_type='rmsd', score_matrix=None):
+        return str(len(read_ca_records(pdb)[0]))
+
+    def create_input_files(self, models, score_type='rmsd', score_matrix=None, coords=None, nproc=1):
         """
         jmht
         Create the input files required to run spicker
         (See notes in spicker.f FORTRAN file for a description of the required files)
+
+        Each model is only read once, or not at all if its CA coordinates are given in coords,
+        an (nmodels, nresidues, 3) array in the same order as models. With score_type 'tm' the
+        TM-scores are calculated on nproc processes.
         """
         if not len(models):
             raise RuntimeError("no models provided!")
+        if coords is not None and len(coords) != len(models):
+            raise RuntimeError("Have coordinates for {0} models but {1} models".format(len(coords), len(models)))
 
         if score_type:
             score_type = score_type.lower()
@@ -57,35 +77,49 @@ class Spickerer(object):
             if not (score_matrix and os.path.isfile(score_matrix)):
                 raise RuntimeError('Cannot find score_matrix: {0}'.format(score_matrix))
             logger.debug("Using score_matrix: {0}".format(score_matrix))
-            shutil.copy(score_matrix, os.path.join(self.run_dir, 'score.matrix'))
+            if distance_matrix.is_binary(score_matrix):
+                # Only spicker itself needs the text form of the matrix
+                matrix, index = distance_matrix.read(score_matrix, mmap=True)
+                if index and [os.path.basename(p) for p in index] != [os.path.basename(p) for p in models]:
+                    raise RuntimeError("The models in score_matrix {0} don't match the models".format(score_matrix))
+                distance_matrix.write_text(matrix, os.path.join(self.run_dir, 'score.matrix'))
+            else:
+                shutil.copy(score_matrix, os.path.join(self.run_dir, 'score.matrix'))
+        elif score_type == 'tm':
+            # The TM-scores are calculated here and read by spicker in the same way as any other score matrix
+            if coords is None:
+                coords = rmsd_util.ca_coordinates(models)
+            logger.debug("Calculating TM-scores between {0} models".format(len(models)))
+            matrix = distance_matrix.CondensedDistanceMatrix(len(models), diagonal=1.0)
+            tmscore_util.pairwise_tm(coords, step=tmscore_util.CLUSTER_STEP, out=matrix, nproc=nproc)
+            distance_matrix.write_text(matrix, os.path.join(self.run_dir, 'score.matrix'))
 
         # read_out - Input file for spicker with coordinates of the CA atoms for each of the PDB structures
         #
         # file_list - a list of the full path of all PDBs - used so we can loop through it and copy the selected
         # ones to the relevant directory after we have run spicker - the order of these must match the order
         # of the structures in the rep1.tra1 file
-        list_string = ''
-        counter = 0
+        sequence = None
+        buf = []
         with open('rep1.tra1', "w") as read_out, open('file_list', "w") as file_list:
-            for infile in models:
-                pdbname = os.path.basename(infile)
+            for counter, infile in enumerate(models, 1):
                 file_list.write(infile + '\n')
-                list_string = list_string + pdbname + '\n'
-                counter += 1
-                length = self.get_length(infile)
+                if coords is None:
+                    residues, xyz = read_ca_records(infile)
+                    if sequence is None:
+                        sequence = residues
+                else:
+                    xyz = ["{0:.3f}".format(x) for x in numpy.ravel(coords[counter - 1])]
+                    xyz = list(zip(xyz[0::3], xyz[1::3], xyz[2::3]))
+                length = str(len(xyz))
                 # 1st field is length, 2nd energy, 3rd & 4th don't seem to be used for anything
-                read_out.write('\t' + length + '\t926.917       ' + str(counter) + '       ' + str(counter) + '\n')
-                with open(infile) as read:
-                    # Write out the coordinates of the CA atoms
-                    for line in read:
-                        pattern = re.compile(
-                            '^ATOM\s*(\d*)\s*(\w*)\s*(\w*)\s*(\w)\s*(\d*)\s*(.\d*.\d*)\s*(.\d*.\d*)\s*(.\d*.\d*)\s*(.\d*.\d*)'
-                        )
-                        result = re.match(pattern, line)
-                        if result:
-                            split = re.split(pattern, line)
-                            if split[2] == 'CA':
-                                read_out.write('     ' + split[6] + '     ' + split[7] + '     ' + split[8] + '\n')
+                buf.append('\t' + length + '\t926.917       ' + str(counter) + '       ' + str(counter) + '\n')
+                # Write out the coordinates of the CA atoms
+                buf.extend('     {0}     {1}     {2}\n'.format(*x) for x in xyz)
+                if len(buf) >= WRITE_BUFFER_LINES:
+                    read_out.writelines(buf)
+                    buf = []
+            read_out.writelines(buf)
 
         # from spicker.f
         # *       'rmsinp'---Mandatory, length of protein & piece for RMSD calculation;
@@ -106,25 +140,29 @@ class Spickerer(object):
         # *                  par3: 1, closc from all decoys; -1, closc clustered decoys
         # *                  From second lines are the file names which contain coordinates
         # *                  of 3D structure decoys. All these files are mandatory
-        par2 = '-2' if score_type == 'tm' else '-1'
+        # TM-scores are read from score.matrix, so we always use the cutoff based on variation
         with open('tra.in', "w") as tra:
-            tra.write('1 {0} 1 \nrep1.tra1\n'.format(par2))
+            tra.write('1 -1 1 \nrep1.tra1\n')
 
         # Create the file with the sequence of the PDB structures
         # from spicker.f
         # *       'seq.dat'--Mandatory, sequence file, for output of PDB models.
-        with open('seq.dat', "w") as seq, open(models[0], 'r') as a_pdb:
-            for line in a_pdb:
-                pattern = re.compile('^ATOM\s*(\d*)\s*(\w*)\s*(\w*)\s*(\w)\s*(\d*)\s*(\d*)\s')
-                result = re.match(pattern, line)
-                if result:
-                    split = re.split(pattern, line)
-                    if split[2] == 'CA':
-                        seq.write('\t' + split[5] + '\t' + split[3] + '\n')
+        if sequence is None:
+            sequence = read_ca_records(models[0])[0]
+        with open('seq.dat', "w") as seq:
+            seq.writelines('\t' + resseq + '\t' + resname + '\n' for resseq, resname in sequence)
         return
 
     def cluster(
-        self, models, num_clusters=10, max_cluster_size=200, run_dir=None, score_type='rmsd', score_matrix=None, nproc=1
+        self,
+        models,
+        num_clusters=10,
+        max_cluster_size=200,
+        run_dir=None,
+        score_type='rmsd',
+        score_matrix=None,
+        nproc=1,
+        coords=None,
     ):
         """Cluster decoys using spicker
 
@@ -148,6 +186,8 @@ class Spickerer(object):
            The number of processors to use
         score_matrix : str, optional
            The path to the score matrix to be used
+        coords : :obj:`numpy.ndarray`, optional
+           An (nmodels, nresidues, 3) array of the CA coordinates of the models if they have already been read
 
         Returns
         -------
@@ -159,7 +199,9 @@ class Spickerer(object):
         RuntimeError
            No clusters returned by SPICKER
         """
-        self._cluster(models, run_dir=run_dir, score_type=score_type, score_matrix=score_matrix, nproc=nproc)
+        self._cluster(
+            models, run_dir=run_dir, score_type=score_type, score_matrix=score_matrix, nproc=nproc, coords=coords
+        )
 
         ns_clusters = len(self.results)
         if ns_clusters == 0:
@@ -191,7 +233,7 @@ class Spickerer(object):
 
         return clusters
 
-    def _cluster(self, models, run_dir=None, score_type='rmsd', score_matrix=None, nproc=1):
+    def _cluster(self, models, run_dir=None, score_type='rmsd', score_matrix=None, nproc=1, coords=None):
         """
         Run spicker to cluster the models
         """
@@ -208,13 +250,11 @@ class Spickerer(object):
         logger.debug("Using executable: {0} on {1} processors".format(self.spicker_exe, nproc))
 
         self.score_type = score_type
-        self.create_input_files(models, score_type=score_type, score_matrix=score_matrix)
+        self.create_input_files(models, score_type=score_type, score_matrix=score_matrix, coords=coords, nproc=nproc)
 
-        # We need special care if we are running with tm scores as we will be using the OPENMP
-        # version of spicker which requires increasing the stack size on linux and setting the
-        # OMP_NUM_THREADS environment variable on all platforms
-        # The stack size on 64-bit linux seems to be 15Mb, so I guess asking for 50 seems reasonable
-        # I'm assuming that the limit is in bytes and specified by an integer so 50Mb -> 50000000
+        # Any TM-scores have already been calculated and written to score.matrix, so spicker only clusters.
+        # OMP_NUM_THREADS is still set in case spicker is an OPENMP build, and the stack size is raised on
+        # linux as its large arrays can overflow the default (15Mb on 64-bit). The limit is in bytes.
         preexec_fn = None
         env = {'OMP_NUM_THREADS': str(nproc)}
         if sys.platform.lower().startswith('linux'):
@@ -0,0 +1,222 @@
+"""Cluster decoys with the SPICKER algorithm directly with NumPy
+
+This follows the RMSD clustering of SPICKER 2.0 (scripts/spicker.f) with the cutoff based on the
+variation of the RMSDs, which is what AMPLE runs SPICKER with, but works on an (nmodels, nresidues, 3)
+array of CA coordinates in memory rather than writing the decoys out for the spicker executable and
+reading its str.txt file back.
+
+SPICKER first picks an RMSD cutoff, starting from half the mean of all the pairwise RMSDs and moving it
+down in steps of 0.1 while the largest cluster contains more than 70% of the decoys and up in steps of
+0.2 while it contains fewer than 15%. Clusters are then picked in turn: the centre of each cluster is the
+decoy with the most unclustered decoys under the cutoff and the cluster is every decoy under the cutoff
+to it, including any that are in earlier clusters. As with SPICKER the cutoff arithmetic is done in single
+precision so that the cutoff, and so the clusters, match those of the executable.
+
+Reference: Y Zhang, J Skolnick, Journal of Computational Chemistry, 2004 25: 865-871
+"""
+
+__author__ = "Jens Thomas"
+
+import logging
+
+import numpy
+
+from ample.ensembler._ensembler import Cluster
+from ample.ensembler.constants import SPICKER_RMSD
+from ample.util import distance_matrix, rmsd_util
+
+logger = logging.getLogger(__name__)
+
+# These are the parameters used by SPICKER
+MAX_CLUSTERS = 10
+RATIO_MAX = 0.7  # The cutoff is reduced while the largest cluster contains more than this fraction of the decoys
+RATIO_MIN = 0.15  # The cutoff is increased while the largest cluster contains less than this fraction of the decoys
+CUTOFF_MIN = 2.0
+CUTOFF_DOWN = 0.1
+CUTOFF_UP = 0.2
+R_CEN_DECIMALS = 3  # SPICKER writes the distances to the cluster centre to 3 decimal places
+
+_f32 = numpy.float32
+
+
+def rmsd_cutoff(matrix, index=None):
+    """Return the RMSD cutoff that SPICKER would use to cluster the decoys in a distance matrix
+
+    Parameters
+    ----------
+    matrix : :obj:`ample.util.distance_matrix.CondensedDistanceMatrix`
+       The RMSDs between the decoys
+    index : :obj:`ample.util.distance_matrix.RadiusIndex`, optional
+       The radius index of the matrix if it has already been created
+
+    Returns
+    -------
+    :obj:`numpy.float32`
+       The RMSD cutoff
+    """
+    n = matrix.n
+    index = index or distance_matrix.RadiusIndex(matrix)
+    # SPICKER includes the distance of each decoy to itself in the statistics
+    npairs = n * (n + 1) // 2
+    data = numpy.asarray(matrix.data, dtype=numpy.float64)
+    rmsd_a = (data.sum() + n * matrix.diagonal) / npairs
+    rmsd2_a = (numpy.dot(data, data) + n * matrix.diagonal ** 2) / npairs
+    rmsd_delta = _f32(numpy.sqrt(max(rmsd2_a - rmsd_a ** 2, 0.0)))
+
+    initial = _f32(rmsd_a * 0.5)
+    if initial < CUTOFF_MIN:
+        initial = _f32(CUTOFF_MIN)
+    cut_min = _f32(initial - _f32(0.8) * rmsd_delta)
+    cut_max = _f32(initial + _f32(0.8) * rmsd_delta)
+    if cut_min < 1:
+        cut_min = _f32(1.0)
+
+    cut = initial
+    seen = set()
+    while cut not in seen:
+        # SPICKER can oscillate between two cutoffs forever, so we stop if we get back to one we've tried
+        seen.add(cut)
+        ratio = _f32(index.counts_below(cut).max()) / _f32(n)
+        if ratio > _f32(RATIO_MAX) and cut > cut_min:
+            cut = _f32(cut - _f32(CUTOFF_DOWN))
+        elif ratio < _f32(RATIO_MIN) and cut < cut_max:
+            cut = _f32(cut + _f32(CUTOFF_UP))
+        else:
+            break
+    logger.debug("SPICKER cutoffs: initial %.3f min %.3f max %.3f selected %.3f", initial, cut_min, cut_max, cut)
+    return min(max(cut, cut_min), cut_max)
+
+
+def spicker(matrix, max_clusters=MAX_CLUSTERS, cutoff=None):
+    """Cluster the decoys in a distance matrix with the SPICKER algorithm
+
+    Parameters
+    ----------
+    matrix : :obj:`ample.util.distance_matrix.CondensedDistanceMatrix`
+       The RMSDs between the decoys
+    max_clusters : int, optional
+       The maximum number of clusters to pick
+    cutoff : float, optional
+       The RMSD cutoff [default: chosen as by SPICKER with :func:`rmsd_cutoff`]
+
+    Returns
+    -------
+    list
+       A (centre, members, r_cen) tuple for each cluster, where members are the indices of all the decoys in
+       the cluster in the order SPICKER lists them and r_cen their distances from the centre
+    """
+    index = distance_matrix.RadiusIndex(matrix)
+    cut = _f32(cutoff) if cutoff is not None else rmsd_cutoff(matrix, index=index)
+    unclustered = numpy.ones(matrix.n, dtype=bool)
+    # The number of unclustered decoys under the cutoff to each decoy
+    near = index.counts_below(cut)
+    clusters = []
+    for _ in range(max_clusters):
+        counts = numpy.where(unclustered, near, 0)
+        centre = int(numpy.argmax(counts))
+        if counts[centre] < 1:
+            break
+        row = matrix.row(centre)
+        members = numpy.where(row < cut)[0]
+        for m in members[unclustered[members]]:
+            unclustered[m] = False
+            near -= matrix.row(m) < cut
+        clusters.append((centre, members.tolist(), row[members].tolist()))
+    return clusters
+
+
+class Spickerer(object):
+    """Cluster decoys as :obj:`ample.util.spicker.Spickerer` does, but without running the spicker executable
+
+    The results are the same :obj:`ample.ensembler._ensembler.Cluster` objects, with the models of each cluster
+    ordered by their distance from the cluster centre, so that the centre is the centroid of the cluster.
+    """
+
+    def __init__(self):
+        self.results = None
+        self.cluster_method = SPICKER_RMSD
+        self.score_type = 'rmsd'
+
+    def cluster(self, models, num_clusters=MAX_CLUSTERS, max_cluster_size=200, coords=None, **kwargs):
+        """Cluster decoys with the SPICKER algorithm
+
+        Parameters
+        ----------
+        models : list
+           A list containing structure decoys
+        num_clusters : int
+           The number of clusters to produce
+        max_cluster_size : int
+           The maximum number of decoys per cluster
+        coords : :obj:`numpy.ndarray`, optional
+           An (nmodels, nresidues, 3) array of the CA coordinates of the models, which are read from the models
+           if not given
+
+        Returns
+        -------
+        list
+           A list containing the clusters
+
+        Raises
+        ------
+        RuntimeError
+           No clusters found
+        """
+        if not len(models):
+            raise RuntimeError("no models provided!")
+        if kwargs.get('score_type', 'rmsd') != 'rmsd':
+            raise RuntimeError("Can only cluster with RMSDs, not: {0}".format(kwargs['score_type']))
+        if coords is None:
+            coords = rmsd_util.ca_coordinates(models)
+        if len(coords) != len(models):
+            raise RuntimeError("Have coordinates for {0} models but {1} models".format(len(coords), len(models)))
+        matrix = rmsd_util.pairwise_rmsd(coords, out=distance_matrix.CondensedDistanceMatrix(len(models)))
+        self.results = self.make_clusters(models, spicker(matrix, max_clusters=max(MAX_CLUSTERS, num_clusters)))
+
+        ns_clusters = len(self.results)
+        if ns_clusters == 0:
+            raise RuntimeError('No clusters found by SPICKER')
+        if ns_clusters < int(num_clusters):
+            logger.critical(
+                'Requested {0} clusters but SPICKER only found {1} so using {1} clusters'.format(
+                    num_clusters, ns_clusters
+                )
+            )
+            num_clusters = ns_clusters
+
+        clusters = []
+        for cluster in self.results[0:num_clusters]:
+            cluster.models = cluster.models[0:max_cluster_size]
+            cluster.r_cen = cluster.r_cen[0:max_cluster_size]
+            clusters.append(cluster)
+        return clusters
+
+    def make_clusters(self, models, spicker_clusters):
+        """Return a :obj:`ample.ensembler._ensembler.Cluster` for each cluster returned by :func:`spicker`"""
+        results = []
+        for i, (centre, members, r_cen) in enumerate(spicker_clusters):
+            result = Cluster()
+            result.cluster_method = self.cluster_method
+            result.cluster_score_type = self.score_type
+            result.index = i + 1
+            result.num_clusters = len(spicker_clusters)
+            # As with the str.txt file, sort by the distance from the centre to 3 decimal places, which
+            # leaves identical distances in the order of the models
+            r_cen = [round(r, R_CEN_DECIMALS) for r in r_cen]
+            for idx, rcen in sorted(zip(members, r_cen), key=lambda tup: tup[1]):
+                result.models.append(models[idx])
+                result.r_cen.append(rcen)
+            results.append(result)
+        return results
+
+    def results_summary(self):
+        """Summarise the spicker results"""
+        if not self.results:
+            raise RuntimeError("Could not find any results!")
+        rstr = "---- Spicker Results ----\n\n"
+        for i, r in enumerate(self.results):
+            rstr += "Cluster: {0}\n".format(i + 1)
+            rstr += "* number of models: {0}\n".format(r.size)
+            rstr += "* centroid model is: {0}\n".format(r.centroid)
+            rstr += "\n"
+        return rstr
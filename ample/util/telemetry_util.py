@@ -0,0 +1,177 @@
+"""Record the resources used by the external programs that AMPLE runs
+
+Every command run with :func:`ample.util.ample_util.run_command` is timed and
+the resources it used are taken from the rusage of the child process. If a
+telemetry file has been set with :func:`enable`, a record for each command is
+appended to it as a line of JSON, so the file can be read while the job is
+running and appended to safely by several processes.
+
+The file and the current stage of the run are held in environment variables
+so that they are inherited by any AMPLE processes we start.
+"""
+
+import errno
+import os
+import sys
+import time
+
+from ample.util import jsonl_util, printTable
+
+TELEMETRY_FILE = 'telemetry.jsonl'
+TELEMETRY_FILE_ENV = 'AMPLE_TELEMETRY_FILE'
+TELEMETRY_STAGE_ENV = 'AMPLE_TELEMETRY_STAGE'
+SCRIPT_TOOL = 'script'  # The tool name given to all job scripts
+
+
+def enable(path):
+    """Write telemetry records to the file path"""
+    jsonl_util.enable(TELEMETRY_FILE_ENV, path)
+
+
+def environment():
+    """Return a dictionary of the environment variables that control telemetry"""
+    return {k: os.environ[k] for k in (TELEMETRY_FILE_ENV, TELEMETRY_STAGE_ENV) if k in os.environ}
+
+
+def set_stage(stage):
+    """Set the stage of the run that subsequent records belong to"""
+    os.environ[TELEMETRY_STAGE_ENV] = stage
+
+
+def wait(process):
+    """Wait for a :obj:`subprocess.Popen` process to finish
+
+    Returns
+    -------
+    tuple
+       The return code of the process and its :obj:`resource.struct_rusage` or None if
+       the platform does not support it
+    """
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return process.returncode, None
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            elif e.errno == errno.ECHILD:
+                # Someone else has already reaped the process
+                process.wait()
+                return process.returncode, None
+            raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+
+def record(cmd, returncode, start, rusage=None, logfile=None, directory=None):
+    """Append a record for a finished command to the telemetry file if one has been set
+
+    Parameters
+    ----------
+    cmd : list
+       The command that was run
+    returncode : int
+       The return code of the command
+    start : float
+       The time the command started
+    rusage : :obj:`resource.struct_rusage`, optional
+       The resources used by the command
+    logfile : str, optional
+       The file the output of the command was written to
+    directory : str, optional
+       The directory the command was run in
+
+    """
+    path = os.environ.get(TELEMETRY_FILE_ENV)
+    if not path:
+        return
+    tool = os.path.basename(cmd[0])
+    if os.path.splitext(tool)[1] in ('.sh', '.bat'):
+        tool = SCRIPT_TOOL
+    data = {
+        'tool': tool,
+        'cmd': " ".join(cmd),
+        'stage': os.environ.get(TELEMETRY_STAGE_ENV),
+        'directory': directory,
+        'start': start,
+        'wall_time': time.time() - start,
+        'returncode': returncode,
+        'output_bytes': os.path.getsize(logfile) if logfile and os.path.isfile(logfile) else None,
+        'user_time': None,
+        'system_time': None,
+        'max_rss_kb': None,
+    }
+    if rusage:
+        data['user_time'] = rusage.ru_utime
+        data['system_time'] = rusage.ru_stime
+        # ru_maxrss is in bytes on OSX and kilobytes elsewhere
+        data['max_rss_kb'] = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+    jsonl_util.append(path, data)
+
+
+def read(path=None):
+    """Return the list of records in a telemetry file"""
+    return jsonl_util.read(path or os.environ.get(TELEMETRY_FILE_ENV))
+
+
+def summarise(records):
+    """Total up the records for each stage and tool
+
+    Returns
+    -------
+    list
+       A list of dictionaries with the totals, in the order the stages and tools were first run
+    """
+    totals = {}
+    order = []
+    for r in records:
+        key = (r.get('stage') or 'unknown', r['tool'])
+        if key not in totals:
+            order.append(key)
+            totals[key] = {
+                'stage': key[0],
+                'tool': key[1],
+                'count': 0,
+                'failed': 0,
+                'wall_time': 0.0,
+                'cpu_time': 0.0,
+                'max_rss_kb': 0,
+                'output_bytes': 0,
+            }
+        t = totals[key]
+        t['count'] += 1
+        if r.get('returncode') != 0:
+            t['failed'] += 1
+        t['wall_time'] += r.get('wall_time') or 0.0
+        t['cpu_time'] += (r.get('user_time') or 0.0) + (r.get('system_time') or 0.0)
+        t['max_rss_kb'] = max(t['max_rss_kb'], r.get('max_rss_kb') or 0)
+        t['output_bytes'] += r.get('output_bytes') or 0
+    return [totals[key] for key in order]
+
+
+def summary(path=None):
+    """Return a string with a table summarising the telemetry file for each stage and tool"""
+    totals = summarise(read(path))
+    if not totals:
+        return ""
+    table = [['Stage', 'Tool', 'Runs', 'Failed', 'Wall (s)', 'CPU (s)', 'Max RSS (MB)', 'Output (MB)']]
+    for t in totals:
+        table.append(
+            [
+                t['stage'],
+                t['tool'],
+                str(t['count']),
+                str(t['failed']),
+                "{0:.1f}".format(t['wall_time']),
+                "{0:.1f}".format(t['cpu_time']),
+                "{0:.1f}".format(t['max_rss_kb'] / 1024.0),
+                "{0:.1f}".format(t['output_bytes'] / (1024.0 * 1024.0)),
+            ]
+        )
+    return "Resources used by external programs:\n\n" + printTable.Table().pprint_table(table)
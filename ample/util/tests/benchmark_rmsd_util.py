@@ -0,0 +1,72 @@
+"""Benchmark util.rmsd_util.pairwise_rmsd with a cutoff against the exhaustive calculation
+
+Perturbed copies of the test decoys are made so that there are enough models for the timings to mean
+something. For each cutoff the time taken with and without the cutoff is printed, along with the recall:
+the fraction of the pairs under the cutoff whose RMSD is found exactly, which should always be 1.
+
+Run with: ccp4-python -m ample.util.tests.benchmark_rmsd_util -nmodels 2000 -cutoffs 1 3
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy
+
+from ample import constants
+from ample.util import rmsd_util
+
+
+def perturbed_decoys(coords, nmodels, noise=0.5, nresidues=None, seed=1):
+    """Return nmodels copies of the models in coords, each with random noise added to the coordinates"""
+    rng = numpy.random.RandomState(seed)
+    copies = coords[rng.randint(len(coords), size=nmodels)]
+    if nresidues:
+        copies = copies[:, :nresidues]
+    return copies + rng.normal(scale=noise, size=copies.shape)
+
+
+def benchmark(coords, cutoffs):
+    """Return the time of the exhaustive calculation and a (cutoff, time, pairs under cutoff, recall) for each cutoff"""
+    start = time.time()
+    exact = rmsd_util.pairwise_rmsd(coords)
+    exact_time = time.time() - start
+    upper = numpy.triu_indices(len(coords), 1)
+    results = []
+    for cutoff in cutoffs:
+        start = time.time()
+        pruned = rmsd_util.pairwise_rmsd(coords, cutoff=cutoff)
+        elapsed = time.time() - start
+        under = exact[upper] < cutoff
+        found = numpy.isclose(pruned[upper], exact[upper], atol=1e-5)
+        recall = found[under].mean() if under.any() else 1.0
+        results.append((cutoff, elapsed, int(under.sum()), recall))
+    return exact_time, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('-nmodels', type=int, default=2000, help="The number of perturbed decoys")
+    parser.add_argument('-nresidues', type=int, help="Only use the first nresidues residues of each decoy")
+    parser.add_argument('-noise', type=float, default=0.5, help="The standard deviation of the noise in Angstroms")
+    parser.add_argument('-cutoffs', type=float, nargs='+', default=[1.0, 3.0])
+    args = parser.parse_args(argv)
+
+    models = sorted(glob.glob(os.path.join(constants.SHARE_DIR, 'testfiles', 'models', '*.pdb')))
+    coords = perturbed_decoys(rmsd_util.ca_coordinates(models), args.nmodels, args.noise, args.nresidues)
+    exact_time, results = benchmark(coords, args.cutoffs)
+    print("{0} models of {1} residues".format(*coords.shape[:2]))
+    print("exhaustive: {0:.2f}s".format(exact_time))
+    for cutoff, elapsed, nunder, recall in results:
+        print(
+            "cutoff {0:.2f}: {1:.2f}s, {2} pairs under the cutoff, recall {3:.4f}".format(
+                cutoff, elapsed, nunder, recall
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@
 
 import pickle
 import os
+import sys
 import unittest
 from ample.util import ample_util
 from ample.constants import AMPLE_PKL, SHARE_DIR
@@ -49,6 +50,58 @@ class Test(unittest.TestCase):
         for f in files:
             os.unlink(f)
 
+    def test_run_commands(self):
+        cmds = [
+            [sys.executable, '-c', 'import sys; open("out", "w").close(); print({0}); sys.exit({0} % 2)'.format(i)]
+            for i in range(6)
+        ]
+        results = ample_util.run_commands(cmds, nproc=3)
+        self.assertEqual([r.returncode for r in results], [0, 1, 0, 1, 0, 1])
+        self.assertEqual([r.output.strip() for r in results], [str(i) for i in range(6)])
+        self.assertTrue(all(r.directory is None for r in results))
+
+        results = ample_util.run_commands(cmds[:2], keep_scratch=True)
+        for r in results:
+            # Each command ran in its own directory
+            self.assertTrue(os.path.isfile(os.path.join(r.directory, 'out')))
+        self.assertNotEqual(results[0].directory, results[1].directory)
+        for r in results:
+            os.unlink(os.path.join(r.directory, 'out'))
+            os.rmdir(r.directory)
+
+        stdin = 'hello'
+        cmd = [sys.executable, '-c', 'import sys; print(sys.stdin.read())']
+        self.assertEqual(ample_util.run_commands([cmd], stdins=[stdin])[0].output.strip(), stdin)
+
+    def test_run_commands_timeout(self):
+        cmd = [sys.executable, '-c', 'import time; time.sleep(30)']
+        result = ample_util.run_commands([cmd], timeout=1)[0]
+        self.assertTrue(result.timed_out)
+        self.assertNotEqual(result.returncode, 0)
+
+    def test_run_command_timeout(self):
+        cmd = [sys.executable, '-c', 'import time; time.sleep(30)']
+        with self.assertRaises(ample_util.CommandTimeoutError):
+            ample_util.run_command(cmd, logfile=os.devnull, timeout=1)
+
+        # Timeouts can be set for each program
+        ample_util.set_tool_timeouts([os.path.basename(sys.executable) + '=1'])
+        try:
+            self.assertEqual(ample_util.tool_timeout(cmd), 1)
+            with self.assertRaises(ample_util.CommandTimeoutError):
+                ample_util.run_command(cmd, logfile=os.devnull)
+            self.assertEqual(ample_util.run_command([sys.executable, '-c', 'pass'], logfile=os.devnull), 0)
+        finally:
+            ample_util.set_tool_timeouts(None)
+        with self.assertRaises(RuntimeError):
+            ample_util.set_tool_timeouts(['theseus:100'])
+
+    @unittest.skipUnless(hasattr(os, 'setsid'), "No process groups on this platform")
+    def test_run_command_timeout_setsid(self):
+        # The job scripts of the workers are already run with setsid
+        cmd = [sys.executable, '-c', 'pass']
+        self.assertEqual(ample_util.run_command(cmd, logfile=os.devnull, timeout=30, preexec_fn=os.setsid), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,91 @@
+"""Test functions for util.broker"""
+
+import multiprocessing
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from ample.util import ample_util, broker
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.wdir, 'broker.sock')
+        self.authkey_file = os.path.join(self.wdir, broker.AUTHKEY_FILE)
+        self.broker = broker.get_broker(self.address, nproc=2, authkey_file=self.authkey_file)
+        self.workers = []
+
+    def tearDown(self):
+        broker.shutdown_broker()
+        for process in self.workers:
+            process.join(10)
+        shutil.rmtree(self.wdir)
+
+    def startWorker(self, nproc):
+        args = (self.address, broker.read_authkey(self.authkey_file), nproc)
+        process = multiprocessing.Process(target=broker.run_worker, args=args)
+        process.start()
+        self.workers.append(process)
+
+    def makeScript(self, name, body):
+        script = os.path.join(self.wdir, name + ample_util.SCRIPT_EXT)
+        with open(script, 'w') as f:
+            f.write(ample_util.SCRIPT_HEADER + os.linesep + body + os.linesep)
+        os.chmod(script, stat.S_IRWXU)
+        return script
+
+    @unittest.skipUnless(hasattr(os, 'fchmod'), "No file modes on this platform")
+    def test_new_authkey(self):
+        # A key left by an earlier run that others could read is made private
+        os.chmod(self.authkey_file, 0o644)
+        authkey = broker.new_authkey(self.authkey_file)
+        self.assertEqual(stat.S_IMODE(os.stat(self.authkey_file).st_mode), 0o600)
+        self.assertEqual(broker.read_authkey(self.authkey_file), authkey)
+
+    def test_run_scripts(self):
+        self.startWorker(2)
+        self.startWorker(1)
+        scripts = [self.makeScript("job_{0}".format(i), "sleep 1; exit {0}".format(i % 2)) for i in range(6)]
+        futures = [self.broker.submit(s) for s in scripts]
+        self.assertEqual([f.result(timeout=60) for f in futures], [0, 1, 0, 1, 0, 1])
+        self.assertTrue(os.path.isfile(os.path.join(self.wdir, "job_0.log")))
+        self.assertEqual(len(set(f.worker for f in futures)), 2)
+
+    def test_kill(self):
+        self.startWorker(1)
+        slow = self.broker.submit(self.makeScript("slow", "sleep 30"))
+        while not slow.running():
+            time.sleep(0.1)
+        start = time.time()
+        self.assertTrue(slow.kill())
+        slow.result(timeout=30)
+        self.assertTrue(slow.cancelled())
+        self.assertLess(time.time() - start, 10)
+
+    def test_lost_worker(self):
+        self.startWorker(1)
+        future = self.broker.submit(self.makeScript("job_0", "sleep 2; exit 0"))
+        while not future.running():
+            time.sleep(0.1)
+        lost = future.worker
+        self.workers[0].terminate()
+        # The job goes back in the queue rather than failing and is run by the next worker
+        self.startWorker(1)
+        self.assertEqual(future.result(timeout=60), 0)
+        self.assertNotEqual(future.worker, lost)
+
+    def test_stop(self):
+        self.startWorker(1)
+        future = self.broker.submit(self.makeScript("job_0", "exit 0"))
+        self.assertEqual(future.result(timeout=60), 0)
+        broker.shutdown_broker()
+        self.workers[0].join(10)
+        self.assertFalse(self.workers[0].is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
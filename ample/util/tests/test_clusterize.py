@@ -1,7 +1,11 @@
 import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from ample.util import ample_util, clusterize
+from ample.testing import fake_scheduler
+from ample.util import ample_util, clusterize, workers_util
 
 
 def on_cluster():
@@ -37,5 +41,66 @@ echo "I am script {0}"
         c.cleanUpArrayJob()
 
 
+class TestFakeScheduler(unittest.TestCase):
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.path = os.environ['PATH']
+        self.poll_min = clusterize.POLL_MIN
+        os.environ['PATH'] = fake_scheduler.install(self.wdir) + os.pathsep + self.path
+        os.chdir(self.wdir)
+        clusterize.POLL_MIN = 0.2
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ['PATH'] = self.path
+        clusterize.POLL_MIN = self.poll_min
+        shutil.rmtree(self.wdir)
+
+    def makeScripts(self, njobs):
+        scripts = []
+        for i in range(njobs):
+            script = os.path.join(self.wdir, "script_{0}.sh".format(i))
+            with open(script, 'w') as f:
+                f.write("#!/bin/bash\necho \"I am script {0}\"\nexit {1}\n".format(i, i % 2))
+            os.chmod(script, 0o777)
+            scripts.append(script)
+        return scripts
+
+    def _test_array(self, qtype):
+        scripts = self.makeScripts(4)
+        c = clusterize.ClusterRun()
+        c.QTYPE = qtype
+        c.submitArrayJob(scripts, job_name="array", submit_max_array=2, submit_qtype=qtype)
+        c.monitorQueue()
+        c.cleanUpArrayJob()
+        for i, script in enumerate(scripts):
+            with open(script + clusterize.DONE_EXT) as f:
+                self.assertEqual(int(f.read()), i % 2)
+            with open(os.path.join(self.wdir, "script_{0}.log".format(i))) as f:
+                self.assertEqual(f.read().strip(), "I am script {0}".format(i))
+        # The sentinel files can be written before the job leaves the queue, but it then
+        # drops out of the list of running jobs even though LSF still lists it as DONE
+        for _ in range(100):
+            c.getRunningJobList(job_ids=c.qList)
+            if not c.runningQueueList:
+                break
+            time.sleep(0.1)
+        self.assertEqual(c.runningQueueList, [])
+
+    def test_array_SGE(self):
+        self._test_array("SGE")
+
+    def test_array_LSF(self):
+        self._test_array("LSF")
+
+    def test_run_scripts_cluster(self):
+        scripts = self.makeScripts(3)
+        workers_util.run_scripts_cluster(scripts, job_name="single", submit_qtype="SGE")
+        for script in scripts:
+            self.assertTrue(os.path.isfile(script + clusterize.DONE_EXT))
+            self.assertTrue(os.path.isfile(os.path.splitext(script)[0] + ".log"))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,133 @@
+"""Test functions for util.distance_matrix"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from ample.util import distance_matrix
+
+
+def random_square(n, seed=1):
+    rng = numpy.random.RandomState(seed)
+    square = rng.uniform(0.0, 10.0, size=(n, n)).astype(numpy.float32)
+    square = numpy.triu(square, 1)
+    return square + square.T
+
+
+class Test(unittest.TestCase):
+    def test_indexing(self):
+        square = random_square(7)
+        m = distance_matrix.CondensedDistanceMatrix.from_square(square)
+        self.assertEqual(len(m.data), 21)
+        self.assertEqual(m.shape, (7, 7))
+        for i in range(7):
+            self.assertTrue(numpy.array_equal(m.row(i), square[i]))
+            for j in range(7):
+                self.assertEqual(m[i, j], square[i, j])
+        self.assertTrue(numpy.array_equal(m[2, [0, 2, 5]], square[2, [0, 2, 5]]))
+        self.assertTrue(numpy.array_equal(numpy.asarray(m), square))
+        m[5, 1] = 42.0
+        self.assertEqual(m[1, 5], 42.0)
+        m[3, [0, 6]] = [1.0, 2.0]
+        self.assertEqual((m[0, 3], m[6, 3]), (1.0, 2.0))
+
+    def test_count_within(self):
+        square = random_square(9, seed=2)
+        square[1, 4] = square[4, 1] = 0.0
+        m = distance_matrix.CondensedDistanceMatrix.from_square(square)
+        condition = numpy.logical_and(square <= 4.0, square != 0.0)
+        self.assertTrue(numpy.array_equal(m.count_within(4.0), condition.sum(axis=1)))
+        m.diagonal = 1.0
+        self.assertTrue(numpy.array_equal(m.count_within(4.0), condition.sum(axis=1) + 1))
+
+    def test_radius_index(self):
+        square = random_square(12, seed=5)
+        square[2, 7] = square[7, 2] = 0.0
+        m = distance_matrix.CondensedDistanceMatrix.from_square(square)
+        index = distance_matrix.RadiusIndex(m)
+        for radius in (0.5, 2.0, 4.0, 7.5, 11.0):
+            condition = numpy.logical_and(square <= radius, square != 0.0)
+            self.assertTrue(numpy.array_equal(index.counts(radius), condition.sum(axis=1)))
+            centre = int(numpy.argmax(condition.sum(axis=1)))
+            cluster = index.largest_cluster(radius)
+            self.assertEqual(cluster, [centre] + numpy.where(condition[centre])[0].tolist())
+        for nitems in range(2, 13):
+            radius = index.radius_for(nitems)
+            self.assertTrue(index.counts(radius).max() + 1 >= nitems)
+            self.assertTrue(index.counts(numpy.nextafter(numpy.float32(radius), numpy.float32(0))).max() + 1 < nitems)
+        self.assertIsNone(index.radius_for(13))
+        self.assertEqual(distance_matrix.RadiusIndex(distance_matrix.CondensedDistanceMatrix(3)).largest_cluster(1.0), [])
+
+    def test_memmap(self):
+        scratch = tempfile.mkdtemp()
+        try:
+            m = distance_matrix.CondensedDistanceMatrix(50, memmap_dir=scratch)
+            self.assertIsInstance(m.data, numpy.memmap)
+            self.assertEqual(os.path.getsize(m.filename), 50 * 49 // 2 * 4)
+            m[10, 20] = 3.5
+            self.assertEqual(m.row(20)[10], 3.5)
+            m.close()
+            self.assertEqual(os.listdir(scratch), [])
+        finally:
+            shutil.rmtree(scratch)
+
+    def test_radius_index_memmap(self):
+        scratch = tempfile.mkdtemp()
+        try:
+            square = random_square(40, seed=7)
+            m = distance_matrix.CondensedDistanceMatrix.from_square(square, memmap_dir=scratch)
+            index = distance_matrix.RadiusIndex(m)
+            self.assertIsInstance(index.sorted, numpy.memmap)
+            self.assertEqual(os.path.dirname(index.filename), scratch)
+            for radius in (0.0, 3.0, 10.0):
+                radius = numpy.float32(radius)
+                self.assertTrue(numpy.array_equal(index.counts_below(radius), (square < radius).sum(axis=1)))
+                self.assertTrue(numpy.array_equal(index.counts(radius), (square <= radius).sum(axis=1) - 1))
+            index.close()
+            m.close()
+            self.assertEqual(os.listdir(scratch), [])
+        finally:
+            shutil.rmtree(scratch)
+
+    def test_binary(self):
+        scratch = tempfile.mkdtemp()
+        try:
+            path = os.path.join(scratch, 'test.matrix')
+            m = distance_matrix.CondensedDistanceMatrix.from_square(random_square(6, seed=3))
+            m.diagonal = 1.0
+            models = ["/models/{0}.pdb".format(i) for i in range(6)]
+            distance_matrix.write(m, path, models=models)
+            self.assertTrue(distance_matrix.is_binary(path))
+            for mmap in (False, True):
+                read, index = distance_matrix.read(path, mmap=mmap)
+                self.assertEqual(index, models)
+                self.assertEqual(read.diagonal, 1.0)
+                self.assertTrue(numpy.array_equal(read.to_square(), m.to_square()))
+                del read
+        finally:
+            shutil.rmtree(scratch)
+
+    def test_write_text(self):
+        square = random_square(4, seed=4)
+        m = distance_matrix.CondensedDistanceMatrix.from_square(square)
+        scratch = tempfile.mkdtemp()
+        try:
+            path = distance_matrix.write_text(m, os.path.join(scratch, 'score.matrix'), offset=1)
+            self.assertFalse(distance_matrix.is_binary(path))
+            with open(path) as f:
+                lines = f.readlines()
+        finally:
+            shutil.rmtree(scratch)
+        # This is the format SPICKER reads
+        expected = []
+        for i in range(4):
+            for j in range(i, 4):
+                expected.append("{0: > 4d} {1: > 4d} {2: > 8.3F}\n".format(i + 1, j + 1, square[i, j]))
+        self.assertEqual(lines, expected + ["\n"])
+
+
+if __name__ == "__main__":
+    unittest.main()
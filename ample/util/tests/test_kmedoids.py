@@ -0,0 +1,71 @@
+"""Test functions for util.kmedoids"""
+
+import glob
+import os
+import unittest
+
+import numpy
+
+from ample import constants
+from ample.util import kmedoids, rmsd_util
+
+
+class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.models = sorted(glob.glob(os.path.join(constants.SHARE_DIR, 'testfiles', 'models', '*.pdb')))
+        cls.coords = rmsd_util.ca_coordinates(cls.models)
+
+    def test_kmedoids(self):
+        # Three well separated groups of points on a line
+        points = numpy.array([0.0, 1.0, 2.0, 20.0, 21.0, 22.0, 23.0, 50.0, 51.0])
+        matrix = numpy.abs(points[:, numpy.newaxis] - points)
+        medoids = kmedoids.kmedoids(matrix, 3, rng=numpy.random.RandomState(1))
+        self.assertEqual(sorted(medoids.tolist()), [1, 4, 7])
+
+    def test_tm_distances(self):
+        matrix = kmedoids.tm_distances(self.coords[:6])
+        self.assertTrue(numpy.allclose(numpy.diag(matrix), 0.0))
+        self.assertTrue(numpy.allclose(matrix, matrix.T))
+        self.assertTrue(numpy.all((matrix >= 0.0) & (matrix < 1.0)))
+        self.assertTrue(numpy.allclose(kmedoids.tm_distances(self.coords[:6], self.coords[2:4]), matrix[:, 2:4]))
+
+    def test_cluster(self):
+        clusterer = kmedoids.KMedoidsClusterer()
+        clusters = clusterer.cluster(self.models, num_clusters=3, max_cluster_size=10)
+        self.assertEqual(len(clusters), 3)
+        self.assertEqual([c.index for c in clusters], [1, 2, 3])
+        self.assertEqual([c.cluster_method for c in clusters], ['kmedoids'] * 3)
+        for cluster in clusters:
+            self.assertLessEqual(len(cluster.models), 10)
+            self.assertEqual(len(cluster.models), len(cluster.r_cen))
+            self.assertEqual(cluster.r_cen[0], 0.0)
+            self.assertEqual(cluster.r_cen, sorted(cluster.r_cen))
+        # The clusters are in order of size
+        clusters = clusterer.cluster(self.models, num_clusters=3, max_cluster_size=200)
+        sizes = [len(c.models) for c in clusters]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(sum(sizes), len(self.models))
+
+    def test_batches(self):
+        # Clustering in batches should find the same clusters as clustering all the models when the groups are clear
+        rng = numpy.random.RandomState(4)
+        centres = rng.normal(scale=10.0, size=(3, 20, 3))
+        coords = numpy.concatenate([c + rng.normal(scale=0.3, size=(40, 20, 3)) for c in centres])
+        models = ['model_{0}.pdb'.format(i) for i in range(len(coords))]
+        full = kmedoids.KMedoidsClusterer().cluster(models, num_clusters=3, coords=coords)
+        batched = kmedoids.KMedoidsClusterer(batch_size=30).cluster(models, num_clusters=3, coords=coords)
+        self.assertEqual(sorted(sorted(c.models) for c in full), sorted(sorted(c.models) for c in batched))
+        self.assertEqual(sorted(len(c.models) for c in batched), [40, 40, 40])
+
+    def test_tm_cluster(self):
+        clusters = kmedoids.KMedoidsClusterer(score_type='tm').cluster(self.models, num_clusters=2)
+        self.assertEqual(len(clusters), 2)
+        self.assertEqual([c.cluster_score_type for c in clusters], ['tm', 'tm'])
+        self.assertEqual(sum(len(c.models) for c in clusters), len(self.models))
+        shared = kmedoids.KMedoidsClusterer(score_type='tm', nproc=2).cluster(self.models, num_clusters=2)
+        self.assertEqual([c.models for c in shared], [c.models for c in clusters])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+"""Test functions for util.ledger_util"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ample.util import ledger_util
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+        self.ledger = os.path.join(self.wdir, ledger_util.LEDGER_FILE)
+        self.environ = os.environ.get(ledger_util.LEDGER_FILE_ENV)
+        ledger_util.enable(self.ledger)
+
+    def tearDown(self):
+        os.environ.pop(ledger_util.LEDGER_FILE_ENV, None)
+        if self.environ:
+            os.environ[ledger_util.LEDGER_FILE_ENV] = self.environ
+        shutil.rmtree(self.wdir)
+
+    def test_job_states(self):
+        ledger_util.record('job_0.sh', ledger_util.SUBMITTED)
+        ledger_util.record('job_1.sh', ledger_util.SUBMITTED)
+        ledger_util.record('job_0.sh', ledger_util.STARTED, pid=99)
+        ledger_util.record('job_0.sh', ledger_util.FINISHED, returncode=0)
+        # A partial line left by a killed process is ignored
+        with open(self.ledger, 'a') as f:
+            f.write('{"job": "job_1.sh", "sta')
+        self.assertEqual(len(ledger_util.read(self.ledger)), 4)
+        states = ledger_util.job_states(self.ledger)
+        self.assertEqual(states['job_0.sh']['state'], ledger_util.FINISHED)
+        self.assertEqual(states['job_0.sh']['returncode'], 0)
+        self.assertEqual(states['job_1.sh']['state'], ledger_util.SUBMITTED)
+
+    def test_no_ledger(self):
+        os.environ.pop(ledger_util.LEDGER_FILE_ENV)
+        ledger_util.record('job_0.sh', ledger_util.SUBMITTED)
+        self.assertFalse(os.path.exists(self.ledger))
+        self.assertEqual(ledger_util.job_states(None), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
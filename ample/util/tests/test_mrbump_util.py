@@ -2,10 +2,12 @@
 
 import pickle
 import os
+import shutil
+import tempfile
 import unittest
 
 from ample.constants import AMPLE_PKL, SHARE_DIR
-from ample.util import mrbump_util
+from ample.util import ample_util, mrbump_util
 
 
 class Test(unittest.TestCase):
@@ -29,6 +31,49 @@ class Test(unittest.TestCase):
         self.assertEqual(len(topf), 3)
         self.assertEqual(topf[2]['info'], 'SHELXE trace of MR result')
 
+    def test_prioritiser(self):
+        wdir = tempfile.mkdtemp()
+        ensembles_data = []
+        scripts = []
+        for tl in (20, 50):
+            for sct in ('polyala', 'allatom'):
+                name = 'c1_tl{0}_r1_{1}'.format(tl, sct)
+                ensembles_data.append(
+                    {
+                        'name': name,
+                        'cluster_num': 1,
+                        'truncation_level': tl,
+                        'side_chain_treatment': sct,
+                        'num_residues': 40,
+                    }
+                )
+                scripts.append(os.path.join(wdir, name + ample_util.SCRIPT_EXT))
+        ensembles_data[2]['num_residues'] = 10
+        prioritiser = mrbump_util.MrBumpPrioritiser(scripts, ensembles_data)
+        self.assertEqual(sorted(scripts, key=prioritiser.priority), [scripts[i] for i in (0, 1, 3, 2)])
+
+        # A bad polyala result should move the rest of its truncation level down the queue
+        name = ensembles_data[0]['name']
+        rdir = os.path.join(wdir, 'search_' + name + '_mrbump', 'results')
+        os.makedirs(rdir)
+        rD = {
+            'loc0_ALL_' + name + '_UNMOD': {
+                'PHASER': {
+                    'SearchModel_filename': name + '.pdb',
+                    'Search_directory': rdir,
+                    'PHASER_TFZ': 3.1,
+                    'PHASER_LLG': 12,
+                    'SHELXE_CC': 4.2,
+                    'SHELXE_ACL': 2,
+                }
+            }
+        }
+        with open(os.path.join(rdir, 'resultsTable.pkl'), 'w') as f:
+            pickle.dump(rD, f)
+        self.assertTrue(prioritiser.job_finished(scripts[0], 0))
+        self.assertEqual(sorted(scripts[1:], key=prioritiser.priority), [scripts[i] for i in (3, 1, 2)])
+        shutil.rmtree(wdir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,120 @@
+"""Test functions for util.rmsd_util"""
+
+import glob
+import os
+import unittest
+
+import numpy
+
+from ample import constants
+from ample.util import rmsd_util
+
+
+def kabsch_rmsd(a, b):
+    """Reference RMSD for a single pair, superposing with the rotation matrix from the SVD"""
+    a = a - a.mean(axis=0)
+    b = b - b.mean(axis=0)
+    u, _, vt = numpy.linalg.svd(a.T.dot(b))
+    d = numpy.sign(numpy.linalg.det(u.dot(vt)))
+    rotation = u.dot(numpy.diag([1.0, 1.0, d])).dot(vt)
+    return numpy.sqrt(((a.dot(rotation) - b) ** 2).sum() / len(a))
+
+
+def random_rotation(rng):
+    q, r = numpy.linalg.qr(rng.normal(size=(3, 3)))
+    q *= numpy.sign(numpy.diag(r))
+    if numpy.linalg.det(q) < 0:
+        q[:, 0] *= -1
+    return q
+
+
+class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.testfiles_dir = os.path.join(constants.SHARE_DIR, 'testfiles')
+
+    def test_superposed(self):
+        rng = numpy.random.RandomState(1)
+        coords = rng.normal(scale=10.0, size=(20, 3))
+        moved = coords.dot(random_rotation(rng)) + rng.normal(size=3) * 50.0
+        matrix = rmsd_util.pairwise_rmsd(numpy.array([coords, moved]))
+        self.assertAlmostEqual(matrix[0, 1], 0.0, 5)
+
+    def test_reference(self):
+        rng = numpy.random.RandomState(2)
+        coords = rng.normal(scale=10.0, size=(11, 30, 3))
+        # Mirror images can't be superposed so make sure we don't allow reflections
+        coords[3] = -coords[2]
+        matrix = rmsd_util.pairwise_rmsd(coords, block_size=4)
+        for i in range(len(coords)):
+            self.assertEqual(matrix[i, i], 0.0)
+            for j in range(len(coords)):
+                self.assertAlmostEqual(matrix[i, j], kabsch_rmsd(coords[i], coords[j]), 6)
+        self.assertGreater(matrix[2, 3], 1.0)
+
+    def test_cross_rmsd(self):
+        rng = numpy.random.RandomState(3)
+        coords = rng.normal(scale=10.0, size=(7, 25, 3))
+        others = rng.normal(scale=10.0, size=(5, 25, 3))
+        others[0] = coords[4].dot(random_rotation(rng))
+        matrix = rmsd_util.cross_rmsd(coords, others, block_size=3)
+        self.assertEqual(matrix.shape, (7, 5))
+        for i in range(len(coords)):
+            for j in range(len(others)):
+                self.assertAlmostEqual(matrix[i, j], kabsch_rmsd(coords[i], others[j]), 6)
+        self.assertAlmostEqual(matrix[4, 0], 0.0, 5)
+
+    def test_rotations(self):
+        rng = numpy.random.RandomState(4)
+        x = rng.normal(scale=10.0, size=(6, 30, 3))
+        y = rng.normal(scale=10.0, size=(6, 30, 3))
+        y[0] = x[0].dot(random_rotation(rng))
+        y[1] = -x[1]  # The mirror image can't be superposed
+        y[2] = x[2]
+        x = x - x.mean(axis=1)[:, numpy.newaxis, :]
+        y = y - y.mean(axis=1)[:, numpy.newaxis, :]
+        h = numpy.matmul(x.transpose(0, 2, 1), y)
+        e0 = 0.5 * ((x ** 2).sum(axis=(1, 2)) + (y ** 2).sum(axis=(1, 2)))
+        rotations = rmsd_util.rotations(h, e0)
+        for i in range(len(x)):
+            self.assertAlmostEqual(numpy.linalg.det(rotations[i]), 1.0)
+            rmsd = numpy.sqrt(((x[i].dot(rotations[i]) - y[i]) ** 2).sum() / len(x[i]))
+            self.assertAlmostEqual(rmsd, kabsch_rmsd(x[i], y[i]), 6)
+        self.assertTrue(numpy.allclose(x[0].dot(rotations[0]), y[0]))
+        self.assertTrue(numpy.allclose(rotations[2], numpy.identity(3)))
+
+    def test_cutoff(self):
+        coords = rmsd_util.ca_coordinates(sorted(glob.glob(os.path.join(self.testfiles_dir, 'models', '*.pdb'))))
+        matrix = rmsd_util.pairwise_rmsd(coords)
+        prints = rmsd_util.fingerprints(coords)
+        bounds = rmsd_util.lower_bounds(prints, prints)
+        self.assertTrue((bounds <= matrix + rmsd_util.LOWER_BOUND_TOLERANCE).all())
+        for cutoff in (1.0, 3.0):
+            pruned = rmsd_util.pairwise_rmsd(coords, block_size=7, cutoff=cutoff)
+            # Every RMSD under the cutoff is found and the rest are lower bounds that are at least the cutoff
+            under = matrix < cutoff
+            self.assertTrue(numpy.allclose(pruned[under], matrix[under]))
+            self.assertTrue((pruned[~under] >= cutoff).all())
+            self.assertTrue((pruned <= matrix + rmsd_util.LOWER_BOUND_TOLERANCE).all())
+
+    def test_ca_coordinates(self):
+        pdbs = sorted(glob.glob(os.path.join(self.testfiles_dir, 'models', '*.pdb')))[:3]
+        residues, xyz = rmsd_util.read_ca(pdbs[0])
+        self.assertEqual(len(residues), 59)
+        self.assertEqual(residues[0], ('A', '1', ' '))
+        self.assertEqual(xyz[0].tolist(), [1.458, 0.0, 0.0])
+        coords = rmsd_util.ca_coordinates(pdbs)
+        self.assertEqual(coords.shape, (3, 59, 3))
+
+    def test_residue_coordinates(self):
+        pdbs = sorted(glob.glob(os.path.join(self.testfiles_dir, 'models', '*.pdb')))[:3]
+        coords = rmsd_util.residue_coordinates(pdbs)
+        self.assertTrue(numpy.array_equal(coords, rmsd_util.ca_coordinates(pdbs)))
+        self.assertTrue(numpy.array_equal(rmsd_util.select_residues(coords, [2, 4, 6]), coords[:, [2, 4, 6]]))
+        # Residues without a CA in any of the models are dropped
+        coords[1, 4] = numpy.nan
+        self.assertTrue(numpy.array_equal(rmsd_util.select_residues(coords, [2, 4, 6]), coords[:, [2, 6]]))
+
+
+if __name__ == "__main__":
+    unittest.main()
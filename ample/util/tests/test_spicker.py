@@ -1,12 +1,15 @@
 import glob
 import os
 import shutil
+import sys
 import tempfile
 import unittest
 
+import numpy
+
 from ample import constants
 from ample.testing import test_funcs
-from ample.util import ample_util, spicker
+from ample.util import ample_util, rmsd_util, spicker
 
 
 @unittest.skip("unreliable test cases")
@@ -57,5 +60,48 @@ class Test(unittest.TestCase):
         shutil.rmtree(work_dir)
 
 
+class TestInputFiles(unittest.TestCase):
+    def setUp(self):
+        self.models = sorted(glob.glob(os.path.join(constants.SHARE_DIR, 'testfiles', 'models', '*.pdb')))
+        self.work_dir = tempfile.mkdtemp()
+        self.owd = os.getcwd()
+        os.chdir(self.work_dir)
+        # The executable isn't run when creating the input files
+        self.spickerer = spicker.Spickerer(spicker_exe=sys.executable, run_dir=self.work_dir)
+
+    def tearDown(self):
+        os.chdir(self.owd)
+        shutil.rmtree(self.work_dir)
+
+    def read_tra1(self):
+        with open('rep1.tra1') as f:
+            return [[float(x) for x in line.split()] for line in f]
+
+    def test_read_ca_records(self):
+        residues, coords = spicker.read_ca_records(self.models[0])
+        self.assertEqual(len(residues), 59)
+        self.assertEqual(len(coords), 59)
+        self.assertEqual(self.spickerer.get_length(self.models[0]), '59')
+        xyz = rmsd_util.ca_coordinates(self.models[:1])[0]
+        self.assertTrue((numpy.array(coords, dtype=float) == xyz).all())
+
+    def test_create_input_files(self):
+        self.spickerer.create_input_files(self.models)
+        tra1 = self.read_tra1()
+        self.assertEqual(len(tra1), 30 * 60)
+        self.assertEqual(tra1[60], [59, 926.917, 2, 2])
+        with open('rmsinp') as f:
+            self.assertEqual(f.read(), '1  59\n\n59\n')
+        with open('seq.dat') as f:
+            seq = f.readlines()
+        self.assertEqual(len(seq), 59)
+        self.assertEqual(len(seq[0].split()), 2)
+        with open('file_list') as f:
+            self.assertEqual([l.strip() for l in f], self.models)
+        # The coordinates can come from a cache rather than the files
+        self.spickerer.create_input_files(self.models, coords=rmsd_util.ca_coordinates(self.models))
+        self.assertEqual(self.read_tra1(), tra1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,89 @@
+"""Test functions for util.spicker_util"""
+
+import glob
+import os
+import unittest
+
+import numpy
+
+from ample import constants
+from ample.util import distance_matrix, rmsd_util, spicker_util
+
+
+def fortran_spicker(amat, cut, nc_max=10):
+    """The clustering loop of spicker.f, transcribed directly"""
+    n_str = len(amat)
+    mark = [1] * n_str
+    clusters = []
+    for _ in range(nc_max):
+        n_str_near = [0] * n_str
+        for j in range(n_str):
+            for k in range(n_str):
+                if mark[j] == 1 and mark[k] == 1 and amat[j, k] < cut:
+                    n_str_near[j] += 1
+        n_str_cl_max = 0
+        for j in range(n_str):
+            if n_str_near[j] > n_str_cl_max:
+                n_str_cl_max = n_str_near[j]
+                i_cl = j
+        if n_str_cl_max < 1:
+            break
+        members = []
+        for j in range(n_str):
+            if amat[j, i_cl] < cut:
+                mark[j] = 0
+                members.append(j)
+        clusters.append((i_cl, members))
+    return clusters
+
+
+class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.models = sorted(glob.glob(os.path.join(constants.SHARE_DIR, 'testfiles', 'models', '*.pdb')))
+        coords = rmsd_util.ca_coordinates(cls.models)
+        cls.matrix = rmsd_util.pairwise_rmsd(coords, out=distance_matrix.CondensedDistanceMatrix(len(cls.models)))
+
+    def test_spicker(self):
+        square = self.matrix.to_square()
+        for cutoff in (3.0, 4.0, 6.0):
+            clusters = spicker_util.spicker(self.matrix, cutoff=cutoff)
+            ref = fortran_spicker(square, numpy.float32(cutoff))
+            self.assertEqual([(c, m) for c, m, _ in clusters], ref)
+            for centre, members, r_cen in clusters:
+                self.assertTrue(numpy.allclose(r_cen, square[centre, members]))
+
+    def test_cluster(self):
+        spickerer = spicker_util.Spickerer()
+        clusters = spickerer.cluster(self.models, num_clusters=3)
+        self.assertEqual(len(clusters), 3)
+        self.assertEqual([c.index for c in clusters], [1, 2, 3])
+        # The first cluster that the spicker executable picked from these models
+        ref = [
+            '5_S_00000005.pdb',
+            '4_S_00000005.pdb',
+            '5_S_00000004.pdb',
+            '4_S_00000002.pdb',
+            '4_S_00000003.pdb',
+            '3_S_00000006.pdb',
+            '3_S_00000004.pdb',
+            '2_S_00000005.pdb',
+            '2_S_00000001.pdb',
+            '3_S_00000003.pdb',
+            '1_S_00000005.pdb',
+            '1_S_00000002.pdb',
+            '1_S_00000004.pdb',
+        ]
+        names = sorted(os.path.basename(m) for m in clusters[0].models)
+        self.assertEqual(names, sorted(ref))
+        r_cen = clusters[0].r_cen
+        self.assertEqual(r_cen[0], 0.0)
+        self.assertEqual(r_cen, sorted(r_cen))
+        self.assertEqual(os.path.basename(clusters[0].centroid), '4_S_00000002.pdb')
+        clusters = spickerer.cluster(self.models, num_clusters=1, max_cluster_size=10)
+        self.assertEqual(len(clusters[0].models), 10)
+        self.assertEqual(len(clusters[0].r_cen), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Test functions for util.telemetry_util"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from ample.util import ample_util, telemetry_util
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+        self.environ = telemetry_util.environment()
+        self.tfile = os.path.join(self.wdir, telemetry_util.TELEMETRY_FILE)
+        telemetry_util.enable(self.tfile)
+
+    def tearDown(self):
+        for k in (telemetry_util.TELEMETRY_FILE_ENV, telemetry_util.TELEMETRY_STAGE_ENV):
+            os.environ.pop(k, None)
+        os.environ.update(self.environ)
+        shutil.rmtree(self.wdir)
+
+    def test_run_command(self):
+        telemetry_util.set_stage('testing')
+        logfile = os.path.join(self.wdir, 'python.log')
+        cmd = [sys.executable, '-c', 'print("x" * 99)']
+        self.assertEqual(ample_util.run_command(cmd, logfile=logfile, directory=self.wdir), 0)
+        ample_util.run_command([sys.executable, '-c', 'import sys; sys.exit(3)'], directory=self.wdir)
+        records = telemetry_util.read(self.tfile)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['stage'], 'testing')
+        self.assertEqual(records[0]['tool'], os.path.basename(sys.executable))
+        self.assertEqual(records[0]['returncode'], 0)
+        self.assertEqual(records[0]['output_bytes'], os.path.getsize(logfile))
+        self.assertGreaterEqual(records[0]['wall_time'], 0.0)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(records[0]['max_rss_kb'], 0)
+        self.assertEqual(records[1]['returncode'], 3)
+
+    def test_summarise(self):
+        records = [
+            {'stage': 'mr', 'tool': 'script', 'returncode': 0, 'wall_time': 2.0, 'user_time': 1.0, 'max_rss_kb': 10},
+            {'stage': 'mr', 'tool': 'script', 'returncode': 1, 'wall_time': 3.0, 'system_time': 0.5, 'max_rss_kb': 5},
+            {'stage': 'ensembling', 'tool': 'gesamt', 'returncode': 0, 'wall_time': 1.0, 'output_bytes': 20},
+        ]
+        totals = telemetry_util.summarise(records)
+        self.assertEqual([(t['stage'], t['tool']) for t in totals], [('mr', 'script'), ('ensembling', 'gesamt')])
+        self.assertEqual(totals[0]['count'], 2)
+        self.assertEqual(totals[0]['failed'], 1)
+        self.assertAlmostEqual(totals[0]['wall_time'], 5.0)
+        self.assertAlmostEqual(totals[0]['cpu_time'], 1.5)
+        self.assertEqual(totals[0]['max_rss_kb'], 10)
+        self.assertEqual(totals[1]['output_bytes'], 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
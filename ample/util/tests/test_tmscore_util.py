@@ -0,0 +1,169 @@
+"""Test functions for util.tmscore_util"""
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from ample import constants
+from ample.parsers import tm_parser
+from ample.testing import test_funcs
+from ample.util import ample_util, distance_matrix, rmsd_util, tmscore_util
+
+
+def superpose(xa, xb, k_ali):
+    """Superpose all of xa onto xb on the residues in k_ali as u3b does"""
+    ca = xa[k_ali].mean(axis=0)
+    cb = xb[k_ali].mean(axis=0)
+    u, _, vt = numpy.linalg.svd((xa[k_ali] - ca).T.dot(xb[k_ali] - cb))
+    if numpy.linalg.det(u.dot(vt)) < 0:
+        u[:, 2] *= -1
+    return (xa - ca).dot(u.dot(vt)) + cb
+
+
+def fortran_tmscore(xa, xb, nseqB=None):
+    """The TMscore subroutine of spicker.f, transcribed directly"""
+    n_ali = len(xa)
+    nseqB = nseqB or n_ali
+    d0 = 1.24 * max(nseqB - 15, 0) ** (1.0 / 3.0) - 1.8
+    if d0 < 0.5:
+        d0 = 0.5
+    d0_search = min(max(d0, 4.5), 8.0)
+    n_init_max = 6
+    L_ini_min = 4
+    if n_ali < L_ini_min:
+        L_ini_min = n_ali
+    L_ini = []
+    for i in range(1, n_init_max):
+        L_ini.append(n_ali // 2 ** (i - 1))
+        if L_ini[-1] <= L_ini_min:
+            L_ini[-1] = L_ini_min
+            break
+    else:
+        L_ini.append(L_ini_min)
+
+    def score_fun(xt, d):
+        d_tmp = d
+        while True:
+            dis = numpy.sqrt(((xt - xb) ** 2).sum(axis=1))
+            i_ali = [k for k in range(n_ali) if dis[k] < d_tmp]
+            if len(i_ali) < 3 and n_ali > 3:
+                d_tmp = d_tmp + 0.5
+                continue
+            return i_ali, (1.0 / (1.0 + (dis / d0) ** 2)).sum() / nseqB
+
+    score_max = -1
+    for L_init in L_ini:
+        for iL in range(n_ali - L_init + 1):
+            k_ali = list(range(iL, iL + L_init))
+            i_ali, score = score_fun(superpose(xa, xb, k_ali), d0_search - 1)
+            score_max = max(score_max, score)
+            for it in range(1, 21):
+                k_ali = i_ali
+                i_ali, score = score_fun(superpose(xa, xb, k_ali), d0_search + 1)
+                score_max = max(score_max, score)
+                if it == 20 or i_ali == k_ali:
+                    break
+    return score_max
+
+
+class Test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.testfiles_dir = os.path.join(constants.SHARE_DIR, 'testfiles')
+        cls.models = sorted(glob.glob(os.path.join(cls.testfiles_dir, 'models', '*.pdb')))
+        cls.coords = rmsd_util.ca_coordinates(cls.models)
+
+    def test_fragment_lengths(self):
+        self.assertEqual(tmscore_util.fragment_lengths(59), [59, 29, 14, 7, 4])
+        self.assertEqual(tmscore_util.fragment_lengths(200), [200, 100, 50, 25, 12, 4])
+        self.assertEqual(tmscore_util.fragment_lengths(10), [10, 5, 4])
+        self.assertEqual(tmscore_util.fragment_lengths(3), [3])
+
+    def test_reference(self):
+        i, j = numpy.triu_indices(6, 1)
+        for nali in (59, 10, 3):
+            x = self.coords[i, :nali]
+            y = self.coords[j, :nali]
+            scores = tmscore_util.pair_scores(x, y, nresidues=70)
+            for k in range(len(x)):
+                self.assertAlmostEqual(scores.tm[k], fortran_tmscore(x[k], y[k], nseqB=70), 10)
+                self.assertAlmostEqual(scores.rmsd[k], rmsd_util.cross_rmsd(x[k : k + 1], y[k : k + 1])[0, 0], 6)
+
+    def test_identical(self):
+        scores = tmscore_util.pair_scores(self.coords[:3], self.coords[:3])
+        for score in (scores.tm, scores.gdtts, scores.gdtha, scores.maxsub):
+            self.assertTrue(numpy.allclose(score, 1.0))
+        self.assertTrue(numpy.allclose(scores.rmsd, 0.0, atol=1e-5))
+
+    def test_pairwise(self):
+        coords = self.coords[:8]
+        full = tmscore_util.pairwise_tm(coords, step=1)
+        self.assertTrue(numpy.allclose(numpy.diag(full), 1.0))
+        self.assertTrue(numpy.allclose(full, full.T))
+        self.assertTrue(numpy.allclose(tmscore_util.cross_tm(coords, coords[2:5], step=1), full[:, 2:5]))
+        for step in (tmscore_util.CLUSTER_STEP, None):
+            # A coarser search can only miss the best superposition
+            matrix = tmscore_util.pairwise_tm(coords, step=step)
+            self.assertTrue((matrix <= full + 1e-12).all())
+            out = tmscore_util.pairwise_tm(
+                coords, step=step, out=distance_matrix.CondensedDistanceMatrix(len(coords), diagonal=1.0)
+            )
+            self.assertTrue(numpy.allclose(out.to_square(), matrix))
+
+    def test_nproc(self):
+        matrix = tmscore_util.pairwise_tm(self.coords, step=tmscore_util.CLUSTER_STEP)
+        # The pairs are split into different batches, which only changes the rounding
+        self.assertTrue(numpy.allclose(tmscore_util.pairwise_tm(self.coords, nproc=3), matrix))
+        cross = tmscore_util.cross_tm(self.coords[:4], self.coords, nproc=2)
+        self.assertTrue(numpy.allclose(cross, matrix[:4]))
+
+    def test_compare_structures(self):
+        native = os.path.join(self.testfiles_dir, '1K33.pdb')
+        model = os.path.join(self.testfiles_dir, '1K33_S_00000001.pdb')
+        results = tmscore_util.compare_structures([model], native)
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result['model_name'], '1K33_S_00000001')
+        self.assertEqual(result['structure_name'], '1K33')
+        # Align the residues on their residue numbers
+        residues, xyz = rmsd_util.read_ca(native)
+        model_residues, model_xyz = rmsd_util.read_ca(model)
+        index = dict((int(r[1]), k) for k, r in enumerate(residues))
+        aligned = [(k, index[int(r[1])]) for k, r in enumerate(model_residues) if int(r[1]) in index]
+        self.assertEqual(result['nr_residues_common'], len(aligned))
+        x = model_xyz[[k for k, _ in aligned]]
+        y = xyz[[k for _, k in aligned]]
+        self.assertAlmostEqual(result['tmscore'], fortran_tmscore(x, y, nseqB=len(residues)), 10)
+        for key in ('gdtts', 'gdtha', 'maxsub'):
+            self.assertTrue(0.0 < result[key] < 1.0)
+
+    @unittest.skipUnless(test_funcs.found_exe("TMscore" + ample_util.EXE_EXT), "TMscore exec missing")
+    def test_tmscore_binary(self):
+        tmscore_exe = ample_util.find_exe("TMscore" + ample_util.EXE_EXT)
+        work_dir = tempfile.mkdtemp()
+        pairs = [('1K33_S_00000001.pdb', '1K33.pdb'), ('2UUI_S_00000001.pdb', '2UUI.pdb')]
+        pairs += [(m, self.models[0]) for m in self.models[1:6]]
+        for model, native in pairs:
+            model = os.path.join(self.testfiles_dir, model)
+            native = os.path.join(self.testfiles_dir, native)
+            logfile = os.path.join(work_dir, 'tmscore.log')
+            ample_util.run_command([tmscore_exe, model, native], logfile=logfile, directory=work_dir)
+            ref = tm_parser.TMscoreLogParser()
+            ref.parse(logfile)
+            result = tmscore_util.compare_structures([model], native)[0]
+            self.assertEqual(result['nr_residues_common'], ref.nr_residues_common)
+            # TMscore prints the scores to 4 decimal places and the RMSD to 3
+            self.assertAlmostEqual(result['tmscore'], ref.tm, delta=1e-3)
+            self.assertAlmostEqual(result['maxsub'], ref.maxsub, delta=1e-3)
+            self.assertAlmostEqual(result['gdtts'], ref.gdtts, delta=1e-3)
+            self.assertAlmostEqual(result['gdtha'], ref.gdtha, delta=1e-3)
+            self.assertAlmostEqual(result['rmsd'], ref.rmsd, delta=1e-2)
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
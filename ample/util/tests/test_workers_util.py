@@ -2,12 +2,14 @@
 
 import glob
 import os
+import shutil
 import stat
 import tempfile
+import time
 import unittest
 
 from ample import constants
-from ample.util import workers_util
+from ample.util import ample_util, ledger_util, workers_util
 
 
 @unittest.skip("unreliable test cases")
@@ -51,5 +53,192 @@ sys.exit(0)
         pass
 
 
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.wdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.wdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        workers_util.shutdown_pool()
+
+    def makeScript(self, name, rcode=0):
+        script = os.path.join(self.wdir, name + ample_util.SCRIPT_EXT)
+        with open(script, 'w') as f:
+            f.write(ample_util.SCRIPT_HEADER + os.linesep + "exit {0}".format(rcode) + os.linesep)
+        os.chmod(script, stat.S_IRWXU)
+        return script
+
+    def test_submit(self):
+        pool = workers_util.get_pool(2)
+        futures = [pool.submit(self.makeScript("job_{0}".format(i), rcode=i % 2)) for i in range(4)]
+        self.assertEqual([f.result(timeout=30) for f in futures], [0, 1, 0, 1])
+        self.assertTrue(all(f.state == workers_util.JobFuture.FINISHED for f in futures))
+        self.assertTrue(os.path.isfile(os.path.join(self.wdir, "job_0.log")))
+
+    def test_workers_reused(self):
+        workers_util.shutdown_pool()
+        pool = workers_util.get_pool(1)
+        first = pool.submit(self.makeScript("job_0"))
+        first.result(timeout=30)
+        second = pool.submit(self.makeScript("job_1"))
+        second.result(timeout=30)
+        self.assertEqual(first.worker, second.worker)
+
+    def test_cancel(self):
+        pool = workers_util.get_pool(1)
+        script = os.path.join(self.wdir, "slow" + ample_util.SCRIPT_EXT)
+        with open(script, 'w') as f:
+            f.write(ample_util.SCRIPT_HEADER + os.linesep + "sleep 2" + os.linesep)
+        os.chmod(script, stat.S_IRWXU)
+        slow = pool.submit(script)
+        queued = pool.submit(self.makeScript("job_0"))
+        self.assertTrue(queued.cancel())
+        self.assertTrue(queued.cancelled())
+        self.assertEqual(slow.result(timeout=30), 0)
+
+    def test_priority(self):
+        pool = workers_util.get_pool(1)
+        order = os.path.join(self.wdir, "order.txt")
+        scripts = []
+        for name in ("first", "low", "high", "middle"):
+            script = os.path.join(self.wdir, name + ample_util.SCRIPT_EXT)
+            with open(script, 'w') as f:
+                f.write(ample_util.SCRIPT_HEADER + os.linesep)
+                if name == "first":
+                    f.write("sleep 1" + os.linesep)
+                f.write("echo {0} >> {1}".format(name, order) + os.linesep)
+            os.chmod(script, stat.S_IRWXU)
+            scripts.append(script)
+        futures = [pool.submit(s, priority=p) for s, p in zip(scripts, (0, 3, 1, 2))]
+        # Jobs that haven't started can be reordered
+        pool.reprioritise(futures, lambda job: -1 if job == scripts[1] else 5)
+        for f in futures:
+            f.result(timeout=30)
+        with open(order) as f:
+            self.assertEqual(f.read().split(), ["first", "low", "high", "middle"])
+
+    @unittest.skipUnless(hasattr(os, "killpg"), "requires process groups")
+    def test_kill(self):
+        pool = workers_util.get_pool(2)
+        marker = os.path.join(self.wdir, "not_killed")
+        script = os.path.join(self.wdir, "slow" + ample_util.SCRIPT_EXT)
+        with open(script, 'w') as f:
+            f.write(ample_util.SCRIPT_HEADER + os.linesep)
+            # The child shell is in the same process group so should be killed with the script
+            f.write("(sleep 3; touch {0}) &".format(marker) + os.linesep)
+            f.write("wait" + os.linesep)
+        os.chmod(script, stat.S_IRWXU)
+        future = pool.submit(script)
+        while not future.running():
+            time.sleep(0.1)
+        self.assertTrue(future.kill())
+        future.result(timeout=30)
+        self.assertTrue(future.cancelled())
+        time.sleep(4)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_resources(self):
+        workers_util.shutdown_pool()
+        pool = workers_util.WorkerPool(4, memory=1000)
+        omp = os.path.join(self.wdir, "omp.txt")
+        script = os.path.join(self.wdir, "omp" + ample_util.SCRIPT_EXT)
+        with open(script, 'w') as f:
+            f.write(ample_util.SCRIPT_HEADER + os.linesep + "echo $OMP_NUM_THREADS > {0}".format(omp) + os.linesep)
+        os.chmod(script, stat.S_IRWXU)
+        self.assertEqual(pool.submit(script, cores=3).result(timeout=30), 0)
+        with open(omp) as f:
+            self.assertEqual(f.read().strip(), "3")
+
+        # The big job can't start until both small jobs have finished
+        slow = os.path.join(self.wdir, "slow" + ample_util.SCRIPT_EXT)
+        with open(slow, 'w') as f:
+            f.write(ample_util.SCRIPT_HEADER + os.linesep + "sleep 1" + os.linesep)
+        os.chmod(slow, stat.S_IRWXU)
+        small = [pool.submit(slow, memory=400) for _ in range(2)]
+        big = pool.submit(self.makeScript("big"), memory=800)
+        # A small job can jump ahead of the big one as there is memory for it
+        backfill = pool.submit(self.makeScript("backfill"), memory=100)
+        backfill.result(timeout=30)
+        self.assertFalse(big.done())
+        big.result(timeout=30)
+        self.assertTrue(all(f.done() for f in small))
+        pool.shutdown()
+
+    def test_run_scripts_serial(self):
+        scripts = [self.makeScript("job_{0}".format(i)) for i in range(3)]
+        self.assertTrue(workers_util.run_scripts_serial(scripts, nproc=2))
+        scripts.append(self.makeScript("job_fail", rcode=1))
+        self.assertFalse(workers_util.run_scripts_serial(scripts, nproc=2))
+
+    def test_callable(self):
+        pool = workers_util.get_pool(2)
+        futures = [pool.submit(_square, args=(i,)) for i in range(4)]
+        self.assertEqual([f.result(timeout=30) for f in futures], [0, 1, 4, 9])
+        self.assertEqual(futures[0].name, __name__ + "._square")
+        failed = pool.submit(_square, args=("x",))
+        with self.assertRaises(RuntimeError):
+            failed.result(timeout=30)
+        self.assertEqual(failed.returncode, 1)
+        self.assertIn("TypeError", failed.error)
+
+    def test_kill_callable(self):
+        pool = workers_util.get_pool(1)
+        future = pool.submit(time.sleep, args=(30,))
+        while not future.running():
+            time.sleep(0.1)
+        self.assertTrue(future.kill())
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=30)
+        self.assertTrue(future.cancelled())
+        # The worker that was killed is replaced
+        self.assertEqual(pool.submit(_square, args=(3,)).result(timeout=30), 9)
+
+    def test_worker_dies_before_starting(self):
+        pool = workers_util.WorkerPool(1)
+        try:
+            future = pool.submit(_square, args=(_DieWhenUnpickled(),))
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=30)
+            self.assertTrue(future.done())
+            self.assertEqual(future.returncode, 1)
+            # The worker that died is replaced
+            self.assertEqual(pool.submit(_square, args=(3,)).result(timeout=30), 9)
+        finally:
+            pool.shutdown()
+
+    def test_ledger(self):
+        ledger = os.path.join(self.wdir, ledger_util.LEDGER_FILE)
+        ledger_util.enable(ledger)
+        try:
+            pool = workers_util.get_pool(1)
+            ok = self.makeScript("job_0")
+            fail = self.makeScript("job_1", rcode=1)
+            for future in [pool.submit(ok), pool.submit(fail), pool.submit(_square, args=(2,))]:
+                future.result(timeout=30)
+        finally:
+            del os.environ[ledger_util.LEDGER_FILE_ENV]
+        # Callables can't be skipped on a restart so aren't recorded
+        self.assertEqual(set(e['job'] for e in ledger_util.read(ledger)), set([ok, fail]))
+        states = [e['state'] for e in ledger_util.read(ledger) if e['job'] == ok]
+        self.assertEqual(states, [ledger_util.SUBMITTED, ledger_util.STARTED, ledger_util.FINISHED])
+        job_states = ledger_util.job_states(ledger)
+        self.assertEqual(job_states[fail]['state'], ledger_util.FAILED)
+        self.assertEqual(job_states[fail]['returncode'], 1)
+
+
+def _square(x):
+    return x * x
+
+
+class _DieWhenUnpickled(object):
+    """Kills the worker as it takes the job off its queue, before it can say that the job has started"""
+
+    def __reduce__(self):
+        return (os._exit, (1,))
+
+
 if __name__ == "__main__":
     unittest.main()
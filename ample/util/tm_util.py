@@ -17,7 +17,7 @@ import tempfile
 import warnings
 
 from ample.parsers import alignment_parser, tm_parser
-from ample.util import ample_util, pdb_edit
+from ample.util import ample_util, pdb_edit, workers_util
 
 from pyjob import Job
 from pyjob.misc import make_script
@@ -186,6 +186,9 @@ class TMapps(object):
 
             if os.path.isfile(model_pdb) and os.path.isfile(structure_pdb):
                 data_entries.append([model_name, structure_name, model_pdb, structure_pdb])
+                if self._qtype == 'local':
+                    log_files.append(os.path.join(self.tmp_dir, "tmscore_" + stem + ".log"))
+                    continue
                 script = make_script(
                     [self.executable, model_pdb, structure_pdb], prefix="tmscore_", stem=stem, directory=self.tmp_dir
                 )
@@ -198,13 +201,29 @@ class TMapps(object):
                     logger.warning("Cannot find: %s", structure_pdb)
                 continue
 
-        logger.info('Executing TManalysis scripts')
-        j = Job(self._qtype)
-        j.submit(job_scripts, nproc=self._nproc, max_array_jobs=self._max_array_jobs, queue=self._queue, name="tmscore")
-        j.wait(interval=1)
+        if self._qtype == 'local':
+            # Run the comparisons directly in the local worker pool rather than writing a script for each one
+            logger.info('Executing TManalysis jobs')
+            pool = workers_util.get_pool(self._nproc)
+            futures = [
+                pool.submit(_run_comparison, args=(self.executable, entry[2], entry[3], log))
+                for entry, log in zip(data_entries, log_files)
+            ]
+            for future in futures:
+                try:
+                    future.result()
+                except RuntimeError as e:
+                    logger.critical(e)
+        else:
+            logger.info('Executing TManalysis scripts')
+            j = Job(self._qtype)
+            j.submit(
+                job_scripts, nproc=self._nproc, max_array_jobs=self._max_array_jobs, queue=self._queue, name="tmscore"
+            )
+            j.wait(interval=1)
 
         self.entries = []
-        for entry, log, script in zip(data_entries, log_files, job_scripts):
+        for entry, log in zip(data_entries, log_files):
             try:
                 pt.reset()
                 pt.parse(log)
@@ -214,6 +233,8 @@ class TMapps(object):
             model_name, structure_name, model_pdb, structure_pdb = entry
             _entry = self._store(model_name, structure_name, model_pdb, structure_pdb, log, pt)
             self.entries.append(_entry)
+
+        for script in job_scripts:
             os.unlink(script)
 
         return self.entries
@@ -283,6 +304,13 @@ class TMapps(object):
         return True
 
 
+def _run_comparison(executable, model_pdb, structure_pdb, logfile):
+    """Run a single TMscore or TMalign comparison, writing the output to logfile"""
+    return ample_util.run_command(
+        [executable, model_pdb, structure_pdb], logfile=logfile, directory=os.path.dirname(logfile)
+    )
+
+
 class TMalign(TMapps):
     """
     Wrapper to handle TMalign scoring for one or more structures
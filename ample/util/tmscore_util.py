@@ -0,0 +1,378 @@
+"""Calculate TM-scores directly with NumPy
+
+This follows the TM-score program (and the TMscore subroutine of scripts/spicker.f) but superposes
+a whole batch of pairs of models at once, so no external program is run for each pair.
+
+The TM-score of a model is found by a heuristic search for the superposition that maximises it. The
+search starts from superpositions of fragments of the aligned residues, of the full length and of
+halving lengths down to 4 residues, starting at every residue. Each superposition is extended by
+repeatedly superposing the residues that it brings within d0_search + 1 of each other, until the
+residues stop changing or there have been 20 iterations. The GDT and MaxSub scores are the best over
+the same superpositions, and the RMSD is that of the superposition of all the aligned residues.
+
+Searching every fragment takes a few hundred superpositions per pair of models, which is fine when
+comparing the models with a native structure but too slow to compare every pair of a large set of
+decoys. For clustering, the fragment starts can be spaced further apart with the step argument, and
+the pairs shared out between several processes with the nproc argument.
+
+Reference: Y Zhang, J Skolnick, Proteins, 2004 57: 702-710
+"""
+
+__author__ = "Jens Thomas"
+
+from collections import namedtuple
+import logging
+import os
+import sys
+
+import numpy
+
+from ample.util import rmsd_util, workers_util
+
+logger = logging.getLogger(__name__)
+
+# These are the parameters used by TM-score
+N_ITERATIONS = 20  # The maximum number of times a superposition is extended
+N_INIT_MAX = 6  # The maximum number of fragment lengths
+L_INIT_MIN = 4  # The shortest fragment
+D0_SEARCH_MIN = 4.5
+D0_SEARCH_MAX = 8.0
+D0_MIN = 0.5
+MAXSUB_CUTOFF = 3.5
+GDT_CUTOFFS = (0.5, 1.0, 2.0, 4.0, 8.0)
+
+CLUSTER_STEP = 8  # The spacing of the fragment starts used when calculating TM-scores for clustering
+TRIAL_ELEMENTS = 2000000  # Limits the number of superposed coordinates held in memory at once
+
+# The arguments of the batches being scored by _indexed_scores - forked processes inherit them from the parent
+_BATCHES = None
+
+TMScores = namedtuple('TMScores', ['tm', 'rmsd', 'gdtts', 'gdtha', 'maxsub'])
+
+
+def d0(nresidues):
+    """Return the TM-score distance scale for a structure of nresidues residues"""
+    return max(1.24 * max(nresidues - 15, 0) ** (1.0 / 3.0) - 1.8, D0_MIN)
+
+
+def fragment_lengths(nali):
+    """Return the lengths of the fragments that the TM-score search starts from for nali aligned residues"""
+    length_min = min(L_INIT_MIN, nali)
+    lengths = []
+    for i in range(N_INIT_MAX - 1):
+        length = nali // 2 ** i
+        if length <= length_min:
+            break
+        lengths.append(length)
+    lengths.append(length_min)
+    return lengths
+
+
+def seeds(nali, step=1):
+    """Return the (nseeds, nali) array of the residues of each fragment that the search starts from
+
+    Parameters
+    ----------
+    nali : int
+       The number of aligned residues
+    step : int, optional
+       The spacing of the starts of the fragments of each length; 1 gives the full TM-score search and
+       None only starts from the superposition of all the residues
+
+    """
+    if step is None:
+        return numpy.ones((1, nali), dtype=bool)
+    fragments = []
+    for length in fragment_lengths(nali):
+        for start in range(0, nali - length + 1, step):
+            fragment = numpy.zeros(nali, dtype=bool)
+            fragment[start : start + length] = True
+            fragments.append(fragment)
+    return numpy.array(fragments)
+
+
+def _distances(x, y, mask):
+    """Return the distances between the residues of each x and y after superposing them on the residues in mask
+
+    x and y are (ntrials, nresidues, 3) arrays and mask an (ntrials, nresidues) array.
+    """
+    w = mask.astype(numpy.float64)
+    n = w.sum(axis=1)[:, numpy.newaxis]
+    wx = x * w[:, :, numpy.newaxis]
+    sx = wx.sum(axis=1)
+    sy = numpy.matmul(w[:, numpy.newaxis, :], y)[:, 0]
+    # The covariance matrix and the sums of squares of the masked residues about their centres
+    h = numpy.matmul(wx.transpose(0, 2, 1), y) - sx[:, :, numpy.newaxis] * (sy / n)[:, numpy.newaxis, :]
+    sq_x = numpy.einsum('ijk,ijk->i', wx, x) - numpy.einsum('ij,ij->i', sx, sx) / n[:, 0]
+    sq_y = numpy.einsum('ij,ijk,ijk->i', w, y, y) - numpy.einsum('ij,ij->i', sy, sy) / n[:, 0]
+    rotation = rmsd_util.rotations(h, 0.5 * (sq_x + sq_y))
+    translation = (sy - numpy.matmul(sx[:, numpy.newaxis, :], rotation)[:, 0]) / n
+    diff = numpy.matmul(x, rotation) + (translation[:, numpy.newaxis, :] - y)
+    return numpy.sqrt(numpy.einsum('ijk,ijk->ij', diff, diff))
+
+
+def _unique(pair, mask):
+    """Return the indices of the first of each set of trials of the same pair with the same mask"""
+    key = numpy.concatenate(
+        [pair[:, numpy.newaxis].astype('>i8').view(numpy.uint8), numpy.packbits(mask, axis=1)], axis=1
+    )
+    key = numpy.ascontiguousarray(key).view(numpy.dtype((numpy.void, key.shape[1]))).ravel()
+    return numpy.sort(numpy.unique(key, return_index=True)[1])
+
+
+def _cut(dist, d):
+    """Return the residues under d of each other, increasing d by 0.5 until there are at least 3 as TM-score does"""
+    if dist.shape[1] > 3:
+        third = numpy.partition(dist, 2, axis=1)[:, 2]
+        d = d + 0.5 * numpy.where(third >= d, numpy.floor((third - d) / 0.5) + 1, 0)
+        return dist < d[:, numpy.newaxis]
+    return dist < d
+
+
+def _search(x, y, fragments, nresidues, max_iterations):
+    """Return the scores of the TM-score search for each pair of x and y
+
+    x and y are (npairs, nali, 3) arrays of the aligned residues and nresidues the length the scores are
+    normalised by. All the superpositions of all the pairs are extended together until they've all converged.
+    """
+    npairs, nali, _ = x.shape
+    nseeds = len(fragments)
+    scale = d0(nresidues)
+    d0_search = min(max(scale, D0_SEARCH_MIN), D0_SEARCH_MAX)
+
+    pair = numpy.repeat(numpy.arange(npairs), nseeds)
+    mask = numpy.tile(fragments, (npairs, 1))
+    tm = numpy.zeros(len(pair))
+    maxsub = numpy.zeros(len(pair))
+    gdt = numpy.zeros((len(pair), len(GDT_CUTOFFS)), dtype=numpy.int64)
+    rmsd = numpy.zeros(npairs)
+    trials = numpy.arange(len(pair))
+    d = d0_search - 1.0
+    for iteration in range(max_iterations + 1):
+        dist = _distances(x[pair[trials]], y[pair[trials]], mask[trials])
+        if iteration == 0:
+            # The first fragment of each pair is all the aligned residues
+            rmsd = numpy.sqrt((dist[::nseeds] ** 2).mean(axis=1))
+        tm[trials] = numpy.maximum(tm[trials], (1.0 / (1.0 + (dist / scale) ** 2)).sum(axis=1))
+        sub = numpy.where(dist < MAXSUB_CUTOFF, 1.0 / (1.0 + (dist / MAXSUB_CUTOFF) ** 2), 0.0)
+        maxsub[trials] = numpy.maximum(maxsub[trials], sub.sum(axis=1))
+        for k, cutoff in enumerate(GDT_CUTOFFS):
+            gdt[trials, k] = numpy.maximum(gdt[trials, k], (dist <= cutoff).sum(axis=1))
+
+        cut = _cut(dist, d)
+        # Stop extending when the residues don't change or there aren't any left to superpose
+        extend = cut.any(axis=1)
+        if iteration > 0:
+            extend &= (cut != mask[trials]).any(axis=1)
+        mask[trials] = cut
+        trials = trials[extend]
+        # Superpositions of the same pair on the same residues carry on identically, so only one is extended
+        trials = trials[_unique(pair[trials], mask[trials])]
+        if not len(trials):
+            break
+        d = d0_search + 1.0
+
+    # The best scores over all the superpositions of each pair
+    tm = tm.reshape(npairs, nseeds).max(axis=1)
+    maxsub = maxsub.reshape(npairs, nseeds).max(axis=1)
+    gdt = gdt.reshape(npairs, nseeds, len(GDT_CUTOFFS)).max(axis=1) / float(nresidues)
+    return TMScores(
+        tm=tm / nresidues,
+        rmsd=rmsd,
+        gdtts=gdt[:, 1:5].mean(axis=1),
+        gdtha=gdt[:, 0:4].mean(axis=1),
+        maxsub=maxsub / nresidues,
+    )
+
+
+def _score_batch(start):
+    """Return start and the scores of the batch of pairs that starts there"""
+    x, y, i, j, fragments, batch, nresidues, max_iterations = _BATCHES
+    pairs = slice(start, start + batch)
+    return start, _search(x[i[pairs]], y[j[pairs]], fragments, nresidues, max_iterations)
+
+
+def _indexed_scores(x, y, i, j, nresidues, step, max_iterations, nproc=1):
+    """Return the scores of each model x[i] superposed onto y[j], gathering the pairs a batch at a time
+
+    With nproc > 1 the batches are shared out between forked processes, which inherit the coordinates
+    rather than having them pickled and sent to them.
+    """
+    global _BATCHES
+    nali = x.shape[1]
+    if not len(i) or not nali:
+        return TMScores(*[numpy.zeros(len(i))] * len(TMScores._fields))
+    fragments = seeds(nali, step=step)
+    batch = max(1, TRIAL_ELEMENTS // (len(fragments) * nali))
+    # Make sure there is a batch for every process
+    batch = min(batch, -(-len(i) // max(nproc, 1)))
+    starts = range(0, len(i), batch)
+    _BATCHES = (x, y, i, j, fragments, batch, nresidues, max_iterations)
+    try:
+        if nproc > 1 and len(starts) > 1 and sys.platform != 'win32':
+            pool = workers_util.fork_pool(min(nproc, len(starts)))
+            try:
+                results = dict(pool.imap_unordered(_score_batch, starts))
+            finally:
+                pool.close()
+                pool.join()
+            results = [results[start] for start in starts]
+        else:
+            results = [_score_batch(start)[1] for start in starts]
+    finally:
+        _BATCHES = None
+    return TMScores(*[numpy.concatenate(scores) for scores in zip(*results)])
+
+
+def pair_scores(x, y, nresidues=None, step=1, max_iterations=N_ITERATIONS, nproc=1):
+    """Return the TM-score of each model in x superposed onto the model at the same index of y
+
+    Parameters
+    ----------
+    x : :obj:`numpy.ndarray`
+       An (npairs, nali, 3) array of the coordinates of the aligned residues of the models
+    y : :obj:`numpy.ndarray`
+       An (npairs, nali, 3) array of the coordinates of the aligned residues of the references
+    nresidues : int, optional
+       The length of the references that the scores are normalised by [default: nali]
+    step : int, optional
+       The spacing of the starts of the fragments the search starts from; 1 is the full TM-score search
+    max_iterations : int, optional
+       The maximum number of times each superposition is extended
+    nproc : int, optional
+       The number of processes to share the pairs between
+
+    Returns
+    -------
+    :obj:`TMScores`
+       The arrays of the TM-score, RMSD, GDT-TS, GDT-HA and MaxSub scores of each pair
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    index = numpy.arange(len(x))
+    return _indexed_scores(x, y, index, index, nresidues or x.shape[1], step, max_iterations, nproc=nproc)
+
+
+def cross_tm(coords, others, step=CLUSTER_STEP, max_iterations=N_ITERATIONS, nproc=1):
+    """Return the (nmodels, nothers) array of the TM-scores between every model in coords and every model in others"""
+    coords = numpy.asarray(coords, dtype=numpy.float64)
+    others = numpy.asarray(others, dtype=numpy.float64)
+    i, j = numpy.divmod(numpy.arange(len(coords) * len(others)), len(others))
+    scores = _indexed_scores(coords, others, i, j, coords.shape[1], step, max_iterations, nproc=nproc)
+    return scores.tm.reshape(len(coords), len(others))
+
+
+def pairwise_tm(coords, step=CLUSTER_STEP, max_iterations=N_ITERATIONS, out=None, nproc=1):
+    """Return the matrix of TM-scores between every pair of models
+
+    Parameters
+    ----------
+    coords : :obj:`numpy.ndarray`
+       An (nmodels, nresidues, 3) array of coordinates
+    step : int, optional
+       The spacing of the starts of the fragments the search starts from; 1 is the full TM-score search
+    max_iterations : int, optional
+       The maximum number of times each superposition is extended
+    out : :obj:`ample.util.distance_matrix.CondensedDistanceMatrix`, optional
+       A matrix with a diagonal of 1 to put the TM-scores in rather than creating a square array
+    nproc : int, optional
+       The number of processes to share the pairs between
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`
+       An (nmodels, nmodels) array of TM-scores, or out if it was given
+    """
+    coords = numpy.asarray(coords, dtype=numpy.float64)
+    nmodels = len(coords)
+    i, j = numpy.triu_indices(nmodels, 1)
+    scores = _indexed_scores(coords, coords, i, j, coords.shape[1], step, max_iterations, nproc=nproc).tm
+    if out is not None:
+        start = 0
+        for row in range(nmodels - 1):
+            out.set_upper(row, scores[start : start + nmodels - row - 1])
+            start += nmodels - row - 1
+        return out
+    matrix = numpy.ones((nmodels, nmodels))
+    matrix[i, j] = scores
+    matrix[j, i] = scores
+    return matrix
+
+
+def compare_structures(models, structure, res_seq_map=None, step=1, nproc=1):
+    """Compare models with a reference structure as the TM-score program does
+
+    The residues are aligned on their residue numbers, which are first mapped onto those of the structure
+    with res_seq_map if it's given. Only the first chain of the structure is used.
+
+    Parameters
+    ----------
+    models : list
+       The paths to the model pdb files
+    structure : str
+       The path to the reference pdb file
+    res_seq_map : :obj:`ample.util.residue_map.residueSequenceMap`, optional
+       The map from the residue numbers of the models to those of the structure
+    step : int, optional
+       The spacing of the starts of the fragments the search starts from; 1 is the full TM-score search
+    nproc : int, optional
+       The number of processes to share the models between
+
+    Returns
+    -------
+    list
+       A dictionary for each model with the same keys as :obj:`ample.util.tm_util.ModelData`
+    """
+    residues, xyz = rmsd_util.read_ca(structure)
+    chain = residues[0][0] if residues else None
+    index = dict((int(r[1]), k) for k, r in enumerate(residues) if r[0] == chain and r[2] == ' ')
+    nresidues = len(index)
+    structure_name = os.path.splitext(os.path.basename(structure))[0]
+
+    # Models aligned on the same residues are scored together
+    alignments = {}
+    entries = []
+    for model in models:
+        model_residues, model_xyz = rmsd_util.read_ca(model)
+        aligned = []
+        for k, residue in enumerate(model_residues):
+            resseq = int(residue[1])
+            if res_seq_map is not None:
+                resseq = res_seq_map.ref2target(resseq)
+            if resseq in index:
+                aligned.append((k, index[resseq]))
+        key = tuple(j for _, j in aligned)
+        alignments.setdefault(key, []).append((len(entries), model_xyz[[k for k, _ in aligned]]))
+        entries.append(
+            {
+                'model_name': os.path.splitext(os.path.basename(model))[0],
+                'structure_name': structure_name,
+                'model_fname': model,
+                'structure_fname': structure,
+                'log_fname': None,
+                'tmscore': 0.0,
+                'rmsd': 0.0,
+                'nr_residues_common': len(aligned),
+                'gdtts': 0.0,
+                'gdtha': 0.0,
+                'maxsub': 0.0,
+                'seq_id': 0,
+            }
+        )
+
+    for key, aligned in alignments.items():
+        if not key:
+            logger.warning("No residues in common with %s for %d models", structure, len(aligned))
+            continue
+        x = numpy.array([coords for _, coords in aligned])
+        y = numpy.broadcast_to(xyz[list(key)], x.shape)
+        scores = pair_scores(x, y, nresidues=nresidues, step=step, nproc=nproc)
+        for n, (k, _) in enumerate(aligned):
+            entries[k].update(
+                tmscore=float(scores.tm[n]),
+                rmsd=float(scores.rmsd[n]),
+                gdtts=float(scores.gdtts[n]),
+                gdtha=float(scores.gdtha[n]),
+                maxsub=float(scores.maxsub[n]),
+            )
+    return entries
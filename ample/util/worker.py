@@ -7,66 +7,130 @@ __version__ = "1.0"
 import logging
 import multiprocessing
 import os
-import sys
+import pickle
+import time
 
-from ample.util import ample_util
+from ample.util import ample_util, telemetry_util
 
 logger = logging.getLogger(__name__)
 
 
-def worker(inqueue, early_terminate=False, check_success=None):
-    """Worker process to run MrBump jobs until no more left.
+def worker(inqueue, outqueue):
+    """Long-lived worker process that runs job scripts until told to stop.
 
-    This function keeps looping over the inqueue, removing jobs from the 
-    inqueue until there are no more left. It checks if a jobs has succeeded
-    and if so it will terminate.
+    The worker blocks on the inqueue until it is given a job. Each job is a
+    (job_id, job, args, cores, environ) tuple, where environ holds environment
+    variables such as the telemetry settings of the process that submitted the
+    job, which may have changed since the worker started. The worker reports
+    that it has started the job and then the return code of the script on the
+    outqueue. A None on the inqueue tells the worker to exit.
+
+    If the job is a callable rather than the path to a script it is called with
+    args in the worker process itself, which avoids writing a script and starting
+    a new interpreter for short pieces of Python work.
+
+    Where possible each script is run in its own process group, so that the
+    script and everything it starts can be killed together. OMP_NUM_THREADS is
+    set to the number of cores the job has been given.
 
     Parameters
     ----------
     inqueue : :obj:`Queue`
-       A Python Queue object
-    early_terminate : bool
-       Terminate on first success or continue running
-    check_success : callable
-       A callable to check the success status of a job
-    
-    Warnings
-    --------
-    This needs to import the main module that it lives in so maybe this should
-    live in a separate module?
+       A multiprocessing Queue object the jobs are read from
+    outqueue : :obj:`Queue`
+       A multiprocessing Queue object job status messages are written to
+
+    Notes
+    -----
+    Messages are (kind, job_id, worker_name, value) tuples where kind is 'started'
+    and value the pid of the script (which is also its process group id if the
+    platform supports them), or kind is 'finished' and value the return code. For
+    callable jobs the pid of the 'started' message is that of the worker itself and
+    the job is finished with a 'result' message, where value is a (return code,
+    return value, error) tuple and error is None unless the callable raised an
+    exception.
 
     """
-    if early_terminate:
-        assert callable(check_success)
-
-    success = True
+    name = multiprocessing.current_process().name
     while True:
-        if inqueue.empty():
-            logger.debug("worker {0} got empty inqueue".format(multiprocessing.current_process().name))
-            rcode = 0 if success else 1
-            sys.exit(rcode)
-
-        # Got a script so run
-        job = inqueue.get()
-
-        # Get name from script
-        logger.debug("Worker {0} running job {1}".format(multiprocessing.current_process().name, job))
-        directory, sname = os.path.split(job)
-        jobname = os.path.splitext(sname)[0]
-
-        # Change directory to the script directory
-        os.chdir(directory)
-        retcode = ample_util.run_command([job], logfile=jobname + ".log", dolog=False, check=True)
-
-        # Can we use the retcode to check?
-        # REM - is retcode object
+        task = inqueue.get()
+        if task is None:
+            logger.debug("Worker {0} got stop sentinel".format(name))
+            break
+        job_id, job, args, cores, environ = task
+        os.environ.update(environ)
+        if callable(job):
+            outqueue.put(('started', job_id, name, os.getpid()))
+            outqueue.put(('result', job_id, name, run_callable(job, args)))
+            continue
+        logger.debug("Worker {0} running job {1}".format(name, job))
+
+        def on_start(p):
+            outqueue.put(('started', job_id, name, p.pid))
+
+        retcode = run_script(job, cores, on_start=on_start)
         if retcode != 0:
-            logger.warning("WARNING! Worker {0} got retcode {1}".format(multiprocessing.current_process().name, retcode))
-            success = False
+            logger.warning("WARNING! Worker {0} got retcode {1}".format(name, retcode))
+        outqueue.put(('finished', job_id, name, retcode))
+
 
-        # Now check the result if early terminate
-        if early_terminate:
-            if check_success(job):
-                logger.debug("Worker {0} job succeeded".format(multiprocessing.current_process().name))
-                sys.exit(0)
+def run_script(job, cores, on_start=None, environ=None):
+    """Run the script job in its directory, writing the output to a log file next to it
 
+    Parameters
+    ----------
+    job : str
+       The path to the script
+    cores : int
+       The number of cores the job has been given, which is used to set OMP_NUM_THREADS
+    on_start : callable, optional
+       Called with the :obj:`subprocess.Popen` object once the script has started
+    environ : dict, optional
+       Extra environment variables to run the script with
+
+    Returns
+    -------
+    int
+       The return code of the script
+    """
+    directory, sname = os.path.split(job)
+    jobname = os.path.splitext(sname)[0]
+    env = dict(os.environ, OMP_NUM_THREADS=str(cores))
+    env.update(environ or {})
+    kwargs = {'env': env}
+    if hasattr(os, 'setsid'):
+        kwargs['preexec_fn'] = os.setsid
+    try:
+        return ample_util.run_command(
+            [job],
+            logfile=os.path.join(directory, jobname + ".log"),
+            directory=directory,
+            dolog=False,
+            check=True,
+            on_start=on_start,
+            **kwargs
+        )
+    except Exception as e:
+        logger.critical("Could not run job {0}: {1}".format(job, e))
+        return 1
+
+
+def run_callable(job, args):
+    """Call job(*args) in this process
+
+    Returns
+    -------
+    tuple
+       The return code, the value returned by the job and the error if it raised an exception
+    """
+    start = time.time()
+    try:
+        value = job(*args)
+        # Make sure the result can be sent back, as pickling errors on a queue's feeder thread are lost
+        pickle.dumps(value)
+        result = (0, value, None)
+    except Exception as e:
+        logger.debug("Callable job {0} raised an exception".format(job), exc_info=True)
+        result = (1, None, "{0}: {1}".format(e.__class__.__name__, e))
+    telemetry_util.record([getattr(job, '__name__', str(job))], result[0], start)
+    return result
@@ -4,86 +4,612 @@ Created on Feb 28, 2013
 @author: jmht
 """
 
+import atexit
+import heapq
+import itertools
 import logging
 import multiprocessing
 import os
+import signal
+import threading
 import time
 
-from ample.util import ample_util, clusterize, worker
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from ample.util import clusterize, ledger_util, telemetry_util, worker
 
 KILL_FILE = 'KILL_ME_NOW'
+MONITOR_INTERVAL = 60  # Seconds between calls to the monitor function
+POLL_INTERVAL = 0.5  # Maximum seconds before we notice a kill file or a dead worker
+KILL_GRACE = 10  # Seconds a killed job has to exit after SIGTERM before it is sent SIGKILL
 logger = logging.getLogger()
 
+# The pool shared by all stages of a run - see get_pool
+_POOL = None
+
+
+class JobFuture(object):
+    """Handle on a job submitted to a :obj:`WorkerPool`
+
+    The job is either the path to a script or a callable that the worker calls with args.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, job_id, job, pool, args=()):
+        self.job_id = job_id
+        self.job = job
+        self.args = args
+        self.name = job_name(job)
+        self.priority = 0
+        self.cores = 1
+        self.memory = None
+        self.backfilled = 0
+        self.held_for_memory = False
+        self.state = self.PENDING
+        self.returncode = None
+        self.value = None
+        self.error = None
+        self.pid = None
+        self.worker = None
+        self.start_time = None
+        self.kill_requested = False
+        self._pool = pool
+        self._event = threading.Event()
+        self._callbacks = []
+
+    def __repr__(self):
+        return "<{0} {1} [{2}] {3}>".format(self.__class__.__name__, self.job_id, self.state, self.name)
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once the job has finished or been cancelled"""
+        if self.done():
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def cancel(self):
+        """Cancel the job if it has not yet been handed to a worker
+
+        Returns
+        -------
+        bool
+           True if the job was cancelled
+        """
+        return self._pool._cancel(self)
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def done(self):
+        return self._event.is_set()
+
+    def kill(self):
+        """Cancel the job, killing its process group if it is already running
+
+        Returns
+        -------
+        bool
+           True if the job has been or will be stopped
+        """
+        return self._pool._kill(self)
+
+    def running(self):
+        return self.state == self.RUNNING
+
+    def result(self, timeout=None):
+        """Wait for the job to finish and return its return code
+
+        For a callable job the value it returned is returned instead and a RuntimeError is raised if it failed.
+        """
+        self._event.wait(timeout)
+        if not self.done():
+            raise RuntimeError("Timed out waiting for job: {0}".format(self.name))
+        if not callable(self.job):
+            return self.returncode
+        if self.returncode != 0:
+            raise RuntimeError("Job {0} failed: {1}".format(self.name, self.error or self.state))
+        return self.value
+
+    def _record(self, state, **data):
+        """Record a new state of the job in the ledger
+
+        Only scripts are recorded as they are the only jobs a restarted run can skip, which
+        saves opening the ledger for every in-process callable.
+        """
+        if not callable(self.job):
+            ledger_util.record(self.name, state, **data)
+
+    def _set_done(self, state, returncode=None):
+        self.state = state
+        self.returncode = returncode
+        if state == self.CANCELLED:
+            ledger_state = ledger_util.CANCELLED
+        else:
+            ledger_state = ledger_util.FINISHED if returncode == 0 else ledger_util.FAILED
+        wall_time = time.time() - self.start_time if self.start_time else None
+        self._record(ledger_state, returncode=returncode, wall_time=wall_time)
+        self._event.set()
+        for fn in self._callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.critical("Callback for job {0} raised an exception: {1}".format(self.name, e))
+
+
+class WorkerPool(object):
+    """A pool of long-lived local worker processes that run job scripts and Python callables.
+
+    Jobs are submitted with :meth:`submit`, which returns a :obj:`JobFuture`. The
+    pool holds pending jobs itself and only hands a job over when a worker is
+    free, so jobs can be cancelled or reprioritised right up until they start.
+    Pending jobs are run lowest priority value first, and in order of submission
+    for equal priorities. Workers stay alive between calls so the same pool can
+    be reused by every stage of a run.
+
+    Each job declares the number of cores and the memory it needs and jobs are
+    only started when there are enough free cores and memory for them. When the
+    next job does not fit, smaller jobs further down the queue are started in
+    its place, but only up to nproc times so the blocked job is not starved.
+
+    Each worker has its own queue and is only handed a job when it is idle, so the
+    pool always knows which worker has a job and can fail it if the worker dies.
+
+    Parameters
+    ----------
+    nproc : int
+       The number of cores to use
+    memory : int, optional
+       The memory available to jobs in MB [default: the physical memory of the machine]
+
+    """
+
+    def __init__(self, nproc, memory=None):
+        self.nproc = nproc
+        self.memory = memory or physical_memory()
+        self.closed = False
+        self._inqueues = {}  # worker name -> the queue its jobs are sent on
+        self._outqueue = multiprocessing.Queue()
+        self._lock = threading.Condition()
+        self._job_ids = itertools.count()
+        self._pending = []  # heap of [priority, job_id, future]
+        self._running = {}
+        self._cores_used = 0
+        self._memory_used = 0
+        self._workers = {}
+        self._start()
+
+    def _start(self):
+        """Start the workers and the thread that reads their messages"""
+        self._grow(self.nproc)
+        self._thread = threading.Thread(target=self._handle_results, name='WorkerPoolResults')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def resize(self, nproc):
+        """Change the maximum number of jobs run at the same time"""
+        with self._lock:
+            self.nproc = nproc
+            self._grow(nproc)
+            self._dispatch()
+
+    def reprioritise(self, futures, priority):
+        """Reorder pending futures using the callable priority(job)"""
+        futures = set(futures)
+        with self._lock:
+            for entry in self._pending:
+                if entry[2] in futures:
+                    entry[0] = entry[2].priority = priority(entry[2].job)
+            heapq.heapify(self._pending)
+
+    def submit(self, job, priority=0, cores=1, memory=None, args=()):
+        """Queue job to be run and return a :obj:`JobFuture` for it
+
+        Parameters
+        ----------
+        job : str or callable
+           The path to the script to run or a picklable callable, such as a module-level function
+        priority : int or float, optional
+           Jobs with the lowest priority are run first
+        cores : int, optional
+           The number of cores the job uses - this is used to set OMP_NUM_THREADS for the job
+        memory : int, optional
+           An estimate of the peak memory used by the job in MB
+        args : tuple, optional
+           The arguments a callable job is called with
+        """
+        if not callable(job) and not os.path.isfile(job):
+            raise RuntimeError("WorkerPool cannot find job: {0}".format(job))
+        future = JobFuture(next(self._job_ids), job, self, args=args)
+        future.priority = priority
+        # A job can never have more than the whole machine or it would never run
+        future.cores = max(1, min(cores, self.nproc))
+        future.memory = min(memory, self.memory) if memory and self.memory else None
+        # Written before the job is queued so it always comes before the job's other entries
+        future._record(ledger_util.SUBMITTED, priority=priority, cores=future.cores)
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("Cannot submit jobs to a WorkerPool that has been shut down")
+            heapq.heappush(self._pending, [priority, future.job_id, future])
+            self._dispatch()
+        return future
+
+    def wait(self, futures, timeout=None):
+        """Block until at least one of the futures is done or timeout seconds have passed"""
+        with self._lock:
+            if not any(f.done() for f in futures):
+                self._lock.wait(timeout)
+        return [f for f in futures if f.done()]
+
+    def shutdown(self, wait=True):
+        """Stop the workers
+
+        Any jobs that have not yet started are cancelled. If wait is True we wait
+        for running jobs to finish, otherwise the workers are terminated.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            cancelled = [entry[2] for entry in self._pending]
+            del self._pending[:]
+        for future in cancelled:
+            future._set_done(JobFuture.CANCELLED)
+        workers = list(self._workers.values())
+        for process in workers:
+            if wait:
+                self._inqueues[process.name].put(None)
+            else:
+                process.terminate()
+        for process in workers:
+            process.join()
+        self._outqueue.put(None)
+        self._thread.join()
+
+    def _cancel(self, future):
+        with self._lock:
+            entries = [entry for entry in self._pending if entry[2] is future]
+            if not entries:
+                return False
+            self._pending.remove(entries[0])
+            heapq.heapify(self._pending)
+        future._set_done(JobFuture.CANCELLED)
+        self._notify()
+        return True
+
+    def _kill(self, future):
+        if self._cancel(future):
+            return True
+        if not hasattr(os, 'killpg'):
+            logger.warning("Cannot kill job {0} as this platform has no process groups".format(future.name))
+            return False
+        with self._lock:
+            if future.job_id not in self._running:
+                return False
+            future.kill_requested = True
+            if future.pid:
+                # If the job hasn't started yet it will be killed as soon as we hear that it has
+                self._signal(future, signal.SIGTERM)
+        timer = threading.Timer(KILL_GRACE, self._force_kill, args=(future,))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _force_kill(self, future):
+        with self._lock:
+            if not future.done() and future.pid:
+                self._signal(future, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(future, signum):
+        """Send signum to the process group of a running job
+
+        A callable job runs in the worker itself, so the worker is signalled instead and
+        will be replaced once it has died.
+        """
+        logger.info("Sending signal {0} to job {1} with process group {2}".format(signum, future.name, future.pid))
+        try:
+            if callable(future.job):
+                os.kill(future.pid, signum)
+            else:
+                os.killpg(future.pid, signum)
+        except OSError as e:
+            logger.debug("Could not signal process group {0}: {1}".format(future.pid, e))
+
+    def _dispatch(self):
+        """Hand pending jobs to the workers while there are resources for them - must be called with the lock held"""
+        started = set()
+        blocked = None
+        busy = set(f.worker for f in self._running.values())
+        idle = [name for name in self._workers if name not in busy]
+        for entry in sorted(self._pending):
+            future = entry[2]
+            if not idle or (blocked is not None and blocked.backfilled >= self.nproc):
+                break
+            if not self._fits(future):
+                if blocked is None:
+                    blocked = future
+                continue
+            # The worker is recorded now so the job can be failed if the worker dies before it says it has started
+            future.worker = idle.pop(0)
+            self._running[future.job_id] = future
+            self._cores_used += future.cores
+            self._memory_used += future.memory or 0
+            self._inqueues[future.worker].put(
+                (future.job_id, future.job, future.args, future.cores, telemetry_util.environment())
+            )
+            started.add(future.job_id)
+            if blocked is not None:
+                blocked.backfilled += 1
+        if started:
+            self._pending = [entry for entry in self._pending if entry[1] not in started]
+            heapq.heapify(self._pending)
+
+    def _fits(self, future):
+        if self._cores_used + future.cores > self.nproc:
+            return False
+        if future.memory and self._memory_used + future.memory > self.memory:
+            if not future.held_for_memory:
+                logger.info(
+                    "Job {0} needs {1} MB but only {2} of {3} MB are free - waiting for memory".format(
+                        future.name, future.memory, self.memory - self._memory_used, self.memory
+                    )
+                )
+                future.held_for_memory = True
+            return False
+        return True
+
+    def _release(self, future):
+        """Free the resources of a job that has stopped running - must be called with the lock held"""
+        del self._running[future.job_id]
+        self._cores_used -= future.cores
+        self._memory_used -= future.memory or 0
+
+    def _grow(self, nproc):
+        while len(self._workers) < nproc:
+            inqueue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=worker.worker, args=(inqueue, self._outqueue))
+            process.start()
+            self._workers[process.name] = process
+            self._inqueues[process.name] = inqueue
+
+    def _handle_results(self):
+        """Thread that reads job status messages from the workers"""
+        while True:
+            try:
+                msg = self._outqueue.get(True, POLL_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if msg is None:
+                break
+            kind, job_id, worker_name, value = msg
+            with self._lock:
+                future = self._running.get(job_id)
+                if future is None:
+                    continue
+                if kind == 'started':
+                    self._started(future, worker_name, value)
+                else:
+                    if kind == 'result':
+                        value, future.value, future.error = value
+                    self._release(future)
+                    self._dispatch()
+            if kind == 'started':
+                future._record(ledger_util.STARTED, pid=value)
+                continue
+            state = JobFuture.CANCELLED if future.kill_requested else JobFuture.FINISHED
+            future._set_done(state, value)
+            self._notify()
+
+    def _started(self, future, worker_name, pid):
+        """Record that a job has started - must be called with the lock held"""
+        future.state = JobFuture.RUNNING
+        future.pid = pid
+        future.worker = worker_name
+        future.start_time = time.time()
+        if future.kill_requested:
+            self._signal(future, signal.SIGTERM)
+
+    def _check_workers(self):
+        """Replace any worker that died and fail the job it had been given"""
+        with self._lock:
+            if self.closed:
+                return
+            for name, process in list(self._workers.items()):
+                if process.is_alive():
+                    continue
+                logger.critical("Worker {0} died with exitcode {1}".format(name, process.exitcode))
+                del self._workers[name]
+                del self._inqueues[name]
+            # Whether or not the worker managed to say that it had started the job
+            failed = [future for future in self._running.values() if future.worker not in self._workers]
+            for future in failed:
+                self._release(future)
+            self._grow(self.nproc)
+            self._dispatch()
+        for future in failed:
+            future._set_done(JobFuture.CANCELLED if future.kill_requested else JobFuture.FINISHED, 1)
+        if failed:
+            self._notify()
+
+    def _notify(self):
+        with self._lock:
+            self._lock.notify_all()
+
+
+def job_name(job):
+    """Return the name of a job, which is the path for a script or module.name for a callable"""
+    if callable(job):
+        return "{0}.{1}".format(getattr(job, '__module__', None), getattr(job, '__name__', job))
+    return job
+
+
+def physical_memory():
+    """Return the physical memory of the machine in MB or None if it cannot be determined"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def fork_pool(nproc):
+    """Return a :obj:`multiprocessing.Pool` with nproc forked processes
+
+    The processes inherit the memory of the parent, so large arrays set in module globals before the
+    pool is created don't need to be pickled and sent to them.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork').Pool(nproc)
+    return multiprocessing.Pool(nproc)
+
+
+def get_pool(nproc):
+    """Return the shared :obj:`WorkerPool`, creating it or resizing it to nproc as required"""
+    global _POOL
+    if _POOL is None or _POOL.closed:
+        _POOL = WorkerPool(nproc)
+    elif _POOL.nproc != nproc:
+        _POOL.resize(nproc)
+    return _POOL
+
+
+def shutdown_pool(wait=True):
+    """Shut down the shared :obj:`WorkerPool` if there is one"""
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=wait)
+        _POOL = None
+
+
+# Make sure we don't leave workers behind if we exit without shutting down cleanly
+atexit.register(shutdown_pool, wait=False)
+
 
 class JobServer(object):
+    """Run a list of job scripts on the shared local :obj:`WorkerPool`"""
+
     def __init__(self):
-        self.inqueue = None
-        self.outqueue = None
+        self.jobs = []
+        self.futures = []
         logger.info("Running jobs on a local machine")
         logger.info("To stop jobs gracefully create an empty file located at: %s" % os.path.abspath(KILL_FILE))
 
     def empty_job_queue(self):
         logger.info("emptying job queue")
-        # Remove all remaining processes from the inqueue. We do this rather than terminate the processes
+        # Cancel all jobs that haven't started. We do this rather than terminate the processes
         # as terminating leaves the MRBUMP processes running. This way we hang around until all our
         # running processes have finished
-        while not self.inqueue.empty():
-            job = self.inqueue.get()
-            logger.debug("Removed job [{0}] from inqueue".format(job))
+        for future in self.futures:
+            if future.cancel():
+                logger.debug("Removed job [{0}] from queue".format(future.job))
         return
 
     def setJobs(self, jobs):
         """Add the list of jobs we are to run"""
-        if self.inqueue:
+        if self.jobs:
             raise RuntimeError("NOT THOUGHT ABOUT MULTIPLE INVOCATIONS!")
-        queue = multiprocessing.Queue()
         for job in jobs:
             if not os.path.isfile(job):
                 raise RuntimeError("JobServer cannot find job: {0}".format(job))
-            queue.put(job)
-        self.inqueue = queue
-        # self.inqueue.close()
-        # We can't call inqueue.close() even though we've finished as it all goes horribly wrong
-        # We sleep to allow enough time for the objects to be picked and put on the queue
-        time.sleep(2)
+        self.jobs = list(jobs)
+        return
+
+    def kill_running_jobs(self):
+        """Kill any of our jobs that are still running"""
+        for future in self.futures:
+            if not future.done() and future.kill():
+                logger.info("Killed job [{0}]".format(future.job))
         return
 
-    def start(self, nproc=None, early_terminate=False, check_success=None, monitor=None):
+    def start(
+        self,
+        nproc=None,
+        early_terminate=False,
+        check_success=None,
+        monitor=None,
+        prioritiser=None,
+        early_terminate_kill=False,
+        job_cores=1,
+        job_memory=None,
+        pool=None,
+    ):
+        """Run the jobs and wait for them to finish
+
+        Parameters
+        ----------
+        nproc : int
+           The number of jobs to run at the same time
+        early_terminate : bool
+           Remove any jobs that haven't started once check_success returns True for a job
+        check_success : callable
+           A callable to check the success status of a job
+        monitor : callable
+           Called periodically while the jobs are running
+        prioritiser : object
+           An object with a priority(job) method that returns the priority of a job (lowest runs first)
+           and a job_finished(job, returncode) method that returns True if the priorities have changed
+        early_terminate_kill : bool
+           With early_terminate, also kill any jobs that are still running when a job succeeds
+        job_cores : int
+           The number of cores each job uses
+        job_memory : int
+           An estimate of the peak memory used by each job in MB
+        pool : :obj:`WorkerPool`
+           The pool to run the jobs on [default: the shared local pool]
+
+        Returns
+        -------
+        bool
+           True if all jobs that ran returned 0
+        """
         assert nproc != None
-        # Start the jobs
-        processes = []
-        for i in range(nproc):
-            process = multiprocessing.Process(target=worker.worker, args=(self.inqueue, early_terminate, check_success))
-            process.start()
-            processes.append(process)
+        if early_terminate:
+            assert callable(check_success)
+        if pool is None:
+            pool = get_pool(nproc)
+        self.futures = []
+        for job in self.jobs:
+            priority = prioritiser.priority(job) if prioritiser else 0
+            self.futures.append(pool.submit(job, priority=priority, cores=job_cores, memory=job_memory))
         if monitor:
             monitor()
+        last_monitor = time.time()
         success = True
-        timeout = 1 * 60
-        # qsize=self.outqueue.qsize() # Broken on OSX
-        while len(processes):
-            for i, process in enumerate(processes):
-                if os.path.isfile(KILL_FILE):
+        killed = False
+        unfinished = list(self.futures)
+        while unfinished:
+            # Wake up as soon as any job finishes, or after POLL_INTERVAL to check the kill file
+            done = pool.wait(unfinished, timeout=POLL_INTERVAL)
+            if os.path.isfile(KILL_FILE):
+                if not killed:
                     logger.critical("Found kill file {} so stopping job".format(KILL_FILE))
+                    killed = True
+                self.empty_job_queue()
+            for future in done:
+                unfinished.remove(future)
+                if future.cancelled():
+                    continue
+                logger.debug("Checking completed job {0} with returncode {1}".format(future.job, future.returncode))
+                if future.returncode != 0:
+                    logger.critical("Job {0} failed with returncode {1}".format(future.job, future.returncode))
+                    success = False
+                elif early_terminate and check_success(future.job):
+                    logger.info("Job {0} was successful so removing remaining jobs from queue".format(future.job))
                     self.empty_job_queue()
-                process.join(
-                    timeout
-                )  # Join process for timeout seconds and if we haven't finished by then move onto the next process
-                if not process.is_alive():
-                    logger.debug("Checking completed process {0} with exitcode {1}".format(process, process.exitcode))
-                    if process.exitcode != 0:
-                        logger.critical("Process {0} failed with exitcode {1}".format(process, process.exitcode))
-                        success = False
-                    if process.exitcode == 0 and early_terminate:
-                        logger.info(
-                            "Process {0} was successful so removing remaining jobs from inqueue".format(process.name)
-                        )
-                        self.empty_job_queue()
-                    del processes[i]
-                if monitor:
-                    monitor()
-        # need to wait here as sometimes it takes a while for the results files to get written
-        time.sleep(3)
+                    if early_terminate_kill:
+                        self.kill_running_jobs()
+                if prioritiser and prioritiser.job_finished(future.job, future.returncode):
+                    pool.reprioritise(unfinished, prioritiser.priority)
+            if monitor and time.time() - last_monitor >= MONITOR_INTERVAL:
+                monitor()
+                last_monitor = time.time()
         return success
 
 
@@ -102,8 +628,16 @@ def run_scripts(
     submit_pe_sge=None,
     submit_array=None,
     submit_max_array=None,
+    prioritiser=None,
+    early_terminate_kill=False,
+    job_cores=1,
+    job_memory=None,
+    submit_broker=None,
 ):
     if submit_cluster:
+        if prioritiser:
+            # We can't reorder jobs once they are on the queue so just submit them in priority order
+            job_scripts = sorted(job_scripts, key=prioritiser.priority)
         return run_scripts_cluster(
             job_scripts,
             nproc=nproc,
@@ -118,8 +652,23 @@ def run_scripts(
             submit_max_array=submit_max_array,
         )
     else:
+        pool = None
+        if submit_broker:
+            # Imported here as the broker module depends on this one
+            from ample.util import broker
+
+            pool = broker.get_broker(submit_broker, nproc=nproc)
         return run_scripts_serial(
-            job_scripts, nproc=nproc, monitor=monitor, early_terminate=early_terminate, check_success=check_success
+            job_scripts,
+            nproc=nproc,
+            monitor=monitor,
+            early_terminate=early_terminate,
+            check_success=check_success,
+            prioritiser=prioritiser,
+            early_terminate_kill=early_terminate_kill,
+            job_cores=job_cores,
+            job_memory=job_memory,
+            pool=pool,
         )
 
 
@@ -170,11 +719,14 @@ def run_scripts_cluster(
                 submit_pe_lsf=submit_pe_lsf,
                 submit_pe_sge=submit_pe_sge,
             )
-            # We add the queue directives after the first line of the script
+            # We add the queue directives and the line that writes the sentinel file after the first line of the script
+            done_file = script + clusterize.DONE_EXT
+            slines.append(clusterize.done_trap(done_file))
             with open(script, 'w') as f:
                 f.writelines("".join([lines[0]] + slines + lines[1:]))
             os.chmod(script, 0o777)
-            cluster_run.submitJob(script)
+            clusterize.remove_done_files([done_file])
+            cluster_run.submitJob(script, doneFiles=[done_file])
 
     # Monitor the cluster queue to see when all jobs have finished
     cluster_run.monitorQueue(monitor=monitor)
@@ -185,25 +737,31 @@ def run_scripts_cluster(
     return True
 
 
-def run_scripts_serial(job_scripts, nproc=None, monitor=None, early_terminate=None, check_success=None):
-    success = False
-    if len(job_scripts) > 1:
-        # Don't need early terminate - check_success if it exists states what's happening
-        js = JobServer()
-        js.setJobs(job_scripts)
-        success = js.start(
-            nproc=nproc, early_terminate=bool(early_terminate), check_success=check_success, monitor=monitor
-        )
-    else:
-        script = job_scripts[0]
-        name = os.path.splitext(os.path.basename(script))[0]
-        logfile = "{0}.log".format(name)
-        wdir = os.path.dirname(script)
-        os.chdir(wdir)
-        rtn = ample_util.run_command([script], logfile=logfile)
-        if rtn == 0:
-            success = True
-    return success
+def run_scripts_serial(
+    job_scripts,
+    nproc=None,
+    monitor=None,
+    early_terminate=None,
+    check_success=None,
+    prioritiser=None,
+    early_terminate_kill=False,
+    job_cores=1,
+    job_memory=None,
+    pool=None,
+):
+    js = JobServer()
+    js.setJobs(job_scripts)
+    return js.start(
+        nproc=nproc or 1,
+        early_terminate=bool(early_terminate),
+        check_success=check_success,
+        monitor=monitor,
+        prioritiser=prioritiser,
+        early_terminate_kill=bool(early_terminate_kill),
+        job_cores=job_cores,
+        job_memory=job_memory,
+        pool=pool,
+    )
 
 
 # Need this defined outside of the test or it can't be pickled on Windoze